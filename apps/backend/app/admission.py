@@ -0,0 +1,163 @@
+import bisect, math, time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Iterable
+
+from fastapi import HTTPException
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import metrics, scheduler
+from app.config import settings
+from app.models import Job, JobStatus
+
+# Допуск задач в очередь. Время ожидания оцениваем как
+#   (задач впереди) * (среднее время обслуживания) / (слотов воркеров),
+# среднее берём по последним ADMISSION_SAMPLE завершённым задачам линии.
+# Очередь длиннее ADMISSION_MAX_QUEUE или ожидание дольше
+# ADMISSION_MAX_WAIT_SEC — 429 с Retry-After, а не задача, которая
+# закончится через полчаса без единого сигнала клиенту.
+
+_DEFAULT_SERVICE_SEC = {"infer": 20.0, "tex": 5.0}
+_service_cache: dict[str, tuple[float, float]] = {}  # kind -> (когда посчитали, секунд на задачу)
+
+
+@dataclass
+class QueueInfo:
+    position: int  # 0 — уже выполняется
+    eta_sec: int
+
+
+def _slots(kind: str) -> int:
+    slots = settings.ADMISSION_WORKER_SLOTS or settings.WORKER_CONCURRENCY
+    if kind == "tex":
+        slots += settings.WORKER_TEX_SLOTS
+    return max(1, slots)
+
+
+async def service_time(session: AsyncSession, kind: str) -> float:
+    now = time.monotonic()
+    cached = _service_cache.get(kind)
+    if cached and now - cached[0] < settings.ADMISSION_STATS_TTL_SEC:
+        return cached[1]
+    recent = (
+        select(Job.started_at, Job.finished_at)
+        .where(Job.kind == kind, Job.status == JobStatus.done,
+               Job.started_at.is_not(None), Job.finished_at.is_not(None))
+        .order_by(Job.finished_at.desc())
+        .limit(settings.ADMISSION_SAMPLE)
+    )
+    rows = (await session.execute(recent)).all()
+    durations = [
+        (scheduler._aware(fin) - scheduler._aware(st)).total_seconds() for st, fin in rows
+    ]
+    durations = [d for d in durations if d >= 0]
+    value = sum(durations) / len(durations) if durations else _DEFAULT_SERVICE_SEC.get(kind, 10.0)
+    _service_cache[kind] = (now, value)
+    metrics.set_gauge(f"admission.service_sec.{kind}", value)
+    return value
+
+
+async def queue_depth(session: AsyncSession, kind: str) -> int:
+    return int((await session.execute(
+        select(func.count()).select_from(Job).where(Job.kind == kind, Job.status == JobStatus.queued)
+    )).scalar_one())
+
+
+def _wait_for(ahead: int, service: float, kind: str) -> float:
+    return ahead * service / _slots(kind)
+
+
+async def admit(session: AsyncSession, kind: str) -> None:
+    # бросает 429, если новую задачу линии kind сейчас брать нельзя
+    depth = await queue_depth(session, kind)
+    service = await service_time(session, kind)
+    wait = _wait_for(depth, service, kind)
+    limit_q = settings.ADMISSION_MAX_QUEUE
+    limit_w = settings.ADMISSION_MAX_WAIT_SEC
+    over_q = limit_q > 0 and depth >= limit_q
+    over_w = limit_w > 0 and wait > limit_w
+    if not (over_q or over_w):
+        return
+    # когда очередь рассосётся до порога
+    excess = max(depth - limit_q + 1 if over_q else 0, math.ceil((wait - limit_w) * _slots(kind) / service) if over_w else 0)
+    retry_after = max(1, math.ceil(_wait_for(excess, service, kind)))
+    metrics.inc(f"admission.rejected.{kind}")
+    raise HTTPException(
+        429, "сервер перегружен, повторите позже",
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+_order_cache: dict = {}  # снимок queue_order: at, lanes (ключи по линиям), keys (job id -> ключ), per_user, epoch
+
+
+def _order_key(job, rank: int, now: datetime) -> tuple:
+    return (-scheduler.level(job, now), rank, scheduler._aware(job.created_at))
+
+
+async def queue_order(session: AsyncSession) -> dict:
+    # Порядок всей очереди (лёгкие колонки, один запрос) — общий для всех опросов
+    # процесса на ADMISSION_QUEUE_TTL_SEC, а не пересчёт O(очереди) на каждый GET.
+    # Впереди задачи — те, что планировщик возьмёт раньше: уровень (вес линии,
+    # премиум, ожидание — scheduler.level), затем очерёдность внутри
+    # пользователя (round-robin: вторые задачи всех идут после первых), затем возраст.
+    t = time.monotonic()
+    if _order_cache and t - _order_cache["at"] < settings.ADMISSION_QUEUE_TTL_SEC:
+        return _order_cache
+    rank = func.row_number().over(partition_by=(Job.kind, Job.user_id), order_by=Job.created_at).label("rank")
+    rows = (await session.execute(
+        select(Job.id, Job.kind, Job.user_id, Job.priority, Job.created_at, rank).where(Job.status == JobStatus.queued)
+    )).all()
+    now = datetime.now(timezone.utc)
+    keys, lanes, per_user, heads = {}, {}, {}, {}
+    for r in rows:
+        keys[r.id] = k = _order_key(r, r.rank, now)
+        lanes.setdefault(r.kind, []).append(k)
+        per_user[(r.kind, r.user_id)] = max(per_user.get((r.kind, r.user_id), 0), r.rank)
+        if r.kind not in heads or (k, r.id) < heads[r.kind]:
+            heads[r.kind] = (k, r.id)
+    for lane in lanes.values():
+        lane.sort()
+    # эпоха — первые задачи линий: сменилась голова (задачу взяли) — сдвинулись позиции
+    epoch = ",".join(f"{kind}:{heads[kind][1]}" for kind in sorted(heads))
+    _order_cache.clear()
+    _order_cache.update(at=t, lanes=lanes, keys=keys, per_user=per_user, epoch=epoch)
+    return _order_cache
+
+
+async def queue_epoch(session: AsyncSession) -> str:
+    # дешёвая метка состояния очереди для ETag: без позиций, из общего снимка
+    return (await queue_order(session))["epoch"]
+
+
+async def queue_info(session: AsyncSession, project_ids: Iterable) -> dict:
+    # project_id -> QueueInfo для проектов, у которых есть задача в очереди или в работе.
+    # Свои задачи — одним запросом по project_id; место среди остальных — по queue_order.
+    # Задача, поставленная после снимка, встаёт по своему ключу (ранг — следующий у пользователя)
+    project_ids = list(project_ids)
+    if not project_ids:
+        return {}
+    rows = (await session.execute(
+        select(Job.id, Job.project_id, Job.kind, Job.user_id, Job.priority, Job.status, Job.created_at, Job.started_at)
+        .where(Job.project_id.in_(project_ids), Job.status.in_((JobStatus.queued, JobStatus.running)))
+    )).all()
+    order = await queue_order(session) if any(r.status == JobStatus.queued for r in rows) else None
+
+    now = datetime.now(timezone.utc)
+    out: dict = {}
+    for r in rows:
+        service = await service_time(session, r.kind)
+        if r.status == JobStatus.running:
+            elapsed = 0.0
+            if r.started_at is not None:
+                elapsed = (now - scheduler._aware(r.started_at)).total_seconds()
+            info = QueueInfo(0, max(1, math.ceil(service - elapsed)))
+        else:
+            key = order["keys"].get(r.id) or _order_key(r, order["per_user"].get((r.kind, r.user_id), 0) + 1, now)
+            ahead = bisect.bisect_left(order["lanes"].get(r.kind, []), key)
+            info = QueueInfo(ahead + 1, max(1, math.ceil(_wait_for(ahead, service, r.kind) + service)))
+        prev = out.get(r.project_id)
+        if prev is None or info.eta_sec > prev.eta_sec:
+            out[r.project_id] = info
+    return out
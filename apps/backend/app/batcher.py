@@ -0,0 +1,146 @@
+import threading, time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Callable, Hashable, Iterable, Optional
+
+from app import metrics
+
+# Динамический микробатчинг: кропы от всех одновременно идущих страниц
+# копятся до max_batch штук или max_wait_ms с момента прихода первого,
+# затем уходят в модель одним вызовом. Каждый вызывающий получает свой
+# результат через Future.
+#
+#   страница A ─┐                      ┌─> Future A1, A2
+#   страница B ─┼─> очередь[key] ─> fn(batch) ─> Future B1
+#   страница C ─┘                      └─> Future C1, C2, C3
+#
+# key разделяет очереди с разными параметрами генерации (beams, длина):
+# в один батч попадают только совместимые элементы.
+
+
+class MicroBatcher:
+    def __init__(self, fn: Callable[[list, Hashable], list], max_batch: int = 16,
+                 max_wait_ms: float = 5.0, name: str = "batch"):
+        # fn(items, key) -> список результатов той же длины и в том же порядке
+        self.fn = fn
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.name = name
+        self._queues: dict[Hashable, deque] = {}
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._retired = False  # сменён новым: поток уходит, когда очередь пуста
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name=f"batcher-{self.name}", daemon=True)
+            self._thread.start()
+
+    def submit(self, item, key: Hashable = ()) -> Future:
+        fut: Future = Future()
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError(f"batcher {self.name} is stopped")
+            self._ensure_thread()
+            self._queues.setdefault(key, deque()).append((item, fut, time.monotonic()))
+            self._cond.notify()
+        return fut
+
+    def map(self, items: Iterable, key: Hashable = (), cancel=None) -> list:
+        futs = [self.submit(it, key) for it in items]
+        if cancel is None:
+            return [f.result() for f in futs]
+        # ждём порциями, чтобы заметить отмену; свои ещё не ушедшие в модель элементы снимаем
+        try:
+            out = []
+            for f in futs:
+                while True:
+                    cancel.raise_if_cancelled()
+                    try:
+                        out.append(f.result(timeout=0.05))
+                        break
+                    except FutureTimeout:
+                        continue
+            return out
+        finally:
+            for f in futs:
+                f.cancel()
+
+    def _take(self) -> Optional[tuple[Hashable, list]]:
+        # под self._cond: выбирает очередь, которой пора уходить в модель
+        while not self._stopping:
+            if self._retired and not any(self._queues.values()):
+                return None
+            now = time.monotonic()
+            oldest_key, oldest_t = None, None
+            for key, q in self._queues.items():
+                if not q:
+                    continue
+                if len(q) >= self.max_batch:
+                    oldest_key, oldest_t = key, now - self.max_wait
+                    break
+                if oldest_t is None or q[0][2] < oldest_t:
+                    oldest_key, oldest_t = key, q[0][2]
+            if oldest_key is None:
+                self._cond.wait()
+                continue
+            deadline = oldest_t + self.max_wait
+            if now < deadline:
+                self._cond.wait(deadline - now)
+                continue
+            q = self._queues[oldest_key]
+            batch = []
+            while q and len(batch) < self.max_batch:
+                entry = q.popleft()
+                if entry[1].set_running_or_notify_cancel():  # False — вызывающий уже отказался
+                    batch.append(entry)
+            if not q:
+                del self._queues[oldest_key]
+            if batch:
+                return oldest_key, batch
+        return None
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                taken = self._take()
+                if taken is None:
+                    # submit после выхода поднимет новый поток
+                    if self._thread is threading.current_thread():
+                        self._thread = None
+                    return
+            key, batch = taken
+            now = time.monotonic()
+            metrics.observe(f"batch.{self.name}.size", len(batch))
+            metrics.observe(f"batch.{self.name}.wait_ms", (now - batch[0][2]) * 1000.0)
+            try:
+                results = self.fn([item for item, _, _ in batch], key)
+                if len(results) != len(batch):
+                    raise RuntimeError(f"batcher {self.name}: {len(results)} results for {len(batch)} items")
+            except BaseException as e:
+                for _, fut, _ in batch:
+                    fut.set_exception(e)
+                continue
+            for (_, fut, _), res in zip(batch, results):
+                fut.set_result(res)
+
+    def retire(self):
+        # мягкая замена close: батчер ещё могут держать идущие страницы (модели
+        # сменились посреди их работы) — их вызовы обслуживаем, а поток
+        # отпускаем, как только очередь опустела; submit поднимет его снова
+        with self._cond:
+            self._retired = True
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._stopping = True
+            pending = [entry for q in self._queues.values() for entry in q]
+            self._queues.clear()
+            self._cond.notify_all()
+        for _, fut, _ in pending:
+            if fut.set_running_or_notify_cancel():
+                fut.set_exception(RuntimeError(f"batcher {self.name} is stopped"))
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
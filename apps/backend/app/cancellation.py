@@ -0,0 +1,132 @@
+import os, signal, subprocess, threading, time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+# Кооперативная отмена задачи. Токен живёт в воркере, проверяется между
+# шагами (raise_if_cancelled) и умеет убивать запущенные подпроцессы:
+# attach_process регистрирует процесс, cancel() убивает всю его группу
+# (latexmk порождает pdflatex, убить надо обоих).
+#
+# У токена может быть срок (timeout): после него проверка бросает
+# DeadlineExceeded, а подпроцессы получают таймаут не больше остатка.
+# stage() даёт дочерний токен со своим, более коротким сроком этапа;
+# отмена родителя отменяет и его.
+
+
+class Cancelled(Exception):
+    pass
+
+
+class DeadlineExceeded(Cancelled):
+    pass
+
+
+class CancelToken:
+    def __init__(self, timeout: Optional[float] = None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: list[Callable[[], None]] = []
+        self.reason = ""
+        self._exc = Cancelled
+        self.deadline = time.monotonic() + timeout if timeout else None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set() or self.expired
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def bound(self, timeout: Optional[float]) -> Optional[float]:
+        # таймаут операции, урезанный до остатка срока
+        rem = self.remaining()
+        if rem is None:
+            return timeout
+        return rem if timeout is None else min(timeout, rem)
+
+    def cancel(self, reason: str = "cancelled", exc: type = Cancelled) -> None:
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._exc = exc
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for cb in callbacks:
+            try:
+                cb()
+            except Exception as e:
+                print(f"[cancel] callback failed: {e}")
+
+    def exception(self) -> Cancelled:
+        return self._exc(self.reason)
+
+    def expire(self) -> None:
+        self.cancel("deadline exceeded", DeadlineExceeded)
+
+    def raise_if_cancelled(self) -> None:
+        if not self._event.is_set() and self.expired:
+            self.expire()
+        if self._event.is_set():
+            raise self.exception()
+
+    @contextmanager
+    def stage(self, name: str, timeout: Optional[float] = None):
+        child = CancelToken(self.bound(timeout))
+        detach = self.on_cancel(lambda: child.cancel(self.reason, self._exc))
+        try:
+            yield child
+        except DeadlineExceeded as e:
+            raise DeadlineExceeded(f"{name}: {e}") from None
+        finally:
+            detach()
+
+    def on_cancel(self, cb: Callable[[], None]) -> Callable[[], None]:
+        # возвращает функцию снятия; если уже отменено — cb вызывается сразу
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(cb)
+                return lambda: self._discard(cb)
+        cb()
+        return lambda: None
+
+    def _discard(self, cb) -> None:
+        with self._lock:
+            try:
+                self._callbacks.remove(cb)
+            except ValueError:
+                pass
+
+    def attach_process(self, proc: subprocess.Popen) -> Callable[[], None]:
+        return self.on_cancel(lambda: kill_process_tree(proc))
+
+
+def kill_process_tree(proc: subprocess.Popen) -> None:
+    if proc.poll() is not None:
+        return
+    if os.name == "posix":
+        kill_process_group(proc.pid)
+    else:
+        proc.kill()
+
+
+def kill_process_group(pid: int) -> None:
+    # процесс запущен с start_new_session=True: pgid == pid
+    try:
+        if os.name == "posix":
+            os.killpg(pid, signal.SIGKILL)
+        else:
+            os.kill(pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def check(token: Optional[CancelToken]) -> None:
+    if token is not None:
+        token.raise_if_cancelled()
@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings
 from pydantic import AnyUrl
 
@@ -37,6 +39,7 @@ class Settings(BaseSettings):
     DETECTOR_WEIGHTS: str = "models/detector/best.pt"
     TROCR_DIR: str = "models/trocr_latex_fast"
     WORDS_OCR_WEIGHTS: str = "models/words_recognizer/ocr_transformer_multi.pt"
+    HTR_WEIGHTS: str = "models/words_recognizer/ocr_transformer.pt"
     TEMP_DIR: str = "temp"
     DET_CONF: float = 0.25
     DET_IOU: float = 0.5
@@ -48,6 +51,105 @@ class Settings(BaseSettings):
     BIN_STRENGTH: float = 0.75
     ERODE_KERNEL: int = 3
 
+    UPLOAD_DEBUG_CROPS: bool = False  # выкладывать page.crops рядом с артефактами проекта
+
+    # Job queue (таблица jobs; воркеры: python -m app.worker)
+    JOB_LEASE_SEC: int = 120
+    JOB_HEARTBEAT_SEC: int = 20
+    JOB_MAX_ATTEMPTS: int = 3
+    JOB_RETENTION_DAYS: int = 14       # завершённые задачи старше удаляет GC воркера; 0 — хранить всё
+    JOB_GC_INTERVAL_SEC: int = 3600
+    WORKER_POLL_SEC: float = 1.0
+    WORKER_CONCURRENCY: int = 2
+    WORKER_TEX_SLOTS: int = 1   # отдельные слоты только под tex, чтобы перекомпиляции не ждали распознавание
+    PANDOC_TIMEOUT_SEC: int = 120
+    DOCX_NATIVE: bool = True  # docx из блоков/нашего tex без pandoc (app/utils/docx_writer.py); pandoc — для прочего tex
+    LOOP_LAG_WARN_MS: float = 100.0   # блокировку event loop дольше этого пишем в лог
+    TEX_SUPERSEDE_POLL_SEC: float = 1.0  # как часто идущая сборка tex проверяет, не пришла ли правка новее
+    # Компиляция TeX (app/utils/compile_pool.py), на процесс
+    LATEX_MAX_CONCURRENCY: int = 0     # 0 — по числу CPU
+    LATEX_COMPILE_TIMEOUT_SEC: int = 240  # на один проход сборки документа
+    LATEX_CPU_LIMIT_SEC: int = 120     # RLIMIT_CPU на процесс TeX; 0 — без лимита
+    LATEX_MEM_LIMIT_MB: int = 1024     # RLIMIT_AS; 0 — без лимита
+    LATEX_SCRATCH_DIR: str = ""        # пусто — системный tmp
+    LATEX_PRECOMPILED_FORMAT: bool = True  # стандартная преамбула из дампа pdflatex -ini (app/utils/latex_format.py)
+    LATEX_FORMAT_DIR: str = ""             # пусто -> TEMP_DIR/latex-fmt
+    LATEX_VALIDATE: bool = True  # проверять формулы до сборки, битые выводить текстом (app/utils/latex_validate.py)
+    # Превью отдельных формул (app/utils/snippets.py, GET /projects/{pid}/blocks/{idx}/preview)
+    # Превью рисует API, а фоновый прогрев — воркер: прогрев полезен, только если кэш у них
+    # общий. Поэтому он включается, лишь когда SNIPPET_CACHE_DIR задан явно (один путь у API
+    # и воркеров; на разных узлах — общий том) или воркеры работают внутри API
+    SNIPPET_CACHE_DIR: str = ""      # пусто -> TEMP_DIR/cache/snippets, свой у каждого процесса/узла
+    SNIPPET_CACHE_MAX_MB: int = 256  # 0 — без кэша (и без фоновой отрисовки)
+    SNIPPET_DPI: int = 200
+    SNIPPET_TIMEOUT_SEC: int = 30
+    SNIPPET_PREWARM: bool = True     # рисовать превью в фоне сразу после распознавания/правки (см. выше)
+    INPROCESS_WORKERS: int = 0  # >0 — запускать воркеры ещё и внутри API (один узел, разработка)
+
+    # Сроки задач и этапов распознавания (0 — без срока)
+    JOB_DEADLINE_INFER_SEC: int = 900
+    JOB_DEADLINE_TEX_SEC: int = 300
+    JOB_CANCEL_POLL_SEC: float = 2.0   # как часто воркер проверяет, не удалили ли проект/задачу
+    PIPELINE_STAGE_DEADLINE_SEC: dict[str, float] = {"detect": 60, "formulas": 300, "text": 180, "compile": 240}
+
+    # Inference pool (процессы с загруженными моделями внутри воркера)
+    INFER_POOL_SIZE: int = 1      # 0 — считать в потоке самого воркера, без пула
+    INFER_TORCH_THREADS: int = 0  # 0 — по умолчанию torch
+    INFER_JOB_THREADS: int = 0    # страниц одновременно в процессе пула (>1 — кропы батчатся между ними);
+                                  # 0 — WORKER_CONCURRENCY поровну на INFER_POOL_SIZE процессов
+
+    # Перезапуск процессов пула (app/memwatch.py): дорабатывают текущие страницы и уходят
+    INFER_RECYCLE_JOBS: int = 500       # после стольких страниц; 0 — не считать
+    INFER_RECYCLE_RSS_MB: int = 6144    # или когда RSS процесса выше; 0 — не следить
+    INFER_RECYCLE_TIMEOUT_SEC: float = 60.0  # сколько ждать выхода старого процесса
+    RSS_SAMPLE_SEC: float = 0.5         # как часто мерить RSS для пика за задачу
+
+    # Micro-batching TrOCR/HTR (app/batcher.py)
+    BATCH_MAX_SIZE: int = 16      # 1 — без батчинга, каждый кроп отдельным вызовом
+    BATCH_MAX_WAIT_MS: float = 5.0
+
+    # Scheduler (app/scheduler.py)
+    SCHED_TEX_WEIGHT: float = 2.0      # tex-задачи на два уровня выше infer
+    SCHED_PREMIUM_WEIGHT: float = 1.0
+    SCHED_AGING_SEC: float = 60.0      # +1 уровень за каждые N секунд ожидания
+    SCHED_CANDIDATES: int = 100
+    SCHED_SERVED_WINDOW_SEC: int = 3600  # «давно не обслуживали» = не брали задач пользователя за это время
+
+    # Уровни качества (app/qos.py): по глубине очереди infer при взятии задачи
+    QOS_BALANCED_DEPTH: int = 20   # с такой очереди — balanced; 0 — никогда
+    QOS_FAST_DEPTH: int = 60       # с такой — fast; 0 — никогда
+    QOS_FORCE_TIER: Literal["", "full", "balanced", "fast"] = ""  # всегда этот уровень; опечатка — ошибка при старте
+
+    # Admission control (app/admission.py): сверх порога — 429 + Retry-After
+    ADMISSION_MAX_QUEUE: int = 200       # задач линии в очереди; 0 = без ограничения
+    ADMISSION_MAX_WAIT_SEC: int = 900    # оценка ожидания; 0 = без ограничения
+    ADMISSION_WORKER_SLOTS: int = 0      # слотов воркеров во всём кластере; 0 = WORKER_CONCURRENCY
+    ADMISSION_SAMPLE: int = 50           # по скольким последним задачам считать время обслуживания
+    ADMISSION_STATS_TTL_SEC: float = 10.0
+    ADMISSION_QUEUE_TTL_SEC: float = 3.0  # порядок очереди для позиций пересчитывается не чаще
+
+    # GET /projects/{pid}: ETag и long-poll ?wait=
+    PROJECT_WAIT_MAX_SEC: float = 30.0     # потолок для ?wait=
+    PROJECT_WAIT_POLL_SEC: float = 5.0     # перепроверка БД, если уведомление потерялось
+    PROJECT_ETAG_URL_TTL_SEC: int = 1800   # ETag меняется хотя бы так часто: ссылки в ответе живут час
+
+    # Workspaces (рабочие папки задач в TEMP_DIR/work)
+    WORKSPACE_QUOTA_MB: int = 10240         # 0 = без квоты
+    WORKSPACE_MIN_RESERVE_MB: int = 16
+    WORKSPACE_TMPFS_DIR: str = "/dev/shm/note2tex"  # пусто = не использовать tmpfs
+    WORKSPACE_TMPFS_MAX_MB: int = 32        # задачи с оценкой до стольких MB идут в tmpfs
+    WORKSPACE_ORPHAN_TTL_SEC: int = 6 * 3600
+    WORKSPACE_GC_INTERVAL_SEC: int = 300
+    INFER_WORKSPACE_HINT_MB: int = 64       # оценка объёма одной задачи распознавания
+
+    # Result cache (готовые tex/pdf/docx по хэшу картинки и параметров)
+    RESULT_CACHE_DIR: str = ""  # пусто -> TEMP_DIR/cache/results
+    RESULT_CACHE_MAX_MB: int = 2048
+
+    # Кэш собранных pdf/docx по хэшу TeX (app/tex_cache.py)
+    TEX_CACHE_DIR: str = ""  # пусто -> TEMP_DIR/cache/tex
+    TEX_CACHE_MAX_MB: int = 512   # 0 — без кэша
+
     DEBUG_PREMIUM_SECRET: str
 
     class Config:
@@ -0,0 +1,161 @@
+import json, os, shutil, time, uuid
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+from app import metrics
+
+META_NAME = "meta.json"
+RESCAN_SEC = 300.0  # папку делят несколько процессов: раз в столько сверяем индекс с диском
+
+
+class DiskLRU:
+    # content-addressed кэш артефактов на диске: одна папка на ключ,
+    # mtime meta.json = время последнего обращения (для LRU).
+    # Размеры записей держим в памяти и считаем на put, а не обходом дерева;
+    # записи, которые сейчас читают (pin), вытеснение пропускает
+
+    def __init__(self, root: str | Path, max_bytes: int, name: str):
+        self.root = Path(root)
+        self.max_bytes = int(max_bytes)
+        self.name = name
+        self._lock = threading.Lock()
+        self._index: Optional[dict[str, list]] = None  # key -> [atime, size, dir]
+        self._total = 0
+        self._scanned = 0.0
+        self._pins: dict[str, int] = {}
+
+    def _entry_dir(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def _load(self, key: str) -> Optional[dict]:
+        d = self._entry_dir(key)
+        meta_path = d / META_NAME
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        files = {}
+        for fname in meta.get("files", []):
+            p = d / fname
+            if not p.exists():
+                return None
+            files[fname] = str(p)
+        try:
+            os.utime(meta_path, None)
+        except OSError:
+            pass
+        return {"dir": str(d), "files": files, "meta": meta.get("data", {})}
+
+    def get(self, key: str) -> Optional[dict]:
+        hit = self._load(key)
+        metrics.inc(f"{self.name}.hit" if hit else f"{self.name}.miss")
+        if hit:
+            with self._lock:
+                if self._index is not None and key in self._index:
+                    self._index[key][0] = time.time()
+        return hit
+
+    def pin(self, key: str) -> None:
+        # пока запись закреплена, evict её не удалит (файлы из get ещё копируют/грузят)
+        with self._lock:
+            self._pins[key] = self._pins.get(key, 0) + 1
+
+    def unpin(self, key: str) -> None:
+        with self._lock:
+            n = self._pins.get(key, 0) - 1
+            if n > 0:
+                self._pins[key] = n
+            else:
+                self._pins.pop(key, None)
+
+    @contextmanager
+    def pinned(self, key: str):
+        # get(key), и запись не вытесняется, пока блок не закончится
+        self.pin(key)
+        try:
+            yield self.get(key)
+        finally:
+            self.unpin(key)
+
+    def put(self, key: str, files: dict[str, str | Path], data: Optional[dict] = None) -> Optional[dict]:
+        if self.max_bytes <= 0:
+            return None
+        dst = self._entry_dir(key)
+        tmp = self.root / "tmp" / f"{key}.{uuid.uuid4().hex}"
+        tmp.mkdir(parents=True, exist_ok=True)
+        added = 0
+        try:
+            names = []
+            for fname, src in files.items():
+                if src and Path(src).exists():
+                    shutil.copyfile(src, tmp / fname)
+                    names.append(fname)
+            (tmp / META_NAME).write_text(
+                json.dumps({"files": names, "data": data or {}, "created": time.time()}, ensure_ascii=False),
+                encoding="utf-8",
+            )
+            size = _dir_size(tmp)
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.replace(tmp, dst)
+                added = size
+            except OSError:
+                # запись с таким ключом уже есть (гонка двух воркеров) — оставляем её
+                shutil.rmtree(tmp, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        metrics.inc(f"{self.name}.store")
+        if added:
+            with self._lock:
+                if self._index is not None and key not in self._index:
+                    self._index[key] = [time.time(), added, dst]
+                    self._total += added
+        self.evict()
+        return self._load(key)
+
+    def _scan(self) -> None:
+        # полный обход: при первом обращении и раз в RESCAN_SEC (записи других процессов)
+        index: dict[str, list] = {}
+        if self.root.exists():
+            for shard in self.root.iterdir():
+                if not shard.is_dir() or shard.name == "tmp":
+                    continue
+                for d in shard.iterdir():
+                    try:
+                        atime = (d / META_NAME).stat().st_mtime
+                    except OSError:
+                        atime = 0.0
+                    index[d.name] = [atime, _dir_size(d), d]
+        self._index = index
+        self._total = sum(e[1] for e in index.values())
+        self._scanned = time.monotonic()
+
+    def evict(self) -> int:
+        with self._lock:
+            if self._index is None or time.monotonic() - self._scanned > RESCAN_SEC:
+                self._scan()
+            removed = 0
+            if self._total > self.max_bytes:
+                for key, (atime, size, d) in sorted(self._index.items(), key=lambda e: e[1][0]):
+                    if self._total <= self.max_bytes:
+                        break
+                    if key in self._pins:
+                        continue
+                    shutil.rmtree(d, ignore_errors=True)
+                    del self._index[key]
+                    self._total -= size
+                    removed += 1
+            metrics.set_gauge(f"{self.name}.bytes", self._total)
+            if removed:
+                metrics.inc(f"{self.name}.evicted", removed)
+            return removed
+
+
+def _dir_size(d: Path) -> int:
+    try:
+        return sum(f.stat().st_size for f in d.iterdir() if f.is_file())
+    except OSError:
+        return 0
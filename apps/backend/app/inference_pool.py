@@ -0,0 +1,364 @@
+import asyncio, importlib, itertools, os, threading, traceback
+import multiprocessing as mp
+import queue as queue_mod
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from typing import Optional
+
+from app import metrics
+from app.memwatch import PeakTracker, recycle_reason, rss_mb
+from app.cancellation import CancelToken, Cancelled, DeadlineExceeded
+from app.config import settings
+
+# Пул долгоживущих процессов для распознавания. Каждый процесс один раз
+# грузит модели (app.pipeline.get_models) и дальше только принимает задачи.
+# Страница передаётся декодированным массивом через shared memory: в
+# очередь уходят только имя сегмента, форма и параметры.
+#
+#   parent: inbox[i].put(run) ──> child i: main loop ──> job thread(s)
+#   parent: reader thread <── outbox.get() <──────────── result/error
+#
+# Отмена: родитель сразу отпускает ожидающего (Cancelled) и шлёт ребёнку
+# {"type": "cancel"}; тот отменяет CancelToken задачи, и пайплайн бросает
+# работу на ближайшей проверке (между этапами/кропами, убивая pdflatex).
+#
+# Перезапуск: каждый ответ ребёнка несёт его RSS и пик за задачу. После
+# recycle_jobs страниц или при RSS выше recycle_rss_mb слот «сливается»:
+# новые страницы копятся в backlog слота, идущие дорабатывают, затем
+# процесс получает None, выходит, а на его место поднимается новый.
+
+
+def _resolve_fn(spec: str):
+    mod, _, name = spec.partition(":")
+    return getattr(importlib.import_module(mod), name)
+
+
+def _child_main(slot: int, inbox, outbox, torch_threads: int, job_threads: int,
+                runner: str, warm: Optional[tuple[str, dict]]):
+    import numpy as np
+    if torch_threads > 0:
+        os.environ["OMP_NUM_THREADS"] = str(torch_threads)
+        import torch
+        torch.set_num_threads(torch_threads)
+    run_fn = _resolve_fn(runner)
+
+    if warm:
+        try:
+            _resolve_fn(warm[0])(**warm[1])
+        except Exception as e:
+            print(f"[pool:{slot}] warmup failed: {e}")
+
+    tokens: dict[int, CancelToken] = {}
+    tracker = PeakTracker(settings.RSS_SAMPLE_SEC)
+
+    def run(msg):
+        shm = None
+        tracker.begin(msg["task"])
+        try:
+            shm = shared_memory.SharedMemory(name=msg["shm"])
+            page = np.ndarray(msg["shape"], dtype=np.dtype(msg["dtype"]), buffer=shm.buf)
+            kwargs = dict(msg["params"])
+            if msg.get("cancellable"):
+                kwargs["cancel"] = tokens[msg["task"]]
+            out = {"ok": True, "result": run_fn(image=page, **kwargs)}
+        except BaseException as e:
+            out = {"ok": False, "exc": type(e).__name__,
+                   "error": f"{type(e).__name__}: {e}", "trace": traceback.format_exc()}
+        finally:
+            tokens.pop(msg["task"], None)
+            page = None
+            if shm is not None:
+                try:
+                    shm.close()
+                except BufferError:
+                    pass  # на буфер ещё ссылается traceback; сегмент всё равно удалит родитель
+        outbox.put(dict(out, task=msg["task"], slot=slot, rss_mb=rss_mb(), peak_mb=tracker.end(msg["task"])))
+
+    pool = ThreadPoolExecutor(max_workers=max(1, job_threads), thread_name_prefix=f"infer{slot}")
+    outbox.put({"ready": slot, "pid": os.getpid()})
+    while True:
+        msg = inbox.get()
+        if msg is None:
+            break
+        if msg.get("type") == "run":
+            if msg.get("cancellable"):
+                tokens[msg["task"]] = CancelToken(msg.get("timeout"))
+            pool.submit(run, msg)
+        elif msg.get("type") == "cancel":
+            tok = tokens.get(msg["task"])
+            if tok is not None:
+                tok.cancel(msg.get("reason") or "cancelled")
+    pool.shutdown(wait=True)
+
+
+_CANCEL_EXC = {"Cancelled": Cancelled, "DeadlineExceeded": DeadlineExceeded}
+
+
+class _Slot:
+    def __init__(self, idx: int):
+        self.idx = idx
+        self.proc: Optional[mp.Process] = None
+        self.inbox = None
+        self.in_flight: set[int] = set()
+        self.jobs = 0
+        self.draining = False   # ждём, пока доработают идущие страницы
+        self.retiring = False   # старому процессу отправлен None, ждём выхода
+        self.backlog: list[dict] = []  # страницы для процесса, который придёт на смену
+
+    def sent(self) -> set[int]:
+        return self.in_flight - {m["task"] for m in self.backlog}
+
+
+class InferencePool:
+    def __init__(self, size: int, torch_threads: int = 0, job_threads: int = 1,
+                 runner: str = "app.pipeline:run_full_pipeline", warm: Optional[tuple[str, dict]] = None,
+                 recycle_jobs: int = 0, recycle_rss_mb: float = 0):
+        self.size = max(1, int(size))
+        self.recycle_jobs = int(recycle_jobs)
+        self.recycle_rss_mb = float(recycle_rss_mb)
+        self.torch_threads = int(torch_threads)
+        self.job_threads = max(1, int(job_threads))
+        self.runner = runner
+        self.warm = warm
+        self._ctx = mp.get_context("spawn")  # fork + torch/cuda = беда
+        self._outbox = None
+        self._slots: list[_Slot] = []
+        self._pending: dict[int, tuple[asyncio.AbstractEventLoop, asyncio.Future, shared_memory.SharedMemory]] = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._reader: Optional[threading.Thread] = None
+        self._stopping = False
+
+    def start(self):
+        self._outbox = self._ctx.Queue()
+        self._slots = [_Slot(i) for i in range(self.size)]
+        for s in self._slots:
+            self._spawn(s)
+        self._reader = threading.Thread(target=self._read_results, name="infer-pool-reader", daemon=True)
+        self._reader.start()
+        return self
+
+    def _spawn(self, s: _Slot):
+        s.jobs = 0
+        s.inbox = self._ctx.Queue()
+        s.proc = self._ctx.Process(
+            target=_child_main,
+            args=(s.idx, s.inbox, self._outbox, self.torch_threads, self.job_threads, self.runner, self.warm),
+            name=f"infer-pool-{s.idx}", daemon=True,
+        )
+        s.proc.start()
+        metrics.inc("infer_pool.spawned")
+
+    def _pick(self) -> _Slot:
+        # сливающиеся слоты — только если других нет (страница подождёт смены процесса)
+        live = [s for s in self._slots if not s.draining] or self._slots
+        return min(live, key=lambda s: len(s.in_flight))
+
+    async def run(self, page, params: dict, cancel: Optional[CancelToken] = None) -> dict:
+        import numpy as np
+        if cancel is not None:
+            cancel.raise_if_cancelled()
+        page = np.ascontiguousarray(page)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, page.nbytes))
+        task = next(self._ids)
+        detach = lambda: None
+        try:
+            np.ndarray(page.shape, dtype=page.dtype, buffer=shm.buf)[...] = page
+            loop = asyncio.get_running_loop()
+            fut = loop.create_future()
+            msg = {"type": "run", "task": task, "shm": shm.name,
+                   "shape": list(page.shape), "dtype": page.dtype.str, "params": params}
+            if cancel is not None:
+                msg.update(cancellable=True, timeout=cancel.remaining())
+            with self._lock:
+                slot = self._pick()
+                slot.in_flight.add(task)
+                self._pending[task] = (loop, fut, shm)
+                inbox = None if slot.draining else slot.inbox
+                if inbox is None:
+                    slot.backlog.append(msg)
+            metrics.set_gauge("infer_pool.in_flight", len(self._pending))
+            if cancel is not None:
+                detach = cancel.on_cancel(lambda: self._abort(task, slot, cancel))
+            if inbox is not None:
+                inbox.put(msg)
+            try:
+                return await fut
+            except asyncio.CancelledError:
+                # отменили корутину (остановка воркера) — ребёнку тоже незачем считать
+                self._abort(task, slot, None)
+                raise
+        finally:
+            detach()
+            with self._lock:
+                self._pending.pop(task, None)
+            shm.close()
+            shm.unlink()
+
+    def _abort(self, task: int, slot: _Slot, cancel: Optional[CancelToken]):
+        # слот остаётся занятым (in_flight), пока ребёнок не ответит; ждущего отпускаем сразу
+        with self._lock:
+            queued = [m for m in slot.backlog if m["task"] == task]
+            if queued:
+                # до ребёнка не дошла — просто снимаем
+                slot.backlog.remove(queued[0])
+                slot.in_flight.discard(task)
+        if not queued:
+            try:
+                slot.inbox.put({"type": "cancel", "task": task, "reason": cancel.reason if cancel else "cancelled"})
+            except Exception:
+                pass
+        metrics.inc("infer_pool.cancelled")
+        if cancel is not None:
+            self._resolve(task, False, cancel.exception(), keep_slot=True)
+
+    def _resolve(self, task: int, ok: bool, value, keep_slot: bool = False):
+        with self._lock:
+            entry = self._pending.get(task)
+            if not keep_slot:
+                for s in self._slots:
+                    s.in_flight.discard(task)
+        if entry is None:
+            return
+        loop, fut, _ = entry
+
+        def _set():
+            if fut.done():
+                return
+            if ok:
+                fut.set_result(value)
+            else:
+                fut.set_exception(value if isinstance(value, BaseException) else RuntimeError(value))
+        loop.call_soon_threadsafe(_set)
+
+    def _read_results(self):
+        while not self._stopping:
+            try:
+                msg = self._outbox.get(timeout=1.0)
+            except queue_mod.Empty:
+                self._check_alive()
+                continue
+            except (EOFError, OSError):
+                break
+            if "ready" in msg:
+                print(f"[pool] worker {msg['ready']} ready (pid {msg['pid']})")
+                continue
+            if not msg["ok"] and msg.get("exc") not in _CANCEL_EXC:
+                print(f"[pool] task {msg['task']} failed in worker {msg['slot']}:\n{msg.get('trace', '')}")
+            if msg["ok"]:
+                value = msg["result"]
+            elif msg.get("exc") in _CANCEL_EXC:
+                value = _CANCEL_EXC[msg["exc"]](msg["error"])
+            else:
+                value = msg["error"]
+            # решение о перезапуске — до того, как ждущий проснётся и пришлёт следующую страницу
+            slot = self._slots[msg["slot"]]
+            self._account(slot, msg)
+            self._resolve(msg["task"], msg["ok"], value)
+            metrics.set_gauge("infer_pool.in_flight", len(self._pending))
+            self._maybe_retire(slot)
+
+    def _account(self, s: _Slot, msg: dict):
+        s.jobs += 1
+        metrics.set_gauge(f"infer_pool.rss_mb.{s.idx}", msg.get("rss_mb", 0.0))
+        metrics.observe("infer_pool.job_peak_rss_mb", msg.get("peak_mb", 0.0))
+        reason = recycle_reason(s.jobs, msg.get("rss_mb", 0.0), self.recycle_jobs, self.recycle_rss_mb)
+        with self._lock:
+            if reason and not s.draining:
+                s.draining = True
+                print(f"[pool] worker {s.idx} will be recycled: {reason}")
+                metrics.inc("infer_pool.recycled")
+
+    def _maybe_retire(self, s: _Slot):
+        with self._lock:
+            if not s.draining or s.retiring or s.sent() or self._stopping:
+                return
+            s.retiring = True
+            old = s.proc
+            s.inbox.put(None)  # ребёнок доделает своё и выйдет
+        threading.Thread(target=self._replace, args=(s, old), name=f"infer-pool-recycle-{s.idx}", daemon=True).start()
+
+    def _replace(self, s: _Slot, old: Optional[mp.Process]):
+        if old is not None:
+            old.join(settings.INFER_RECYCLE_TIMEOUT_SEC)
+            if old.is_alive():
+                old.terminate()
+                old.join(5.0)
+        if self._stopping:
+            return
+        self._spawn(s)
+        self._flush(s)
+
+    def _flush(self, s: _Slot):
+        with self._lock:
+            backlog, s.backlog = s.backlog, []
+            s.draining = s.retiring = False
+            for m in backlog:
+                s.inbox.put(m)
+
+    def _check_alive(self):
+        for s in self._slots:
+            if self._stopping or s.retiring or s.proc is None or s.proc.is_alive():
+                continue
+            print(f"[pool] worker {s.idx} died (exit {s.proc.exitcode}), restarting")
+            metrics.inc("infer_pool.crashed")
+            with self._lock:
+                lost = list(s.sent())
+            for task in lost:
+                self._resolve(task, False, f"inference worker died (exit {s.proc.exitcode})")
+            self._spawn(s)
+            self._flush(s)
+
+    def shutdown(self, timeout: float = 10.0):
+        self._stopping = True
+        for s in self._slots:
+            try:
+                s.inbox.put(None)
+            except Exception:
+                pass
+        for s in self._slots:
+            if s.proc is None:
+                continue
+            s.proc.join(timeout)
+            if s.proc.is_alive():
+                s.proc.terminate()
+        with self._lock:
+            tasks = list(self._pending)
+        for task in tasks:
+            self._resolve(task, False, "inference pool is shutting down")
+
+
+_pool: Optional[InferencePool] = None
+
+
+def job_threads() -> int:
+    # по умолчанию процесс пула берёт столько страниц, сколько воркер может
+    # ему отдать: иначе вторая страница ждёт, и батчей между страницами нет
+    if settings.INFER_JOB_THREADS > 0:
+        return settings.INFER_JOB_THREADS
+    return max(1, -(-settings.WORKER_CONCURRENCY // max(1, settings.INFER_POOL_SIZE)))
+
+
+def get_pool() -> InferencePool:
+    global _pool
+    if _pool is None:
+        _pool = InferencePool(
+            size=settings.INFER_POOL_SIZE,
+            torch_threads=settings.INFER_TORCH_THREADS,
+            job_threads=job_threads(),
+            recycle_jobs=settings.INFER_RECYCLE_JOBS,
+            recycle_rss_mb=settings.INFER_RECYCLE_RSS_MB,
+            warm=("app.pipeline:get_models", dict(
+                detector_weights=settings.DETECTOR_WEIGHTS,
+                trocr_dir=settings.TROCR_DIR,
+                htr_weights=settings.HTR_WEIGHTS,
+            )),
+        ).start()
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
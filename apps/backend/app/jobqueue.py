@@ -0,0 +1,277 @@
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import metrics, notify, scheduler
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import Job, JobStatus, Project, ProjectStatus
+from app.quotas import is_premium
+
+# Очередь задач в таблице jobs. API только кладёт задачи, воркеры
+# (python -m app.worker, сколько угодно процессов/узлов) забирают их
+# через SELECT ... FOR UPDATE SKIP LOCKED и держат аренду хартбитами.
+# Задачу с истёкшей арендой (воркер умер) возвращаем в очередь, пока не
+# кончились попытки.
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+async def enqueue(session: AsyncSession, kind: str, project_id, payload: Optional[dict] = None, user=None,
+                  coalesce: bool = False) -> Job:
+    if coalesce:
+        await supersede_queued(session, kind, project_id)
+    job = Job(
+        kind=kind, project_id=project_id, payload=payload or {},
+        user_id=getattr(user, "id", None), priority=1 if user is not None and is_premium(user) else 0,
+        status=JobStatus.queued, attempts=0, max_attempts=settings.JOB_MAX_ATTEMPTS,
+        created_at=_now(),
+    )
+    session.add(job)
+    await session.flush()
+    metrics.inc(f"jobs.enqueued.{kind}")
+    return job
+
+
+async def _submit(kind: str, project_id, payload: dict, session: Optional[AsyncSession], user,
+                  coalesce: bool = False) -> None:
+    if session is not None:
+        # в транзакции вызывающего: задача появится вместе с его commit
+        await enqueue(session, kind, project_id, payload, user, coalesce)
+        return
+    async with AsyncSessionLocal() as s:
+        await enqueue(s, kind, project_id, payload, user, coalesce)
+        await s.commit()
+
+
+async def submit_infer_job(project_id, session: Optional[AsyncSession] = None, user=None):
+    await _submit("infer", project_id, {}, session, user)
+
+
+async def submit_texjob(project_id, tex_content: str, session: Optional[AsyncSession] = None, user=None,
+                        revision: Optional[int] = None, prepared: bool = False, blocks: Optional[list] = None):
+    # собирать имеет смысл только последнюю правку: ждущие сборки старых ревизий снимаем
+    # prepared — tex уже в нашем формате (правка блока), _wrap_tex_if_needed не нужен
+    # blocks — Project.blocks этой правки: воркер запишет их вместе с новым tex_key
+    payload = {"tex": tex_content}
+    if revision is not None:
+        payload["rev"] = revision
+    if prepared:
+        payload["prepared"] = True
+    if blocks is not None:
+        payload["blocks"] = blocks
+    await _submit("tex", project_id, payload, session, user, coalesce=True)
+
+
+async def has_pending(session: AsyncSession, kind: str, project_id) -> bool:
+    # задача этого вида ждёт в очереди или уже выполняется
+    q = select(Job.id).where(
+        Job.project_id == project_id, Job.kind == kind, Job.status.in_((JobStatus.queued, JobStatus.running))
+    ).limit(1)
+    return (await session.execute(q)).first() is not None
+
+
+async def supersede_queued(session: AsyncSession, kind: str, project_id) -> int:
+    res = await session.execute(
+        update(Job)
+        .where(Job.project_id == project_id, Job.kind == kind, Job.status == JobStatus.queued)
+        .values(status=JobStatus.cancelled, error="superseded", finished_at=_now())
+    )
+    if res.rowcount:
+        metrics.inc(f"jobs.coalesced.{kind}", res.rowcount)
+    return res.rowcount
+
+
+async def _candidates(session: AsyncSession, kinds: Optional[list[str]]) -> list[Job]:
+    # голова очереди каждого (линия, пользователь)
+    rn = func.row_number().over(partition_by=(Job.kind, Job.user_id), order_by=Job.created_at).label("rn")
+    inner = select(Job.id, rn).where(Job.status == JobStatus.queued)
+    if kinds:
+        inner = inner.where(Job.kind.in_(kinds))
+    inner = inner.subquery()
+    q = (
+        select(Job).join(inner, inner.c.id == Job.id).where(inner.c.rn == 1)
+        .order_by(Job.created_at).limit(settings.SCHED_CANDIDATES)
+    )
+    return list((await session.execute(q)).scalars().all())
+
+
+async def _last_served(session: AsyncSession, user_ids: set) -> dict:
+    user_ids = {u for u in user_ids if u is not None}
+    if not user_ids:
+        return {}
+    # только недавняя история (индекс user_id, started_at): кого не брали дольше окна,
+    # тот для планировщика «не обслуживался» — как и новый пользователь
+    since = _now() - timedelta(seconds=settings.SCHED_SERVED_WINDOW_SEC)
+    res = await session.execute(
+        select(Job.user_id, func.max(Job.started_at))
+        .where(Job.user_id.in_(user_ids), Job.started_at >= since)
+        .group_by(Job.user_id)
+    )
+    return {uid: ts for uid, ts in res.all() if ts is not None}
+
+
+async def lease(session: AsyncSession, worker_id: str, kinds: Optional[list[str]] = None) -> Optional[Job]:
+    candidates = await _candidates(session, kinds)
+    if not candidates:
+        await session.rollback()
+        return None
+    now = _now()
+    served = await _last_served(session, {c.user_id for c in candidates})
+    job = None
+    for cand in scheduler.order(candidates, now, served):
+        # кандидатов читали без блокировки: забираем первого, кого не увёл другой воркер
+        job = (await session.execute(
+            select(Job).where(Job.id == cand.id, Job.status == JobStatus.queued)
+            .with_for_update(skip_locked=True)
+            .execution_options(populate_existing=True)
+        )).scalar_one_or_none()
+        if job is not None:
+            break
+    if job is None:
+        await session.rollback()
+        return None
+    job.status = JobStatus.running
+    job.attempts += 1
+    job.worker_id = worker_id
+    job.started_at = now
+    job.heartbeat_at = now
+    job.lease_until = now + timedelta(seconds=settings.JOB_LEASE_SEC)
+    await session.commit()
+    metrics.inc(f"jobs.leased.{job.kind}")
+    metrics.observe(f"queue.wait_sec.{job.kind}", (now - scheduler._aware(job.created_at)).total_seconds())
+    return job
+
+
+async def publish_depths(session: AsyncSession) -> dict:
+    res = await session.execute(
+        select(Job.kind, func.count()).where(Job.status == JobStatus.queued).group_by(Job.kind)
+    )
+    depths = {lane: 0 for lane in scheduler.LANES}
+    depths.update({kind: int(n) for kind, n in res.all()})
+    for lane, n in depths.items():
+        metrics.set_gauge(f"queue.depth.{lane}", n)
+    return depths
+
+
+async def heartbeat(session: AsyncSession, job_id, worker_id: str) -> bool:
+    # False — задача больше не наша (аренда истекла и её забрали, или отменили)
+    now = _now()
+    res = await session.execute(
+        update(Job)
+        .where(Job.id == job_id, Job.worker_id == worker_id, Job.status == JobStatus.running)
+        .values(heartbeat_at=now, lease_until=now + timedelta(seconds=settings.JOB_LEASE_SEC))
+    )
+    await session.commit()
+    return res.rowcount == 1
+
+
+async def complete(session: AsyncSession, job_id, worker_id: str) -> None:
+    await session.execute(
+        update(Job)
+        .where(Job.id == job_id, Job.worker_id == worker_id, Job.status == JobStatus.running)
+        .values(status=JobStatus.done, finished_at=_now(), lease_until=None)
+    )
+    await session.commit()
+
+
+async def cancel(session: AsyncSession, job_id, worker_id: str, reason: str) -> None:
+    # задачу остановили намеренно (например, пришла новая ревизия): без повторов
+    res = await session.execute(
+        update(Job)
+        .where(Job.id == job_id, Job.worker_id == worker_id, Job.status == JobStatus.running)
+        .values(status=JobStatus.cancelled, error=reason, finished_at=_now(), lease_until=None)
+        .returning(Job.kind)
+    )
+    kind = res.scalar_one_or_none()
+    await session.commit()
+    if kind:
+        metrics.inc(f"jobs.cancelled.{kind}")
+
+
+async def fail(session: AsyncSession, job_id, worker_id: str, error: str, retry: bool = True) -> bool:
+    # True — задача вернулась в очередь на повтор; retry=False — провал окончательный
+    # (вышел срок: повтор упрётся в тот же срок)
+    job = (await session.execute(
+        select(Job).where(Job.id == job_id, Job.worker_id == worker_id, Job.status == JobStatus.running)
+    )).scalar_one_or_none()
+    if job is None:
+        await session.rollback()
+        return False
+    retry = retry and job.attempts < job.max_attempts
+    job.error = (error or "")[-4000:]
+    job.lease_until = None
+    if retry:
+        job.status = JobStatus.queued
+        job.worker_id = None
+    else:
+        job.status = JobStatus.failed
+        job.finished_at = _now()
+        await _fail_project(session, job.project_id)
+    await session.commit()
+    metrics.inc(f"jobs.{'retried' if retry else 'failed'}.{job.kind}")
+    return retry
+
+
+async def requeue_expired(session: AsyncSession) -> tuple[int, int]:
+    q = (
+        select(Job)
+        .where(Job.status == JobStatus.running, Job.lease_until < _now())
+        .with_for_update(skip_locked=True)
+    )
+    requeued = failed = 0
+    for job in (await session.execute(q)).scalars().all():
+        job.worker_id = None
+        job.lease_until = None
+        if job.attempts < job.max_attempts:
+            job.status = JobStatus.queued
+            requeued += 1
+        else:
+            job.status = JobStatus.failed
+            job.error = "lease expired"
+            job.finished_at = _now()
+            await _fail_project(session, job.project_id)
+            failed += 1
+    await session.commit()
+    if requeued:
+        metrics.inc("jobs.lease_expired", requeued)
+    return requeued, failed
+
+
+_FINISHED = (JobStatus.done, JobStatus.failed, JobStatus.cancelled)
+
+
+async def prune_finished(session: AsyncSession, batch: int = 1000) -> int:
+    # удаляет завершённые задачи старше JOB_RETENTION_DAYS пачками (индекс status, created_at);
+    # история нужна только недавняя: время обслуживания (admission), последнее обслуживание
+    if settings.JOB_RETENTION_DAYS <= 0:
+        return 0
+    cutoff = _now() - timedelta(days=settings.JOB_RETENTION_DAYS)
+    removed = 0
+    while True:
+        ids = select(Job.id).where(
+            Job.status.in_(_FINISHED), Job.created_at < cutoff,
+            or_(Job.finished_at.is_(None), Job.finished_at < cutoff),
+        ).limit(batch)
+        n = (await session.execute(delete(Job).where(Job.id.in_(ids)).execution_options(synchronize_session=False))).rowcount
+        await session.commit()
+        removed += n
+        if n < batch:
+            break
+    if removed:
+        metrics.inc("jobs.pruned", removed)
+    return removed
+
+
+async def _fail_project(session: AsyncSession, project_id) -> None:
+    res = await session.execute(
+        update(Project)
+        .where(Project.id == project_id, Project.status == ProjectStatus.processing)
+        .values(status=ProjectStatus.failed)
+    )
+    if res.rowcount:
+        await notify.publish(session, project_id)
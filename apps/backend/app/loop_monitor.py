@@ -0,0 +1,50 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from app import metrics
+from app.config import settings
+
+# Задержка event loop: таймер на interval секунд должен сработать вовремя;
+# опоздание — время, на которое кто-то занял loop синхронным кодом
+# (subprocess, upload, тяжёлый numpy). Всё, что дольше LOOP_LAG_WARN_MS,
+# пишем в лог: это регрессия, такой код надо уводить в поток/подпроцесс.
+
+
+class LagProbe:
+    def __init__(self, interval_sec: float = 0.01):
+        self.interval = interval_sec
+        self.max_lag = 0.0
+        self.samples = 0
+
+    async def run(self, name: str = "loop", warn_ms: float | None = None):
+        warn_ms = settings.LOOP_LAG_WARN_MS if warn_ms is None else warn_ms
+        loop = asyncio.get_running_loop()
+        while True:
+            t0 = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - t0 - self.interval)
+            self.max_lag = max(self.max_lag, lag)
+            self.samples += 1
+            metrics.observe(f"{name}.lag_ms", lag * 1000.0)
+            if warn_ms and lag * 1000.0 > warn_ms:
+                print(f"[{name}] event loop blocked for {lag * 1000.0:.0f} ms")
+
+
+async def monitor_loop_lag(name: str = "loop", interval_sec: float = 0.5):
+    await LagProbe(interval_sec).run(name)
+
+
+@asynccontextmanager
+async def measure_lag(interval_sec: float = 0.005):
+    # для тестов: максимальная задержка loop, пока выполняется тело блока
+    probe = LagProbe(interval_sec)
+    task = asyncio.create_task(probe.run("test", warn_ms=0))
+    await asyncio.sleep(0)
+    try:
+        yield probe
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
@@ -7,10 +7,13 @@ from fastapi.middleware.cors import CORSMiddleware
 from starlette.responses import FileResponse
 
 from app.config import settings
+from app import metrics
 from app.routers import api
 from app.routers import premium as premium_router
 from app.routers import account as account_router
-from app.worker import worker
+from app.workspace import workspaces
+from app.loop_monitor import monitor_loop_lag
+from app.notify import listen_loop
 
 app = FastAPI(title=settings.APP_NAME, version=settings.APP_VERSION)
 
@@ -24,7 +27,14 @@ app.add_middleware(
 
 @app.on_event("startup")
 async def _startup():
-    app.state.worker_tasks = [asyncio.create_task(worker()) for _ in range(2)]
+    # API только кладёт задачи в очередь; обрабатывают их отдельные процессы python -m app.worker
+    app.state.worker_tasks = []
+    if settings.INPROCESS_WORKERS > 0:
+        from app.worker import run_workers
+        app.state.worker_tasks.append(asyncio.create_task(run_workers(settings.INPROCESS_WORKERS, with_gc=False)))
+    app.state.worker_tasks.append(asyncio.create_task(workspaces.gc_loop(settings.WORKSPACE_GC_INTERVAL_SEC)))
+    app.state.worker_tasks.append(asyncio.create_task(monitor_loop_lag("api")))
+    app.state.worker_tasks.append(asyncio.create_task(listen_loop()))
 
 @app.on_event("shutdown")
 async def _shutdown():
@@ -34,8 +44,11 @@ async def _shutdown():
     for t in tasks:
         try:
             await t
-        except Exception:
+        except BaseException:
             pass
+    if settings.INPROCESS_WORKERS > 0:
+        from app.inference_pool import shutdown_pool
+        shutdown_pool()
 
 @app.get("/v1/health")
 async def health():
@@ -47,6 +60,10 @@ async def health():
         "detector_weights": settings.DETECTOR_WEIGHTS,
     }
 
+@app.get("/v1/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
 FILES_ROOT = Path(settings.FILES_DIR)
 FILES_ROOT.mkdir(parents=True, exist_ok=True)
 
@@ -0,0 +1,65 @@
+import os, threading
+from typing import Hashable, Optional
+
+# Память процессов с моделями. torch + generate на кропах разного размера
+# фрагментируют аллокатор: RSS растёт от задачи к задаче и не отдаётся.
+# Следим за RSS (текущий и пик за задачу) и решаем, когда процесс пора
+# перезапустить: после N задач или при превышении порога.
+
+_PAGE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # не Linux: только пик за жизнь процесса (macOS — в байтах, остальные — в KB)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if os.uname().sysname == "Darwin" else peak / 1024
+    except Exception:
+        return 0.0
+
+
+class PeakTracker:
+    # пик RSS процесса за время каждой задачи: фоновый поток раз в interval
+    # обновляет максимум у всех идущих задач (параллельные задачи делят пик)
+    def __init__(self, interval_sec: float = 0.5):
+        self.interval = interval_sec
+        self._peaks: dict[Hashable, float] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def begin(self, key: Hashable) -> None:
+        now = rss_mb()
+        with self._lock:
+            self._peaks[key] = now
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="rss-sampler", daemon=True)
+                self._thread.start()
+
+    def end(self, key: Hashable) -> float:
+        now = rss_mb()
+        with self._lock:
+            return max(self._peaks.pop(key, now), now)
+
+    def _loop(self):
+        ev = threading.Event()
+        while not ev.wait(self.interval):
+            now = rss_mb()
+            with self._lock:
+                for k, v in self._peaks.items():
+                    if now > v:
+                        self._peaks[k] = now
+
+
+def recycle_reason(jobs: int, rss: float, max_jobs: int, max_rss_mb: float) -> Optional[str]:
+    # None — процесс ещё работает; 0 в лимите — лимит выключен
+    if max_jobs > 0 and jobs >= max_jobs:
+        return f"{jobs} jobs served"
+    if max_rss_mb > 0 and rss >= max_rss_mb:
+        return f"rss {rss:.0f} MB >= {max_rss_mb:.0f} MB"
+    return None
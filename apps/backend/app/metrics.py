@@ -0,0 +1,48 @@
+import threading
+from collections import defaultdict
+
+# простые in-process метрики; каждый процесс (API, воркер) отдаёт свои
+
+_lock = threading.Lock()
+_counters: dict[str, float] = defaultdict(float)
+_gauges: dict[str, float] = {}
+_summaries: dict[str, dict] = {}
+
+
+def inc(name: str, value: float = 1.0) -> None:
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name: str, value: float) -> None:
+    with _lock:
+        _gauges[name] = float(value)
+
+
+def add_gauge(name: str, delta: float) -> None:
+    with _lock:
+        _gauges[name] = _gauges.get(name, 0.0) + float(delta)
+
+
+def observe(name: str, value: float) -> None:
+    with _lock:
+        s = _summaries.get(name)
+        if s is None:
+            s = _summaries[name] = {"count": 0, "sum": 0.0, "max": 0.0, "last": 0.0}
+        s["count"] += 1
+        s["sum"] += value
+        s["max"] = max(s["max"], value)
+        s["last"] = value
+
+
+def snapshot() -> dict:
+    with _lock:
+        summaries = {}
+        for k, s in _summaries.items():
+            summaries[k] = dict(s, avg=(s["sum"] / s["count"]) if s["count"] else 0.0)
+        return {"counters": dict(_counters), "gauges": dict(_gauges), "summaries": summaries}
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear(); _gauges.clear(); _summaries.clear()
@@ -1,6 +1,6 @@
 import uuid, enum
 from datetime import datetime, timezone
-from sqlalchemy import String, Boolean, Enum, ForeignKey, Integer, DateTime, Text, UniqueConstraint
+from sqlalchemy import String, Boolean, Enum, ForeignKey, Integer, DateTime, Text, UniqueConstraint, JSON, Index
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from app.database import Base
@@ -17,6 +17,14 @@ class ProjectStatus(str, enum.Enum):
     failed = "failed"
 
 
+class JobStatus(str, enum.Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+    cancelled = "cancelled"
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -98,6 +106,16 @@ class Project(Base):
     pdf_key:   Mapped[str | None] = mapped_column(String(512))
     docx_key:  Mapped[str | None] = mapped_column(String(512))
 
+    # растёт с каждой правкой tex: сборка старой ревизии не перезаписывает результат новой
+    tex_revision: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+    # уровень качества последнего распознавания (app/qos.py)
+    quality_tier: Mapped[str | None] = mapped_column(String(16), nullable=True)
+
+    # блоки последнего распознавания [{idx, kind, bbox, content}]: правка одного
+    # блока пересобирает только его строку tex (PATCH /projects/{pid}/blocks/{idx})
+    blocks: Mapped[list | None] = mapped_column(JSON, nullable=True)
+
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True),
         default=lambda: datetime.now(timezone.utc),
@@ -146,3 +164,38 @@ class ProjectRating(Base):
     __table_args__ = (
         UniqueConstraint("user_id", "project_id", name="uq_rating_user_project"),
     )
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    kind: Mapped[str] = mapped_column(String(16), nullable=False)  # "infer" | "tex"
+    project_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), ForeignKey("projects.id", ondelete="CASCADE"), index=True)
+    payload: Mapped[dict] = mapped_column(JSON, nullable=False, default=dict)
+    # для планировщика: чья задача и её приоритет (1 — премиум)
+    user_id: Mapped[uuid.UUID | None] = mapped_column(UUID(as_uuid=True), nullable=True, index=True)
+    priority: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+    status: Mapped[JobStatus] = mapped_column(Enum(JobStatus, name="job_status"), nullable=False, default=JobStatus.queued)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    max_attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=3)
+    error: Mapped[str | None] = mapped_column(Text, nullable=True)
+
+    # аренда: воркер держит задачу, пока продлевает lease_until хартбитами
+    worker_id: Mapped[str | None] = mapped_column(String(128), nullable=True)
+    lease_until: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    heartbeat_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(timezone.utc),
+        nullable=False,
+    )
+    started_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index("ix_jobs_status_created", "status", "created_at"),
+        Index("ix_jobs_user_started", "user_id", "started_at"),  # последнее обслуживание (jobqueue._last_served)
+    )
@@ -0,0 +1,115 @@
+import asyncio
+from typing import Optional
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.config import settings
+
+# Уведомления «проект изменился» для long-poll GET /projects/{pid}?wait=.
+#
+# Кто меняет проект, вызывает publish(session, pid) перед commit:
+#   - в Postgres это pg_notify в той же транзакции — доставится слушателям
+#     только после commit (воркеры в отдельных процессах/на других узлах);
+#   - в своём процессе ждущие будятся сразу после commit (after_commit).
+# API слушает канал (listen_loop) и будит ждущие запросы. Уведомление —
+# только подсказка: ждущий всё равно перечитывает проект из БД, а при
+# потере уведомлений спасает периодическая перепроверка.
+
+CHANNEL = "project_updated"
+
+
+class ProjectEvents:
+    def __init__(self):
+        self._waiters: dict[str, set[asyncio.Future]] = {}
+
+    async def wait(self, project_id, timeout: float) -> bool:
+        # True — пришло уведомление, False — таймаут
+        key = str(project_id)
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, set()).add(fut)
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters = self._waiters.get(key)
+            if waiters is not None:
+                waiters.discard(fut)
+                if not waiters:
+                    del self._waiters[key]
+
+    def notify(self, project_id) -> int:
+        woken = 0
+        for fut in list(self._waiters.get(str(project_id), ())):
+            if not fut.done():
+                fut.get_loop().call_soon_threadsafe(_wake, fut)
+                woken += 1
+        return woken
+
+    def waiting(self) -> int:
+        return sum(len(w) for w in self._waiters.values())
+
+
+def _wake(fut: asyncio.Future):
+    if not fut.done():
+        fut.set_result(None)
+
+
+project_events = ProjectEvents()
+
+
+async def publish(session: AsyncSession, project_id) -> None:
+    if session.get_bind().dialect.name == "postgresql":
+        await session.execute(text("SELECT pg_notify(:ch, :pid)"), {"ch": CHANNEL, "pid": str(project_id)})
+    session.sync_session.info.setdefault("notify_projects", set()).add(str(project_id))
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(sync_session: Session):
+    for pid in sync_session.info.pop("notify_projects", ()):
+        project_events.notify(pid)
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(sync_session: Session):
+    sync_session.info.pop("notify_projects", None)
+
+
+def _listen_dsn() -> Optional[str]:
+    url = settings.DATABASE_URL
+    if not url.startswith("postgresql"):
+        return None
+    return "postgresql" + url[url.index("://"):]
+
+
+async def listen_loop(reconnect_sec: float = 5.0):
+    # отдельное соединение asyncpg под LISTEN; при обрыве переподключаемся
+    dsn = _listen_dsn()
+    if dsn is None:
+        return
+    import asyncpg
+
+    def on_notify(conn, pid, channel, payload):
+        project_events.notify(payload)
+
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(dsn)
+            await conn.add_listener(CHANNEL, on_notify)
+            while not conn.is_closed():
+                await asyncio.sleep(reconnect_sec)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[notify] listener failed: {e}")
+        finally:
+            if conn is not None and not conn.is_closed():
+                try:
+                    await conn.close()
+                except Exception:
+                    pass
+        await asyncio.sleep(reconnect_sec)
@@ -1,11 +1,20 @@
+import threading
 import time, uuid, csv
 from pathlib import Path
+from typing import Optional
 import httpx
 
-from app.utils.detect_blocks import detect_blocks
-from app.utils.recognize_formula import recognize_crops
-from app.utils.recognize_word import recognize_word, load_htr_model
-from app.utils.assemble_latex import write_mixed_latex_file
+from app import metrics, pipeline_record as pr
+from app.batcher import MicroBatcher
+from app.cancellation import CancelToken, Cancelled
+from app.config import settings
+from app.result_cache import sha256_file
+from app.utils.detect_blocks import predict_boxes, cut_crops, load_detector
+from app.utils.crop_store import CropStore
+from app.utils.recognize_formula import recognize_crops, recognize_batch, load_trocr
+from app.utils.recognize_word import recognize_word, recognize_words, load_htr_model
+from app.utils.assemble_latex import stored_issues, write_mixed_latex_file
+from app.utils.latex_validate import check_formula
 from app.utils.latex_to_pdf import compile_tex_file_to_pdf
 
 async def download_image(url: str, dest_dir: str) -> str:
@@ -15,6 +24,68 @@ async def download_image(url: str, dest_dir: str) -> str:
         r = await client.get(url); r.raise_for_status(); dst.write_bytes(r.content)
     return str(dst)
 
+_models: dict = {}
+_models_lock = threading.Lock()
+
+def get_models(detector_weights: str, trocr_dir: str, htr_weights: str) -> dict:
+    # модели грузятся один раз на процесс и живут, пока живёт процесс
+    key = (detector_weights, trocr_dir, htr_weights)
+    with _models_lock:
+        m = _models.get(key)
+        if m is None:
+            t0 = time.time()
+            m = {
+                "detector": load_detector(detector_weights),
+                "trocr": load_trocr(trocr_dir),
+                "htr": load_htr_model(htr_weights)[0],
+            }
+            if settings.BATCH_MAX_SIZE > 1:
+                m["formula_batcher"], m["text_batcher"] = _make_batchers(m)
+            # не close: прежние модели ещё могут считать страницы в соседних
+            # потоках; батчеры доработают их и отпустят потоки, остальное
+            # уйдёт вместе с последней ссылкой на словарь моделей
+            for old in _models.values():
+                for b in ("formula_batcher", "text_batcher"):
+                    if old.get(b):
+                        old[b].retire()
+            _models.clear()
+            _models[key] = m
+            print(f"[pipeline] models loaded in {time.time() - t0:.1f}s")
+        return m
+
+def _make_batchers(m: dict):
+    # одна пара батчеров на процесс: страницы, которые считаются параллельно
+    # (INFER_JOB_THREADS потоков в процессе пула), делят один вызов модели
+    processor, trocr_model, device = m["trocr"]
+    htr_model = m["htr"]
+
+    def formulas(images, key):
+        max_new_tokens, beams, length_penalty = key
+        return recognize_batch(processor, trocr_model, device, images,
+                               max_new_tokens=max_new_tokens, num_beams=beams, length_penalty=length_penalty)
+
+    def lines(images, key):
+        try:
+            return recognize_words(images, model=htr_model)
+        except Exception:
+            # битый кроп не должен ронять чужие строки в том же батче
+            res = []
+            for im in images:
+                try:
+                    res.append(recognize_word(im, model=htr_model))
+                except Exception:
+                    res.append(("", 0.0))
+            return res
+
+    opts = dict(max_batch=settings.BATCH_MAX_SIZE, max_wait_ms=settings.BATCH_MAX_WAIT_MS)
+    return MicroBatcher(formulas, name="trocr", **opts), MicroBatcher(lines, name="htr", **opts)
+
+def _stage_sec(stage: str) -> Optional[float]:
+    return settings.PIPELINE_STAGE_DEADLINE_SEC.get(stage) or None
+
+# ultralytics не потокобезопасен: при нескольких страницах в процессе YOLO по очереди
+_detector_lock = threading.Lock()
+
 def run_full_pipeline(
     image_path: str,
     detector_weights: str,
@@ -29,47 +100,108 @@ def run_full_pipeline(
     make_csv: bool = True,
     make_pdf: bool = True,
     htr_weights: str = "models/words_recognizer/ocr_transformer.pt",
+    record: Optional[dict] = None,
+    image=None,
+    image_sha: Optional[str] = None,
+    cancel: Optional[CancelToken] = None,
 ):
+    # image — страница, уже декодированная в BGR (например, из shared memory пула);
+    # cancel — токен задачи: проверяется между этапами и кропами, у каждого этапа свой срок
     t0 = time.time()
+    token = cancel or CancelToken()
+    token.raise_if_cancelled()
+    models = get_models(detector_weights, trocr_dir, htr_weights)
     work_dir = Path(temp_dir) / "work"
     work_dir.parent.mkdir(parents=True, exist_ok=True)
 
-    det_results = detect_blocks(
-        image_path=image_path,
-        yolo_weights=detector_weights,
-        conf=det_conf, iou=det_iou, imgsz=det_imgsz, pad=det_pad,
-        temp_dir=str(work_dir), save_viz=True,
+    params = dict(
+        detector_weights=detector_weights, trocr_dir=trocr_dir, htr_weights=htr_weights,
+        det_conf=det_conf, det_iou=det_iou, det_imgsz=det_imgsz, det_pad=det_pad,
+        beams=beams, max_new_tokens=max_new_tokens, length_penalty=length_penalty,
+        bin_strength=bin_strength, erode_kernel=erode_kernel,
     )
+    image_sha = image_sha or sha256_file(image_path)
+    record = pr.coerce_record(record, image_sha)
+    stages_run = []
+
+    # detect: пропускаем YOLO, если картинка и параметры детектора не менялись
+    det_key = pr.stage_key("detect", params, image_sha)
+    det_cached = pr.cached_stage(record, "detect", det_key)
+    if det_cached:
+        boxes = [tuple(b) for b in det_cached["boxes"]]
+    else:
+        with token.stage("detect", _stage_sec("detect")) as st, _detector_lock:
+            st.raise_if_cancelled()
+            boxes = predict_boxes(
+                image_path=image_path, yolo_weights=detector_weights,
+                conf=det_conf, iou=det_iou, imgsz=det_imgsz, pad=det_pad,
+                image=image, model=models["detector"],
+            )
+            st.raise_if_cancelled()
+        pr.put_stage(record, "detect", det_key, params, boxes=[list(b) for b in boxes])
+        stages_run.append("detect")
+
+    det_results = cut_crops(image_path, boxes, temp_dir=str(work_dir), save_viz=True, image=image)
     if not det_results:
         return {
             "latex": "", "blocks": [], "tex_path": None, "csv_path": None, "pdf_path": None,
             "time_ms": int((time.time() - t0) * 1000), "model_version": "trocr-custom",
-            "detector_weights": detector_weights,
+            "detector_weights": detector_weights, "record": record, "stages_run": stages_run,
         }
     print("det_results:", det_results)
+    crops = CropStore(det_results[0]["crop_store"])
 
+    # formulas: распознаём только блоки без готового результата для текущих параметров
+    f_key = pr.stage_key("formulas", params)
+    f_outputs = pr.reusable_outputs(record, "formulas", f_key)
     formula_items = [d for d in det_results if d.get("cls") == "formula"]
-    formula_crop_paths = [d["crop_path"] for d in formula_items]
-
-    rec_formulas = recognize_crops(
-        crop_paths=formula_crop_paths, model_dir=trocr_dir,
-        beams=beams, max_new_tokens=max_new_tokens, length_penalty=length_penalty,
-        bin_strength=bin_strength, erode_kernel=erode_kernel, out_dir=str(work_dir),
-    )
+    todo = [d for d in formula_items if pr.bbox_key(d["bbox"]) not in f_outputs]
+    bin_by_idx = {}
+    if todo:
+        with token.stage("formulas", _stage_sec("formulas")) as st:
+            rec_formulas = recognize_crops(
+                crops=[(d["idx"], crops.get(d["idx"])) for d in todo], model_dir=trocr_dir,
+                beams=beams, max_new_tokens=max_new_tokens, length_penalty=length_penalty,
+                bin_strength=bin_strength, erode_kernel=erode_kernel, out_dir=str(work_dir),
+                trocr=models["trocr"], batcher=models.get("formula_batcher"), cancel=st,
+            )
+        by_idx = {d["idx"]: d for d in todo}
+        for idx, latex, bin_path in rec_formulas:
+            if idx in by_idx:
+                f_outputs[pr.bbox_key(by_idx[idx]["bbox"])] = latex
+                bin_by_idx[idx] = bin_path
+        stages_run.append("formulas")
+    pr.put_stage(record, "formulas", f_key, params,
+                 outputs={pr.bbox_key(d["bbox"]): f_outputs.get(pr.bbox_key(d["bbox"]), "") for d in formula_items})
     latex_by_idx = {}
-    for idx, latex, bin_path in rec_formulas:
-        latex_by_idx[idx] = (latex, bin_path)
+    for d in formula_items:
+        latex_by_idx[d["idx"]] = (f_outputs.get(pr.bbox_key(d["bbox"]), ""), bin_by_idx.get(d["idx"], ""))
 
-    htr_model, _ = load_htr_model(htr_weights)
-    text_by_idx = {}
-    for d in det_results:
-        if d.get("cls") != "text_line":
-            continue
-        try:
-            text, conf = recognize_word(d["crop_path"], weights_path=words_ocr_weights, model=htr_model)
-        except Exception:
-            text, conf = "", 0.0
-        text_by_idx[d["idx"]] = (text, conf)
+    t_key = pr.stage_key("text", params)
+    t_outputs = pr.reusable_outputs(record, "text", t_key)
+    text_items = [d for d in det_results if d.get("cls") == "text_line"]
+    todo = [d for d in text_items if pr.bbox_key(d["bbox"]) not in t_outputs]
+    if todo:
+        htr_model = models["htr"]
+        with token.stage("text", _stage_sec("text")) as st:
+            if models.get("text_batcher"):
+                recognized = models["text_batcher"].map([crops.get(d["idx"]) for d in todo], cancel=st)
+            else:
+                recognized = []
+                for d in todo:
+                    st.raise_if_cancelled()
+                    try:
+                        recognized.append(recognize_word(crops.get(d["idx"]), weights_path=words_ocr_weights, model=htr_model))
+                    except Exception:
+                        recognized.append(("", 0.0))
+        for d, (text, conf) in zip(todo, recognized):
+            t_outputs[pr.bbox_key(d["bbox"])] = [text, conf]
+        stages_run.append("text")
+    pr.put_stage(record, "text", t_key, params,
+                 outputs={pr.bbox_key(d["bbox"]): t_outputs.get(pr.bbox_key(d["bbox"]), ["", 0.0]) for d in text_items})
+    text_by_idx = {d["idx"]: tuple(t_outputs.get(pr.bbox_key(d["bbox"]), ("", 0.0))) for d in text_items}
+    crops.close()
+    print(f"[pipeline] stages run: {stages_run or ['none']}")
 
     # финальный список блоков для сборки
     blocks = []
@@ -88,8 +220,21 @@ def run_full_pipeline(
                 "content": txt, "crop_path": crop, "alt_path": None, "conf": conf,
             })
 
+    # проверка формул до сборки: битая формула уходит в документ текстом, а не валит pdflatex.
+    # Один раз на формулу: issues/warnings остаются в блоке, их берут сборка tex/docx и проект
+    if settings.LATEX_VALIDATE:
+        for b in blocks:
+            if b["kind"] == "formula":
+                b.update(check_formula(b["content"]))
+        bad = [b["idx"] for b in blocks if b.get("issues")]
+        if bad:
+            metrics.inc("latex.formulas_quarantined", len(bad))
+            print(f"[pipeline] quarantined formulas: {bad}")
+
     tex_path = pdf_path = csv_path = None
+    compile_report: dict = {}  # проходы pdflatex и время каждого
 
+    token.raise_if_cancelled()
     if make_tex:
         items_for_doc = [
             (b["idx"], b["kind"], b["content"], b["bbox"][0], b["bbox"][1], b["bbox"][2], b["bbox"][3])
@@ -98,12 +243,19 @@ def run_full_pipeline(
         tex_path = write_mixed_latex_file(
             items=items_for_doc,
             out_path=str(work_dir / "page.tex"),
-            title=f""
+            title=f"",
+            validate=settings.LATEX_VALIDATE,
+            issues=stored_issues(blocks),
         )
         if make_pdf:
             try:
-                pdf_obj = compile_tex_file_to_pdf(tex_path, engine="pdflatex", timeout=240)
+                with token.stage("compile", _stage_sec("compile")) as st:
+                    pdf_obj = compile_tex_file_to_pdf(tex_path, engine="pdflatex",
+                                                      timeout=settings.LATEX_COMPILE_TIMEOUT_SEC, cancel=st,
+                                                      report=compile_report)
                 pdf_path = str(pdf_obj.resolve())
+            except Cancelled:
+                raise
             except Exception as e:
                 print(f"[latex] PDF compile failed: {e}")
                 pdf_path = None
@@ -127,4 +279,6 @@ def run_full_pipeline(
         "time_ms": int((time.time() - t0) * 1000),
         "model_version": "trocr-custom",
         "detector_weights": detector_weights,
+        "record": record, "stages_run": stages_run, "compile": compile_report,
+        "crop_store": det_results[0]["crop_store"],
     }
@@ -0,0 +1,80 @@
+import hashlib, json
+from typing import Optional
+
+# Промежуточный результат пайплайна по проекту: боксы детектора,
+# геометрия кропов и распознанный текст по каждому блоку вместе
+# с параметрами, которые его породили. Пайплайн — маленький DAG:
+#
+#   detect ──┬── formulas ──┐
+#            └── text ──────┴── assemble/compile
+#
+# detect пересчитывается только при смене картинки или параметров детектора;
+# formulas/text — только для блоков, чей кроп или параметры стадии изменились.
+
+RECORD_VERSION = 1
+
+STAGE_PARAMS = {
+    "detect": ("detector_weights", "det_conf", "det_iou", "det_imgsz", "det_pad"),
+    "formulas": ("trocr_dir", "beams", "max_new_tokens", "length_penalty", "bin_strength", "erode_kernel"),
+    "text": ("htr_weights",),
+}
+
+
+def record_key(user_id, project_id) -> str:
+    return f"users/{user_id}/projects/{project_id}/pipeline.json"
+
+
+def stage_params(stage: str, params: dict) -> dict:
+    from app.result_cache import weights_fingerprint
+    out = {}
+    for k in STAGE_PARAMS[stage]:
+        v = params.get(k)
+        if k in ("detector_weights", "trocr_dir", "htr_weights") and v:
+            v = weights_fingerprint(str(v))
+        out[k] = v
+    return out
+
+
+def stage_key(stage: str, params: dict, image_sha: str = "") -> str:
+    payload = {"stage": stage, "params": stage_params(stage, params)}
+    if stage == "detect":
+        payload["image"] = image_sha
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def bbox_key(bbox) -> str:
+    return ",".join(str(int(v)) for v in bbox)
+
+
+def empty_record(image_sha: str) -> dict:
+    return {"version": RECORD_VERSION, "image_sha": image_sha, "stages": {}}
+
+
+def coerce_record(rec: Optional[dict], image_sha: str) -> dict:
+    # запись от другой картинки или старого формата ничего не даёт
+    if not isinstance(rec, dict):
+        return empty_record(image_sha)
+    if rec.get("version") != RECORD_VERSION or rec.get("image_sha") != image_sha:
+        return empty_record(image_sha)
+    rec.setdefault("stages", {})
+    return rec
+
+
+def dump_record(rec: dict) -> bytes:
+    return json.dumps(rec, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def cached_stage(rec: dict, stage: str, key: str) -> Optional[dict]:
+    st = rec.get("stages", {}).get(stage)
+    if st and st.get("key") == key:
+        return st
+    return None
+
+
+def reusable_outputs(rec: dict, stage: str, key: str) -> dict:
+    st = cached_stage(rec, stage, key)
+    return dict(st.get("outputs", {})) if st else {}
+
+
+def put_stage(rec: dict, stage: str, key: str, params: dict, **data) -> None:
+    rec.setdefault("stages", {})[stage] = {"key": key, "params": stage_params(stage, params), **data}
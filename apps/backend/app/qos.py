@@ -0,0 +1,53 @@
+from typing import Optional
+
+from app.config import settings
+
+# Уровни качества распознавания. Под нагрузкой (сессия) очередь растёт,
+# а каждая страница по-прежнему считается на полном качестве — время
+# ожидания уходит за SLO. Уровень выбираем при взятии задачи по глубине
+# очереди infer: чем длиннее очередь, тем дешевле настройки (меньше
+# картинка детектора, меньше лучей и токенов). Премиум на ступень выше.
+# Выбранный уровень записываем в проект.
+#
+#   глубина < QOS_BALANCED_DEPTH  -> full
+#   глубина < QOS_FAST_DEPTH      -> balanced
+#   иначе                         -> fast
+
+TIERS = ("full", "balanced", "fast")
+
+# поверх настроек по умолчанию (full — как в settings)
+_OVERRIDES = {
+    "full": {},
+    "balanced": {"det_imgsz": 1024, "beams": 2, "max_new_tokens": 192},
+    "fast": {"det_imgsz": 768, "beams": 1, "max_new_tokens": 160, "erode_kernel": 0},
+}
+
+
+def params_for(tier: str) -> dict:
+    if tier not in _OVERRIDES:
+        raise ValueError(f"unknown quality tier: {tier}")
+    base = dict(
+        det_imgsz=settings.DET_IMGSZ, beams=settings.BEAMS, max_new_tokens=settings.MAX_NEW_TOKENS,
+        bin_strength=settings.BIN_STRENGTH, erode_kernel=settings.ERODE_KERNEL,
+    )
+    out = dict(base, **_OVERRIDES[tier])
+    # уровень не может быть дороже полного
+    out["det_imgsz"] = min(out["det_imgsz"], base["det_imgsz"])
+    out["beams"] = min(out["beams"], base["beams"])
+    out["max_new_tokens"] = min(out["max_new_tokens"], base["max_new_tokens"])
+    return out
+
+
+def pick(depth: int, premium: bool = False, forced: Optional[str] = None) -> str:
+    forced = forced if forced is not None else settings.QOS_FORCE_TIER
+    if forced:
+        return forced
+    if depth >= settings.QOS_FAST_DEPTH > 0:
+        i = 2
+    elif depth >= settings.QOS_BALANCED_DEPTH > 0:
+        i = 1
+    else:
+        i = 0
+    if premium:
+        i = max(0, i - 1)
+    return TIERS[i]
@@ -0,0 +1,122 @@
+import hashlib, os
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from app.config import settings
+from app.disk_cache import DiskLRU
+
+# параметры, которые не влияют на результат распознавания
+_RUNTIME_PARAMS = {"image_path", "temp_dir"}
+# параметры-пути к весам: в ключ идёт отпечаток содержимого, а не путь
+_WEIGHT_PARAMS = {"detector_weights", "words_ocr_weights", "trocr_dir", "htr_weights"}
+
+# версия сборки результата: менять при любом изменении вывода распознавания или сборки
+# tex/pdf/docx, которое не видно по параметрам и весам, — старые записи перестанут находиться
+PIPELINE_VERSION = 3
+# настройки, от которых зависят артефакты в записи, но которые не передаются в params
+_OUTPUT_SETTINGS = ("LATEX_VALIDATE", "DOCX_NATIVE", "LATEX_PRECOMPILED_FORMAT")
+
+ARTIFACTS = {"tex_path": "formulas.tex", "pdf_path": "formulas.pdf", "docx_path": "formulas.docx"}
+
+_cache: DiskLRU | None = None
+
+
+def get_cache() -> DiskLRU:
+    global _cache
+    if _cache is None:
+        _cache = DiskLRU(
+            settings.RESULT_CACHE_DIR or os.path.join(settings.TEMP_DIR, "cache", "results"),
+            settings.RESULT_CACHE_MAX_MB * 1024 * 1024,
+            name="result_cache",
+        )
+    return _cache
+
+
+def sha256_file(path: str | Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=64)
+def _digest_cached(path: str, stamp: tuple) -> str:
+    p = Path(path)
+    if p.is_file():
+        return sha256_file(p)
+    h = hashlib.sha256()
+    for f in sorted(x for x in p.rglob("*") if x.is_file()):
+        h.update(str(f.relative_to(p)).encode("utf-8"))
+        h.update(sha256_file(f).encode("ascii"))
+    return h.hexdigest()
+
+
+def weights_fingerprint(path: str) -> str:
+    # веса хэшируем один раз на (размер, mtime); для папки (trocr) — по всем файлам
+    p = Path(path)
+    if not p.exists():
+        return f"missing:{path}"
+    if p.is_file():
+        st = p.stat()
+        stamp = (st.st_size, st.st_mtime_ns)
+    else:
+        stamp = tuple(sorted(
+            (str(f), f.stat().st_size, f.stat().st_mtime_ns) for f in p.rglob("*") if f.is_file()
+        ))
+    return _digest_cached(str(p.resolve()), stamp)
+
+
+def params_fingerprint(params: dict) -> str:
+    h = hashlib.sha256()
+    h.update(f"app={settings.APP_VERSION}\npipeline={PIPELINE_VERSION}".encode("utf-8"))
+    for name in _OUTPUT_SETTINGS:
+        h.update(f"\n{name}={getattr(settings, name)!r}".encode("utf-8"))
+    for k in sorted(params):
+        if k in _RUNTIME_PARAMS:
+            continue
+        v = params[k]
+        if k in _WEIGHT_PARAMS and v:
+            v = weights_fingerprint(str(v))
+        h.update(f"\n{k}={v!r}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def result_key(image_path: str, params: dict, image_sha: Optional[str] = None) -> str:
+    return hashlib.sha256(
+        ((image_sha or sha256_file(image_path)) + ":" + params_fingerprint(params)).encode("ascii")
+    ).hexdigest()
+
+
+def _compact_blocks(blocks: list[dict]) -> list[dict]:
+    keep = ("idx", "bbox", "kind", "content", "conf", "issues", "warnings")
+    return [{k: b[k] for k in keep if k in b} for b in blocks]
+
+
+def lookup(key: str) -> Optional[dict]:
+    # на попадании запись закреплена (файлы ещё будут грузиться) — снять release(key)
+    cache = get_cache()
+    cache.pin(key)
+    hit = cache.get(key)
+    if not hit:
+        cache.unpin(key)
+        return None
+    out = {"blocks": hit["meta"].get("blocks", []), "cached": True}
+    for field, fname in ARTIFACTS.items():
+        out[field] = hit["files"].get(fname)
+    return out
+
+
+def release(key: str) -> None:
+    get_cache().unpin(key)
+
+
+def store(key: str, result: dict) -> None:
+    files = {fname: result.get(field) for field, fname in ARTIFACTS.items() if result.get(field)}
+    if "formulas.tex" not in files:
+        return
+    try:
+        get_cache().put(key, files, {"blocks": _compact_blocks(result.get("blocks", []))})
+    except Exception as e:
+        print(f"[cache] failed to store result {key[:12]}: {e}")
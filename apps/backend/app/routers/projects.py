@@ -1,22 +1,36 @@
-import uuid, os
+import asyncio, hashlib, time, uuid, os
+from collections import OrderedDict
+from pathlib import Path
 from typing import Optional
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException
+from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, Query, Request, Response
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update
 from app.database import get_session
-from app.security import require_verified
+from app.security import require_verified, require_verified_id
 from app.models import Project, ProjectStatus
 from app.config import settings
-from app import crud
+from app import crud, metrics
+from app.notify import project_events, publish
 from app.quotas import can_consume, consume, under_project_cap
-from app.storage import upload_file, make_download_url, delete_objects
-from app.worker import submit_infer_job, submit_texjob
+from app.storage import upload_file, make_download_url, delete_objects, fetch_to_path
+from app.jobqueue import has_pending, submit_infer_job, submit_texjob
+from app.admission import admit, queue_epoch, queue_info
+from app.pipeline_record import record_key
+from app.workspace import workspaces, MB
 from app.schemas import RatingIn, RatingOut
+from app.utils import snippets
+from app.utils.assemble_latex import formulas_from_tex, splice_block
+from app.utils.latex_validate import check_formula
 from uuid import UUID
 
 router = APIRouter(prefix="/projects", tags=["projects"])
 
+class FormulaCheck(BaseModel):
+    idx: int
+    issues: list[str] = []    # формула выведена текстом, а не собрана
+    warnings: list[str] = []  # собрана, но выглядит подозрительно (незнакомые команды)
+
 class ProjectOut(BaseModel):
     id: uuid.UUID
     title: str
@@ -26,6 +40,10 @@ class ProjectOut(BaseModel):
     texUrl: Optional[str] = None
     pdfUrl: Optional[str] = None
     docxUrl: Optional[str] = None
+    queuePosition: Optional[int] = None  # 0 — уже обрабатывается, None — не в очереди
+    etaSec: Optional[int] = None
+    qualityTier: Optional[str] = None  # full/balanced/fast — с каким качеством распознан
+    validation: list[FormulaCheck] = []  # формулы с замечаниями проверки (LATEX_VALIDATE)
 
     class Config:
         json_encoders = {uuid.UUID: str}
@@ -40,45 +58,153 @@ async def create_project(
         raise HTTPException(403, "количество проектов превышено")
     if not await can_consume(session, user, pages=1):
         raise HTTPException(403, "количество обработок в месяц превышено")
+    await admit(session, "infer")
     next_title = await crud.next_untitled_title(session, user.id)
     p = Project(user_id=user.id, title=next_title, description="", status=ProjectStatus.processing)
     session.add(p)
     await session.flush()
 
-    tmp_path = f"{settings.TEMP_DIR}/inbox/{uuid.uuid4().hex}.png"
-    os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
-    with open(tmp_path, "wb") as f:
-        f.write(await image.read())
+    data = await image.read()
     img_key = f"users/{user.id}/projects/{p.id}/image.png"
-    upload_file(tmp_path, img_key)
+    async with workspaces.job("inbox", size_hint=len(data)) as wd:
+        tmp_path = os.path.join(wd, "image.png")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        await asyncio.to_thread(upload_file, tmp_path, img_key)
     p.image_key = img_key
     await session.commit()
 
-    await submit_infer_job(project_id=p.id)
+    await submit_infer_job(project_id=p.id, session=session, user=user)
     await consume(session, user, pages=1)
     await session.commit()
 
-    return await _out_for_project(p)
+    return await _out_for_project(p, session)
 
-async def _out_for_project(p: Project) -> ProjectOut:
+async def _out_for_project(p: Project, session: Optional[AsyncSession] = None, queue: Optional[dict] = None) -> ProjectOut:
     def url(k: str | None):
         return make_download_url(k) if k else None
+    if queue is None and session is not None and p.status == ProjectStatus.processing:
+        queue = await queue_info(session, [p.id])
+    q = (queue or {}).get(p.id)
     return ProjectOut(
         id=p.id, title=p.title, description=p.description, status=p.status,
-        imageUrl=url(p.image_key), texUrl=url(p.tex_key), pdfUrl=url(p.pdf_key), docxUrl=url(p.docx_key)
+        imageUrl=url(p.image_key), texUrl=url(p.tex_key), pdfUrl=url(p.pdf_key), docxUrl=url(p.docx_key),
+        queuePosition=q.position if q else None, etaSec=q.eta_sec if q else None,
+        qualityTier=p.quality_tier,
+        validation=[FormulaCheck(idx=b["idx"], issues=b.get("issues") or [], warnings=b.get("warnings") or [])
+                    for b in p.blocks or [] if b.get("issues") or b.get("warnings")],
     )
 
 @router.get("", response_model=list[ProjectOut])
 async def list_projects(user = Depends(require_verified), session: AsyncSession = Depends(get_session)):
     res = await session.execute(select(Project).where(Project.user_id==user.id).order_by(Project.created_at.desc()))
-    return [await _out_for_project(p) for p in res.unique().scalars().all()]
+    projects = res.unique().scalars().all()
+    queue = await queue_info(session, [p.id for p in projects if p.status == ProjectStatus.processing])
+    return [await _out_for_project(p, queue=queue) for p in projects]
+
+async def _project_etag(session: AsyncSession, pid: uuid.UUID, user_id: uuid.UUID) -> Optional[str]:
+    # дёшево: одна строка без связей и эпоха очереди (общий снимок, без позиций) —
+    # так и для 304, и для перепроверок long-poll; позиция считается только для тела 200
+    row = (await session.execute(
+        select(Project.updated_at, Project.status).where(Project.id == pid, Project.user_id == user_id)
+    )).one_or_none()
+    if row is None:
+        return None
+    updated_at, st = row
+    epoch = await queue_epoch(session) if st == ProjectStatus.processing else ""
+    # ссылки на скачивание живут час: 304 не должен отдавать клиенту протухшие
+    url_epoch = int(time.time() // settings.PROJECT_ETAG_URL_TTL_SEC)
+    raw = f"{updated_at.isoformat() if updated_at else ''}|{st.value}|{epoch}|{url_epoch}"
+    return '"' + hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20] + '"'
+
+def _etag_matches(header: Optional[str], tag: str) -> bool:
+    if not header:
+        return False
+    return any(t.strip().removeprefix("W/") == tag or t.strip() == "*" for t in header.split(","))
 
 @router.get("/{pid}", response_model=ProjectOut)
-async def get_project(pid: uuid.UUID, user = Depends(require_verified), session: AsyncSession = Depends(get_session)):
-    p = await crud.get_project(session, pid, user.id)
+async def get_project(
+    pid: uuid.UUID,
+    request: Request,
+    response: Response,
+    wait: float = Query(0, ge=0, description="держать запрос до N секунд, пока проект совпадает с If-None-Match"),
+    user_id: uuid.UUID = Depends(require_verified_id),
+    session: AsyncSession = Depends(get_session),
+):
+    inm = request.headers.get("if-none-match")
+    tag = await _project_etag(session, pid, user_id)
+    if tag is None:
+        raise HTTPException(404)
+    deadline = time.monotonic() + min(wait, settings.PROJECT_WAIT_MAX_SEC)
+    while _etag_matches(inm, tag) and time.monotonic() < deadline:
+        await session.rollback()  # не держим соединение пула, пока ждём
+        await project_events.wait(pid, min(deadline - time.monotonic(), settings.PROJECT_WAIT_POLL_SEC))
+        tag = await _project_etag(session, pid, user_id)
+        if tag is None:
+            raise HTTPException(404)
+    if _etag_matches(inm, tag):
+        metrics.inc("projects.not_modified")
+        return Response(status_code=304, headers={"ETag": tag})
+
+    p = await crud.get_project(session, pid, user_id)
     if not p:
         raise HTTPException(404)
-    return await _out_for_project(p)
+    response.headers["ETag"] = tag
+    return await _out_for_project(p, session)
+
+# формулы документа по номеру блока; ключ — (tex_key, updated_at): правка даёт новую запись
+_formulas: OrderedDict = OrderedDict()
+_FORMULAS_MAX = 64
+
+async def _project_formulas(tex_key: str, updated_at) -> dict[int, str]:
+    k = (tex_key, updated_at)
+    if k in _formulas:
+        _formulas.move_to_end(k)
+        return _formulas[k]
+    async with workspaces.job("preview", size_hint=MB) as wd:
+        local = os.path.join(wd, "page.tex")
+        await asyncio.to_thread(fetch_to_path, tex_key, local)
+        tex = await asyncio.to_thread(Path(local).read_text, encoding="utf-8", errors="replace")
+    _formulas[k] = out = formulas_from_tex(tex)
+    while len(_formulas) > _FORMULAS_MAX:
+        _formulas.popitem(last=False)
+    return out
+
+@router.get("/{pid}/blocks/{idx}/preview")
+async def block_preview(
+    pid: uuid.UUID,
+    idx: int,
+    request: Request,
+    format: str = Query("png", pattern="^(png|svg)$"),
+    user_id: uuid.UUID = Depends(require_verified_id),
+    session: AsyncSession = Depends(get_session),
+):
+    # формула — из сохранённых блоков проекта (есть сразу после распознавания, без
+    # выкачки и разбора tex); tex разбираем только у проектов, где блоков ещё не хранили
+    p = await crud.get_project(session, pid, user_id)
+    if not p or not (p.blocks or p.tex_key):
+        raise HTTPException(404)
+    blocks, tex_key, updated_at = p.blocks, p.tex_key, p.updated_at
+    await session.rollback()  # рендер может занять секунды — соединение пула не держим
+    if blocks:
+        formula = next((b.get("content") or None for b in blocks if b["idx"] == idx and b["kind"] == "formula"), None)
+    else:
+        try:
+            formula = (await _project_formulas(tex_key, updated_at)).get(idx)
+        except FileNotFoundError:
+            raise HTTPException(404)
+    if formula is None:
+        raise HTTPException(404, "формула не найдена")
+    tag = '"' + (await asyncio.to_thread(snippets.key, formula, format))[:20] + '"'
+    headers = {"ETag": tag, "Cache-Control": "private, max-age=300"}
+    if _etag_matches(request.headers.get("if-none-match"), tag):
+        return Response(status_code=304, headers=headers)
+    try:
+        data = await snippets.render_async(formula, format)
+    except Exception as e:
+        print(f"[preview] {pid} #{idx}: {e}")
+        raise HTTPException(422, "не удалось отрисовать формулу")
+    return Response(content=data, media_type=snippets.MEDIA_TYPES[format], headers=headers)
 
 class PatchIn(BaseModel):
     title: Optional[str] = None
@@ -98,9 +224,70 @@ async def patch_project(pid: uuid.UUID, data: PatchIn, user=Depends(require_veri
 
     if data.tex is not None:
         p.status = ProjectStatus.processing
+        # атомарно: две быстрые правки подряд должны получить разные ревизии
+        rev = (await session.execute(
+            update(Project).where(Project.id == p.id)
+            .values(tex_revision=Project.tex_revision + 1).returning(Project.tex_revision)
+        )).scalar_one()
+        await submit_texjob(project_id=p.id, tex_content=data.tex, session=session, user=user, revision=rev)
+        await publish(session, p.id)
         await session.commit()
-        await submit_texjob(project_id=p.id, tex_content=data.tex)
-    return await _out_for_project(p)
+    return await _out_for_project(p, session)
+
+class BlockPatchIn(BaseModel):
+    content: str
+
+@router.patch("/{pid}/blocks/{idx}", response_model=ProjectOut)
+async def patch_block(
+    pid: uuid.UUID,
+    idx: int,
+    data: BlockPatchIn,
+    user=Depends(require_verified),
+    session: AsyncSession = Depends(get_session),
+):
+    # правка одного блока: в tex меняется только его строка, дальше — обычная
+    # сборка правки (кэш pdf/docx, превью формул), но без _wrap_tex_if_needed.
+    # Основа — tex по p.tex_key, поэтому пока ждёт или идёт сборка (PATCH tex,
+    # прошлая правка блока), отвечаем 409: иначе правили бы устаревший tex, а
+    # наша задача сняла бы ждущую. Строку держим до commit, чтобы проверка и
+    # постановка задачи были атомарны. Сами ничего не выкладываем: новый tex и
+    # blocks записывает воркер вместе, после сборки.
+    p = (await session.execute(
+        select(Project).where(Project.id == pid, Project.user_id == user.id).with_for_update()
+    )).unique().scalar_one_or_none()
+    if not p or not p.tex_key or not p.blocks:
+        raise HTTPException(404)
+    if not any(b["idx"] == idx for b in p.blocks):
+        raise HTTPException(404, "блок не найден")
+    if await has_pending(session, "tex", p.id):
+        raise HTTPException(409, "документ ещё собирается — повторите после сборки")
+
+    async with workspaces.job("block", size_hint=MB) as wd:
+        local = os.path.join(wd, "formulas.tex")
+        try:
+            await asyncio.to_thread(fetch_to_path, p.tex_key, local)
+        except FileNotFoundError:
+            raise HTTPException(404)
+        tex = await asyncio.to_thread(Path(local).read_text, encoding="utf-8", errors="replace")
+        new_tex = await asyncio.to_thread(splice_block, tex, p.blocks, idx, data.content, settings.LATEX_VALIDATE)
+        if new_tex is None:
+            raise HTTPException(409, "строка блока изменена вручную — правьте tex целиком")
+
+    checked = check_formula(data.content) if settings.LATEX_VALIDATE and any(
+        b["idx"] == idx and b["kind"] == "formula" for b in p.blocks) else {}
+    blocks = [{**{k: v for k, v in b.items() if k not in ("issues", "warnings")}, "content": data.content, **checked}
+              if b["idx"] == idx else b for b in p.blocks]
+    p.status = ProjectStatus.processing
+    rev = (await session.execute(
+        update(Project).where(Project.id == p.id)
+        .values(tex_revision=Project.tex_revision + 1).returning(Project.tex_revision)
+    )).scalar_one()
+    await submit_texjob(project_id=p.id, tex_content=new_tex, session=session, user=user, revision=rev,
+                        prepared=True, blocks=blocks)
+    metrics.inc("projects.block_patch")
+    await publish(session, p.id)
+    await session.commit()
+    return await _out_for_project(p, session)
 
 @router.post("/{pid}/reprocess", status_code=202)
 async def reprocess(pid: uuid.UUID, user=Depends(require_verified), session: AsyncSession = Depends(get_session)):
@@ -109,10 +296,11 @@ async def reprocess(pid: uuid.UUID, user=Depends(require_verified), session: Asy
         raise HTTPException(404)
     if not await can_consume(session, user, pages=1):
         raise HTTPException(403, "количество обработок в месяц превышено")
+    await admit(session, "infer")
     p.status = ProjectStatus.processing
-    await session.commit()
-    await submit_infer_job(project_id=p.id)
+    await submit_infer_job(project_id=p.id, session=session, user=user)
     await consume(session, user, pages=1)
+    await publish(session, p.id)
     await session.commit()
     return
 
@@ -122,7 +310,8 @@ async def delete_project(pid: uuid.UUID, user=Depends(require_verified), session
     if not p:
         return
     keys = [k for k in [p.image_key, p.tex_key, p.pdf_key, p.docx_key] if k]
-    delete_objects(keys)
+    keys += [record_key(p.user_id, p.id), f"users/{p.user_id}/projects/{p.id}/debug/page.crops"]
+    await asyncio.to_thread(delete_objects, keys)
     await session.delete(p)
     await session.commit()
     return
@@ -0,0 +1,44 @@
+import math
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+from app.config import settings
+
+# Политика выбора следующей задачи из очереди.
+#
+# Кандидаты — самая старая задача каждого (линия, пользователь), так что
+# 50 страниц одного пользователя дают одного кандидата, а не 50.
+# Уровень задачи = вес линии (tex — интерактивные перекомпиляции) + премиум
+# + ожидание / SCHED_AGING_SEC (защита от голодания: каждые AGING секунд
+# ожидания задача поднимается на уровень). Внутри уровня — round-robin по
+# пользователям: раньше идёт тот, кого дольше не обслуживали.
+
+LANES = ("tex", "infer")
+
+
+def _aware(dt: Optional[datetime]) -> Optional[datetime]:
+    if dt is not None and dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)  # SQLite отдаёт naive
+    return dt
+
+
+def lane_weight(lane: str) -> float:
+    return settings.SCHED_TEX_WEIGHT if lane == "tex" else 0.0
+
+
+def level(job, now: datetime) -> int:
+    wait = max(0.0, (now - _aware(job.created_at)).total_seconds())
+    score = lane_weight(job.kind) + settings.SCHED_PREMIUM_WEIGHT * (job.priority or 0)
+    if settings.SCHED_AGING_SEC > 0:
+        score += wait / settings.SCHED_AGING_SEC
+    return math.floor(score)
+
+
+def order(candidates: Iterable, now: datetime, last_served: dict) -> list:
+    epoch = datetime.min.replace(tzinfo=timezone.utc)
+
+    def key(job):
+        served = _aware(last_served.get(job.user_id)) or epoch
+        return (-level(job, now), served, _aware(job.created_at))
+
+    return sorted(candidates, key=key)
@@ -30,19 +30,22 @@ def create_access_token(user: User) -> str:
     }
     return jwt.encode(payload, settings.JWT_SECRET, algorithm=settings.JWT_ALG)
 
-async def get_current_user(
-    creds: Annotated[HTTPAuthorizationCredentials | None, Depends(auth_scheme)],
-    session: Annotated[AsyncSession, Depends(get_session)]
-) -> User:
+def _token_user_id(creds: HTTPAuthorizationCredentials | None) -> uuid.UUID:
     if not creds:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
     token = creds.credentials
     try:
         payload = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALG])
-        uid = payload.get("sub")
+        return uuid.UUID(payload.get("sub"))
     except Exception:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
-    res = await session.execute(select(User).where(User.id == uuid.UUID(uid)))
+
+async def get_current_user(
+    creds: Annotated[HTTPAuthorizationCredentials | None, Depends(auth_scheme)],
+    session: Annotated[AsyncSession, Depends(get_session)]
+) -> User:
+    uid = _token_user_id(creds)
+    res = await session.execute(select(User).where(User.id == uid))
     user = res.unique().scalar_one_or_none()
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
@@ -52,3 +55,16 @@ async def require_verified(user: Annotated[User, Depends(get_current_user)]) ->
     if not user.email_verified:
         raise HTTPException(403, "почта не подтверждена")
     return user
+
+async def require_verified_id(
+    creds: Annotated[HTTPAuthorizationCredentials | None, Depends(auth_scheme)],
+    session: Annotated[AsyncSession, Depends(get_session)]
+) -> uuid.UUID:
+    # облегчённый require_verified для частого опроса: одна колонка вместо User со связями
+    uid = _token_user_id(creds)
+    verified = (await session.execute(select(User.email_verified).where(User.id == uid))).scalar_one_or_none()
+    if verified is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+    if not verified:
+        raise HTTPException(403, "почта не подтверждена")
+    return uid
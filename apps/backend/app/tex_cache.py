@@ -0,0 +1,71 @@
+import hashlib, os, shutil
+from pathlib import Path
+from typing import Optional
+
+from app.config import settings
+from app.disk_cache import DiskLRU
+
+# Кэш собранных pdf/docx по содержимому TeX. Одинаковый исходник (повторное
+# сохранение PATCH-ем, перераспознавание с тем же результатом) не гоняет
+# latexmk/pandoc заново. Ключ — хэш нормализованного исходника + инструмент
+# и его версия: обновили TeX или pandoc — старые записи просто не находятся
+# и уходят по LRU. Кэшируем только успешные сборки.
+
+_cache: DiskLRU | None = None
+
+
+def get_cache() -> DiskLRU:
+    global _cache
+    if _cache is None:
+        _cache = DiskLRU(
+            settings.TEX_CACHE_DIR or os.path.join(settings.TEMP_DIR, "cache", "tex"),
+            settings.TEX_CACHE_MAX_MB * 1024 * 1024,
+            name="tex_cache",
+        )
+    return _cache
+
+
+def enabled() -> bool:
+    return settings.TEX_CACHE_MAX_MB > 0
+
+
+def normalize(text: str) -> str:
+    # пробелы в конце строк, CRLF, BOM и хвостовые пустые строки на вывод не влияют
+    text = text.lstrip("\ufeff").replace("\r\n", "\n").replace("\r", "\n")
+    return "\n".join(line.rstrip() for line in text.split("\n")).strip("\n") + "\n"
+
+
+def key(tex_path: str | Path, tool: str) -> Optional[str]:
+    # tool — что и какой версии собирает ("pdf:pdfTeX 3.14..."); None — кэш выключен/файл не прочитать
+    if not enabled():
+        return None
+    try:
+        text = Path(tex_path).read_text(encoding="utf-8")
+    except (OSError, UnicodeDecodeError):
+        return None
+    h = hashlib.sha256(f"app={settings.APP_VERSION}\n{tool}\n".encode("utf-8"))
+    h.update(normalize(text).encode("utf-8"))
+    return h.hexdigest()
+
+
+def fetch(k: Optional[str], fname: str, dst: str | Path) -> bool:
+    # True — артефакт из кэша лёг в dst
+    if not k:
+        return False
+    with get_cache().pinned(k) as hit:
+        if not hit or fname not in hit["files"]:
+            return False
+        try:
+            shutil.copyfile(hit["files"][fname], dst)
+        except OSError:
+            return False
+    return True
+
+
+def store(k: Optional[str], fname: str, src: str | Path) -> None:
+    if not k:
+        return
+    try:
+        get_cache().put(k, {fname: src})
+    except Exception as e:
+        print(f"[cache] failed to store {fname} {k[:12]}: {e}")
@@ -1,7 +1,12 @@
 from pathlib import Path
-from typing import List, Tuple, Dict, Any
+from typing import List, Optional, Tuple, Dict, Any
+import bisect
+import re
 import statistics
 
+from app.utils.latex_validate import validate_formula
+from app.utils.reading_order import reading_groups
+
 HEADER = r"""\documentclass[12pt]{article}
 \usepackage[T1]{fontenc}
 \usepackage[utf8]{inputenc}
@@ -37,6 +42,18 @@ def latex_escape_text(s: str) -> str:
     }
     return "".join(repl.get(ch, ch) for ch in s)
 
+def quarantine(formula: str) -> str:
+    # формула не прошла проверку: печатаем исходник как текст, чтобы документ собрался
+    # (" у babel[russian] — активный символ)
+    f = latex_escape_text((formula or "").strip()).replace('"', '\\textquotedbl{}')
+    return f"\\texttt{{{f}}}" if f else ""
+
+def _render_formula(b: Dict[str, Any], display: bool) -> str:
+    if b.get("issues"):
+        q = quarantine(b["content"])
+        return f"\\begin{{center}}{q}\\end{{center}}\n" if display else q
+    return _wrap_display(b["content"]) if display else _wrap_inline(b["content"])
+
 
 def _height(b: Dict[str, Any]) -> float:
     x1, y1, x2, y2 = b["bbox"]
@@ -64,8 +81,35 @@ def _vertical_overlap(a: Dict[str, Any], b: Dict[str, Any]) -> float:
     hb = max(1.0, float(by2 - by1))
     return inter / min(ha, hb)
 
+class _Line:
+    # строка в процессе сборки: центры по возрастанию (медиана за O(1)) и
+    # блоки, ещё способные перекрыться по вертикали со следующими
+    __slots__ = ("blocks", "centers", "alive", "max_y2")
+
+    def __init__(self, b: Dict[str, Any]):
+        self.blocks = [b]
+        self.centers = [_y_center(b)]
+        self.alive = [b]
+        self.max_y2 = float(b["bbox"][3])
+
+    def add(self, b: Dict[str, Any]) -> None:
+        self.blocks.append(b)
+        bisect.insort(self.centers, _y_center(b))
+        self.alive.append(b)
+        self.max_y2 = max(self.max_y2, float(b["bbox"][3]))
+
+    def median(self) -> float:
+        # то же, что statistics.median
+        c, n = self.centers, len(self.centers)
+        return c[n // 2] if n % 2 else (c[n // 2 - 1] + c[n // 2]) / 2
+
+def _nonempty(blocks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # пустые блоки в документ не идут; блок без content (ещё не распознан, порядок детекции) — идёт
+    return [b for b in blocks
+            if "content" not in b or (isinstance(b["content"], str) and b["content"].strip() != "")]
+
 def _cluster_into_lines(blocks: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
-    bs = [b for b in blocks if isinstance(b.get("content", ""), str) and b["content"].strip() != ""]
+    bs = _nonempty(blocks)
     if not bs:
         return []
 
@@ -77,50 +121,83 @@ def _cluster_into_lines(blocks: List[Dict[str, Any]]) -> List[List[Dict[str, Any
     if statistics.pstdev(heights) > 0.8 * (med_h + 1e-6):
         y_tol *= 1.25
 
-    lines: List[List[Dict[str, Any]]] = []
+    # Проход сверху вниз по y1. Строка, у которой все блоки кончились выше
+    # текущего y1, а медиана центров ниже всех оставшихся центров больше
+    # чем на y_tol, уже никому не подойдёт — выбывает из активных. Блок
+    # с y2 <= y1 перекрытия больше не даст — выбывает из alive строки.
+    centers = [_y_center(b) for b in bs_sorted]
+    min_cy_after = centers[:]
+    for i in range(len(centers) - 2, -1, -1):
+        min_cy_after[i] = min(centers[i], min_cy_after[i + 1])
 
-    for b in bs_sorted:
-        cy = _y_center(b)
-        placed = False
-        best_line_idx = -1
+    lines: List[_Line] = []
+    active: List[_Line] = []
+
+    for b, cy, min_cy in zip(bs_sorted, centers, min_cy_after):
+        y1 = float(b["bbox"][1])
+        best_line = None
         best_score = -1.0
 
-        for i, line in enumerate(lines):
-            line_cy = statistics.median([_y_center(x) for x in line])
+        still = []
+        for line in active:
+            line_cy = line.median()
+            if min_cy > line_cy + y_tol and y1 >= line.max_y2:
+                continue
+            still.append(line)
+            line.alive = [x for x in line.alive if float(x["bbox"][3]) > y1]
             dy = abs(cy - line_cy)
-            ovl = max(_vertical_overlap(b, x) for x in line)
+            ovl = max((_vertical_overlap(b, x) for x in line.alive), default=0.0)
             score = (max(0.0, y_tol - dy) / y_tol) + 0.5 * ovl
             if dy <= y_tol or ovl >= 0.5:
                 if score > best_score:
                     best_score = score
-                    best_line_idx = i
-
-        if best_line_idx >= 0:
-            lines[best_line_idx].append(b)
-            placed = True
+                    best_line = line
+        active = still
 
-        if not placed:
-            lines.append([b])
+        if best_line is not None:
+            best_line.add(b)
+        else:
+            line = _Line(b)
+            lines.append(line)
+            active.append(line)
 
-    for line in lines:
-        line.sort(key=_x_left)
+    out = [sorted(line.blocks, key=_x_left) for line in lines]
+    out.sort(key=lambda ln: min(b["bbox"][1] for b in ln))
+    return out
 
-    lines.sort(key=lambda ln: min(b["bbox"][1] for b in ln))
+def _reading_lines(blocks: List[Dict[str, Any]], gutters=None) -> List[List[Dict[str, Any]]]:
+    # строки в порядке чтения: по колонкам (reading_groups), внутри колонки —
+    # _cluster_into_lines; на одноколоночной странице — ровно _cluster_into_lines.
+    # gutters — уже найденные column_gutters этих блоков, чтобы не искать заново
+    bs = _nonempty(blocks)
+    if not bs:
+        return []
+    groups = reading_groups([b["bbox"] for b in bs], gutters)
+    lines: List[List[Dict[str, Any]]] = []
+    for g in range(int(groups.max()) + 1):
+        lines.extend(_cluster_into_lines([b for b, bg in zip(bs, groups) if bg == g]))
     return lines
 
+def reading_order(boxes, gutters=None) -> List[int]:
+    # индексы boxes (x1, y1, x2, y2, ...) в том порядке, в каком build_mixed_document
+    # выведет блоки: те же группы и строки. По нему detect_blocks нумерует блоки,
+    # так что idx идут в порядке документа
+    blocks = [{"i": i, "bbox": tuple(float(v) for v in b[:4])} for i, b in enumerate(boxes)]
+    return [b["i"] for line in _reading_lines(blocks, gutters) for b in line]
+
 def _render_line_to_latex(line: List[Dict[str, Any]]) -> str:
     if not line:
         return ""
 
     only_one = (len(line) == 1)
     if only_one and line[0]["kind"] == "formula":
-        return _wrap_display(line[0]["content"])
+        return _render_formula(line[0], display=True)
 
     parts = []
     for i, b in enumerate(line):
         kind = b["kind"]
         if kind == "formula":
-            parts.append(_wrap_inline(b["content"]))
+            parts.append(_render_formula(b, display=False))
         else:
             parts.append(latex_escape_text(b["content"]))
 
@@ -137,45 +214,176 @@ def _render_line_to_latex(line: List[Dict[str, Any]]) -> str:
 
     return "".join(out) + "\n"
 
+def _norm_block(idx, kind, content, x1, y1, x2, y2, validate: bool = True,
+                issues: Optional[List[str]] = None) -> Dict[str, Any]:
+    # issues — уже найденные проблемы формулы (хранятся в блоке); None — проверить здесь
+    content = content if isinstance(content, str) else ""
+    if not (validate and kind == "formula"):
+        issues = []
+    elif issues is None:
+        issues = validate_formula(content)
+    return {
+        "idx": idx,
+        "kind": kind,
+        "content": content,
+        "bbox": (float(x1), float(y1), float(x2), float(y2)),
+        "issues": issues,
+    }
+
+def _line_chunk(line: List[Dict[str, Any]]) -> str:
+    # строка документа целиком: маркер с блоками, замечания проверки, latex, пустая строка
+    cmts = " ".join([
+        f"(#{b['idx']} {b['kind']} x={int(b['bbox'][0])}..{int(b['bbox'][2])} y={int(b['bbox'][1])}..{int(b['bbox'][3])})"
+        for b in line
+    ])
+    out = [f"% {cmts}\n"]
+    for b in line:
+        if b["issues"]:
+            out.append(f"% invalid #{b['idx']}: {'; '.join(b['issues'])}\n")
+    out.append(_render_line_to_latex(line))
+    out.append("\n")
+    return "".join(out)
+
 def build_mixed_document(
     blocks: List[Tuple[int, str, str, float, float, float, float]],
-    title: str
+    title: str,
+    validate: bool = True,
+    issues: Optional[Dict[int, List[str]]] = None,
 ) -> str:
-    norm_blocks: List[Dict[str, Any]] = []
-    for tup in blocks:
-        if len(tup) != 7:
-            continue
-        idx, kind, content, x1, y1, x2, y2 = tup
-        norm_blocks.append({
-            "idx": idx,
-            "kind": kind,
-            "content": content if isinstance(content, str) else "",
-            "bbox": (float(x1), float(y1), float(x2), float(y2)),
-        })
+    # issues — idx -> проблемы формулы, если их уже нашли (блоки пайплайна/проекта)
+    issues = issues or {}
+    norm_blocks = [_norm_block(*tup, validate=validate, issues=issues.get(tup[0])) for tup in blocks if len(tup) == 7]
 
-    lines = _cluster_into_lines(norm_blocks)
+    lines = _reading_lines(norm_blocks)
 
     body_lines: List[str] = []
     if not lines:
         body_lines.append("\\textit{Нет блоков.}\n")
     else:
-        for i, line in enumerate(lines):
-            cmts = " ".join([
-                f"(#{b['idx']} {b['kind']} x={int(b['bbox'][0])}..{int(b['bbox'][2])} y={int(b['bbox'][1])}..{int(b['bbox'][3])})"
-                for b in line
-            ])
-            body_lines.append(f"% {cmts}\n")
-            body_lines.append(_render_line_to_latex(line))
-            body_lines.append("\n")
+        for line in lines:
+            body_lines.append(_line_chunk(line))
 
     return HEADER.replace("%TITLE%", title) + "".join(body_lines) + FOOTER
 
 def write_mixed_latex_file(
     items: List[Tuple[int, str, str, float, float, float, float]],
     out_path: str,
-    title: str = ""
+    title: str = "",
+    validate: bool = True,
+    issues: Optional[Dict[int, List[str]]] = None,
 ) -> str:
     out = Path(out_path); out.parent.mkdir(parents=True, exist_ok=True)
-    tex = build_mixed_document(items, title=title)
+    tex = build_mixed_document(items, title=title, validate=validate, issues=issues)
     out.write_text(tex, encoding="utf-8")
     return str(out.resolve())
+
+
+# Обратно: из .tex (в т.ч. поправленного пользователем) — исходник каждой
+# формулы по номеру блока. Опираемся на комментарии "% (#idx kind ...)",
+# которые build_mixed_document пишет перед каждой строкой.
+_MARKER_RE = re.compile(r"^% (\(#\d+ .*)$")
+_ENTRY_RE = re.compile(r"\(#(\d+) (\w+)[^)]*\)")
+_INVALID_RE = re.compile(r"^% invalid #(\d+):")
+_FORMULA_RE = re.compile(
+    r"\\\[\s*(.*?)\s*\\\]|\\\((.*?)\\\)|\\texttt\{((?:\\[A-Za-z]+\{\}|\\[^A-Za-z]|[^{}\\])*)\}",
+    re.S,
+)
+_UNESCAPE_RE = re.compile(r"\\(textbackslash|textasciitilde|textasciicircum|textquotedbl)\{\}|\\([&%$#_{}])")
+_UNESCAPE = {"textbackslash": "\\", "textasciitilde": "~", "textasciicircum": "^", "textquotedbl": '"'}
+
+def _unescape_text(s: str) -> str:
+    return _UNESCAPE_RE.sub(lambda m: _UNESCAPE[m.group(1)] if m.group(1) else m.group(2), s)
+
+def formulas_from_tex(tex: str) -> Dict[int, str]:
+    # строку, где число формул не сходится с разметкой (пустая формула, ручная правка), пропускаем
+    out: Dict[int, str] = {}
+    entries: List[Tuple[int, str]] = []
+    body: List[str] = []
+
+    def flush():
+        idxs = [idx for idx, kind in entries if kind == "formula"]
+        found = _FORMULA_RE.findall("".join(body))
+        if idxs and len(found) == len(idxs):
+            for idx, (display, inline, quarantined) in zip(idxs, found):
+                out[idx] = display or inline or _unescape_text(quarantined)
+
+    for line in tex.splitlines(keepends=True):
+        m = _MARKER_RE.match(line)
+        if m:
+            flush()
+            entries = [(int(i), kind) for i, kind in _ENTRY_RE.findall(m.group(1))]
+            body = []
+        elif line.startswith("\\end{document}"):
+            break
+        elif not _INVALID_RE.match(line):
+            body.append(line)
+    flush()
+    return out
+
+
+# Правка одного блока (PATCH /projects/{pid}/blocks/{idx}): пересобираем
+# только его строку. Строку находим по маркеру "% (#idx ...)" и сверяем с
+# тем, что дали бы сохранённые блоки: расходится — строку правили руками,
+# молча затирать нельзя. Пробелы при сверке не в счёт (PATCH tex схлопывает
+# \[..\] в одну строку). Блок появляется или пропадает (пустое содержимое) —
+# меняется разбивка на строки, собираем документ заново, но тоже только
+# если он не правился руками.
+_WS_RE = re.compile(r"\s+")
+_TITLE_RE = re.compile(r"\\title\{([^{}]*)\}")
+
+def _same_latex(a: str, b: str) -> bool:
+    return _WS_RE.sub("", a) == _WS_RE.sub("", b)
+
+def _items(blocks: List[Dict[str, Any]]) -> List[Tuple[int, str, str, float, float, float, float]]:
+    return [(b["idx"], b["kind"], b.get("content") or "", *b["bbox"]) for b in blocks]
+
+def stored_issues(blocks: List[Dict[str, Any]]) -> Dict[int, List[str]]:
+    # проблемы формул, сохранённые в блоках (пайплайн проверяет каждую один раз)
+    return {b["idx"]: b["issues"] for b in blocks if "issues" in b}
+
+def splice_block(
+    tex: str,
+    blocks: List[Dict[str, Any]],
+    idx: int,
+    content: str,
+    validate: bool = True,
+) -> str | None:
+    # blocks — сохранённые блоки проекта (idx, kind, bbox, content) до правки;
+    # None — документ в этом месте не совпадает с блоками
+    by_idx = {b["idx"]: b for b in blocks}
+    old = by_idx[idx]
+    known = stored_issues(blocks)
+    if not (old.get("content") or "").strip() or not content.strip():
+        m = _TITLE_RE.search(tex)
+        title = m.group(1) if m else ""
+        if not _same_latex(tex, build_mixed_document(_items(blocks), title=title, validate=validate, issues=known)):
+            return None
+        new_blocks = [dict(b, content=content) if b["idx"] == idx else b for b in blocks]
+        known.pop(idx, None)
+        return build_mixed_document(_items(new_blocks), title=title, validate=validate, issues=known)
+
+    lines = tex.splitlines(keepends=True)
+    for i, ln in enumerate(lines):
+        m = _MARKER_RE.match(ln)
+        if not m:
+            continue
+        entries = [int(e) for e, _ in _ENTRY_RE.findall(m.group(1))]
+        if idx in entries:
+            break
+    else:
+        return None
+    if any(e not in by_idx for e in entries):
+        return None
+    # конец строки — следующий маркер или \end{document}
+    j = i + 1
+    while j < len(lines) and not _MARKER_RE.match(lines[j]) and not lines[j].startswith("\\end{document}"):
+        j += 1
+    segment = "".join(lines[i:j])
+    line = [_norm_block(*it, validate=validate, issues=known.get(it[0])) for it in _items([by_idx[e] for e in entries])]
+    if not _same_latex(segment, _line_chunk(line)):
+        return None
+    for b in line:
+        if b["idx"] == idx:
+            b.update(_norm_block(*_items([dict(old, content=content)])[0], validate=validate))
+    tail = segment[len(segment.rstrip()):]
+    return "".join(lines[:i]) + _line_chunk(line).rstrip() + tail + "".join(lines[j:])
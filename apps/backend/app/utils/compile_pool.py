@@ -0,0 +1,197 @@
+import asyncio, os, shutil, tempfile, threading, time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import Optional
+
+from app import metrics
+from app.cancellation import CancelToken, check
+from app.config import settings
+
+# Ограничения на компиляцию LaTeX в пределах процесса:
+#   - не больше LATEX_MAX_CONCURRENCY компиляций разом, остальные ждут
+#     слот (ожидание и работа меряются отдельно: latex.queue_wait_ms / latex.run_ms);
+#   - каждому процессу TeX — RLIMIT_CPU и RLIMIT_AS через ulimit до exec (зациклившийся макрос
+#     или раздутая память убиваются ядром, а не висят до таймаута);
+#   - каждая компиляция — в своей пустой scratch-папке, наружу копируется
+#     только pdf (и лог при ошибке).
+# Таймаут и отмена убивают всю группу процессов (latexmk + pdflatex), см. _run.
+
+
+class _Waiter:
+    __slots__ = ("wake", "granted")
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+class CompilePool:
+    # слоты выдаются строго по очереди прихода — и потокам (slot), и корутинам (aslot):
+    # освободившийся слот передаётся первому ждущему, никто не перехватывает его опросом
+    def __init__(self, size: int):
+        self.size = max(1, int(size))
+        self._free = self.size
+        self._waiters: deque[_Waiter] = deque()
+        self._lock = threading.Lock()
+        self.running = 0
+
+    def _acquire(self, wake) -> Optional[_Waiter]:
+        # None — слот взят сразу; иначе ждать, пока waiter.granted
+        with self._lock:
+            if self._free > 0 and not self._waiters:
+                self._free -= 1
+                return None
+            w = _Waiter(wake)
+            self._waiters.append(w)
+            return w
+
+    def _release(self) -> None:
+        with self._lock:
+            self._release_locked()
+
+    def _release_locked(self) -> None:
+        while self._waiters:
+            w = self._waiters.popleft()
+            w.granted = True
+            try:
+                w.wake()
+                return
+            except RuntimeError:
+                continue  # event loop ждущего уже закрыт
+        self._free += 1
+
+    def _abandon(self, w: _Waiter) -> None:
+        # ждущий ушёл (отмена); если слот ему уже передали — отдаём следующему
+        with self._lock:
+            if w.granted:
+                self._release_locked()
+            else:
+                self._waiters.remove(w)
+
+    def _enter(self, waited: float) -> None:
+        with self._lock:
+            self.running += 1
+            metrics.set_gauge("latex.compiles_running", self.running)
+        metrics.observe("latex.queue_wait_ms", waited * 1000.0)
+
+    def _exit(self, t0: float) -> None:
+        metrics.observe("latex.run_ms", (time.perf_counter() - t0) * 1000.0)
+        with self._lock:
+            self.running -= 1
+            metrics.set_gauge("latex.compiles_running", self.running)
+        self._release()
+
+    @contextmanager
+    def slot(self, cancel: Optional[CancelToken] = None, report: Optional[dict] = None):
+        t0 = time.perf_counter()
+        ev = threading.Event()
+        w = self._acquire(ev.set)
+        if w is not None:
+            try:
+                while not ev.wait(0.1):
+                    check(cancel)
+            except BaseException:
+                self._abandon(w)
+                raise
+        waited = time.perf_counter() - t0
+        self._enter(waited)
+        t1 = time.perf_counter()
+        try:
+            check(cancel)
+            yield
+        finally:
+            self._exit(t1)
+            _note(report, waited, t1)
+
+    @asynccontextmanager
+    async def aslot(self, cancel: Optional[CancelToken] = None, report: Optional[dict] = None):
+        t0 = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        # слот может освободиться в другом потоке (slot/другой loop)
+        w = self._acquire(lambda: loop.call_soon_threadsafe(_resolve, fut))
+        if w is not None:
+            try:
+                while not fut.done():
+                    check(cancel)
+                    await asyncio.wait((fut,), timeout=0.1)
+            except BaseException:
+                self._abandon(w)
+                raise
+        waited = time.perf_counter() - t0
+        self._enter(waited)
+        t1 = time.perf_counter()
+        try:
+            check(cancel)
+            yield
+        finally:
+            self._exit(t1)
+            _note(report, waited, t1)
+
+
+def _resolve(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(None)
+
+
+def _note(report: Optional[dict], waited: float, started: float) -> None:
+    if report is not None:
+        report["queue_ms"] = round(waited * 1000.0, 1)
+        report["run_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+
+
+_pool: Optional[CompilePool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> CompilePool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = CompilePool(settings.LATEX_MAX_CONCURRENCY or os.cpu_count() or 1)
+        return _pool
+
+
+def limited(cmd: list) -> list:
+    # RLIMIT_CPU/RLIMIT_AS ставит sh перед exec TeX, так что процесс ни мгновения не работает
+    # без них (prlimit после Popen оставлял такое окно); дети (pdflatex у latexmk) их наследуют.
+    # preexec_fn не берём: он небезопасен, когда в процессе есть потоки
+    if os.name != "posix" or not os.path.exists("/bin/sh"):
+        return cmd
+    sets = []
+    if settings.LATEX_CPU_LIMIT_SEC > 0:
+        sets.append(f"ulimit -t {settings.LATEX_CPU_LIMIT_SEC}")
+    if settings.LATEX_MEM_LIMIT_MB > 0:
+        sets.append(f"ulimit -v {settings.LATEX_MEM_LIMIT_MB * 1024}")
+    if not sets:
+        return cmd
+    script = "".join(f"{s} 2>/dev/null; " for s in sets) + 'exec "$@"'
+    return ["/bin/sh", "-c", script, "tex", *cmd]
+
+
+@contextmanager
+def scratch_dir(prefix: str = "tex_"):
+    root = settings.LATEX_SCRATCH_DIR or None
+    if root:
+        os.makedirs(root, exist_ok=True)
+    d = Path(tempfile.mkdtemp(prefix=prefix, dir=root))
+    try:
+        yield d
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+@contextmanager
+def scratch(tex_path: Path):
+    # копия исходника в пустой папке; наружу — только то, что вернёт вызывающий
+    with scratch_dir() as d:
+        dst = d / tex_path.name
+        shutil.copyfile(tex_path, dst)
+        yield dst
+
+
+def export(src: Path, dst_dir: Path) -> Path:
+    dst = dst_dir / src.name
+    shutil.copyfile(src, dst)
+    return dst
@@ -0,0 +1,120 @@
+import json, struct
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# Один файл на страницу со всеми кропами вместо сотни raw_block_NNN.png.
+#
+#   MAGIC | crop0 bytes | pad | crop1 bytes | pad | ... | JSON index | u64 index_offset | MAGIC
+#
+# Кропы лежат сырыми массивами с выравниванием ALIGN, индекс в конце
+# (писать можно потоково). Читается через np.memmap: get() отдаёт view
+# без копирования.
+
+MAGIC = b"N2TCROP1"
+ALIGN = 64
+_TRAILER = struct.Struct("<Q8s")
+
+
+def _pad(n: int) -> int:
+    return (-n) % ALIGN
+
+
+class CropStoreWriter:
+    def __init__(self, path: str | Path, page_size: Optional[Tuple[int, int]] = None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._f = open(self.path, "wb")
+        self._f.write(MAGIC)
+        self._f.write(b"\0" * _pad(len(MAGIC)))
+        self._pos = len(MAGIC) + _pad(len(MAGIC))
+        self._items: List[dict] = []
+        self._page_size = list(page_size) if page_size else None
+
+    def add(self, idx: int, arr: np.ndarray, bbox=None, cls: Optional[str] = None) -> str:
+        a = np.ascontiguousarray(arr)
+        self._f.write(memoryview(a).cast("B"))
+        self._items.append({
+            "idx": int(idx), "cls": cls,
+            "bbox": [int(v) for v in bbox] if bbox is not None else None,
+            "offset": self._pos, "shape": list(a.shape), "dtype": a.dtype.str,
+        })
+        self._pos += a.nbytes
+        pad = _pad(self._pos)
+        if pad:
+            self._f.write(b"\0" * pad)
+            self._pos += pad
+        return ref(self.path, idx)
+
+    def close(self) -> str:
+        if self._f.closed:
+            return str(self.path)
+        index = json.dumps({"version": 1, "page": self._page_size, "items": self._items}).encode("utf-8")
+        self._f.write(index)
+        self._f.write(_TRAILER.pack(self._pos, MAGIC))
+        self._f.close()
+        return str(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CropStore:
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        size = self.path.stat().st_size
+        with open(self.path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"not a crop store: {self.path}")
+            f.seek(size - _TRAILER.size)
+            index_offset, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+            if magic != MAGIC:
+                raise ValueError(f"truncated crop store: {self.path}")
+            f.seek(index_offset)
+            self.index = json.loads(f.read(size - _TRAILER.size - index_offset))
+        self._by_idx = {it["idx"]: it for it in self.index["items"]}
+        self._mm = np.memmap(self.path, dtype=np.uint8, mode="r") if self.index["items"] else None
+
+    def __len__(self) -> int:
+        return len(self._by_idx)
+
+    def __contains__(self, idx: int) -> bool:
+        return idx in self._by_idx
+
+    def meta(self, idx: int) -> dict:
+        return self._by_idx[idx]
+
+    def get(self, idx: int) -> np.ndarray:
+        it = self._by_idx[idx]
+        dt = np.dtype(it["dtype"])
+        n = int(np.prod(it["shape"])) * dt.itemsize
+        return self._mm[it["offset"]:it["offset"] + n].view(dt).reshape(it["shape"])
+
+    def items(self) -> Iterator[Tuple[dict, np.ndarray]]:
+        for it in self.index["items"]:
+            yield it, self.get(it["idx"])
+
+    def close(self) -> None:
+        self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def ref(path: str | Path, idx: int) -> str:
+    return f"{path}#{int(idx):03d}"
+
+
+def write_page_crops(path: str | Path, page_rgb: np.ndarray, boxes) -> str:
+    H, W = page_rgb.shape[:2]
+    with CropStoreWriter(path, page_size=(W, H)) as w:
+        for idx, (x1, y1, x2, y2, name) in enumerate(boxes, start=1):
+            w.add(idx, page_rgb[y1:y2, x1:x2], bbox=(x1, y1, x2, y2), cls=name)
+    return str(path)
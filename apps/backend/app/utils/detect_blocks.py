@@ -5,6 +5,10 @@ import cv2
 import torch
 from ultralytics import YOLO
 
+from app.utils.crop_store import write_page_crops, ref as crop_ref
+from app.utils.assemble_latex import reading_order
+from app.utils.reading_order import column_gutters
+
 ID2NAME = {0: "formula", 1: "other", 2: "table", 3: "text_line"}
 
 
@@ -21,37 +25,48 @@ def _xyxy_to_int_box(xyxy, W, H, pad=0.0):
 
 
 def _sort_boxes_tblr(boxes):
-    return sorted(boxes, key=lambda b: (b[1] // 50, b[1], b[0]))
+    # тот же порядок, что у build_mixed_document (группы и строки), — idx блоков
+    # идут в порядке документа; гаттеры ищем один раз
+    xyxy = [b[:4] for b in boxes]
+    return [boxes[i] for i in reading_order(xyxy, column_gutters(xyxy))]
 
 
-def detect_blocks(
-        image_path: str,
+def load_detector(yolo_weights: str = "models/detector/best.pt"):
+    model = YOLO(yolo_weights)
+    model.model.names = ID2NAME
+    return model
+
+
+def _read_page(image_path, image=None):
+    if image is not None:
+        return image
+    src = Path(image_path)
+    assert src.exists(), f"File not found: {src}"
+    page = cv2.imread(str(src), cv2.IMREAD_COLOR)
+    assert page is not None, f"Cannot read image: {src}"
+    return page
+
+
+def predict_boxes(
+        image_path: str = None,
         yolo_weights: str = "models/detector/best.pt",
         conf: float = 0.25,
         iou: float = 0.5,
         imgsz: int = 1280,
         pad: float = 0.04,
-        temp_dir: str = "temp",
-        save_viz: bool = True,
+        image=None,
+        model=None,
 ):
-    src = Path(image_path)
-    assert src.exists(), f"File not found: {src}"
-
-    tdir = Path(temp_dir)
-    if tdir.exists():
-        shutil.rmtree(tdir)
-    (tdir).mkdir(parents=True, exist_ok=True)
-
-    page = cv2.imread(str(src), cv2.IMREAD_COLOR)
-    assert page is not None, f"Cannot read image: {src}"
+    # image — уже декодированная страница (BGR), model — загруженный детектор
+    page = _read_page(image_path, image)
     H, W = page.shape[:2]
 
     device = "0" if torch.cuda.is_available() else "cpu"
-    model = YOLO(yolo_weights)
-    model.model.names = ID2NAME
+    if model is None:
+        model = load_detector(yolo_weights)
 
     rlist = model.predict(
-        source=str(src),
+        source=page if image is not None else str(image_path),
         conf=conf,
         iou=iou,
         imgsz=imgsz,
@@ -76,19 +91,39 @@ def detect_blocks(
             xi, yi, xa, ya = _xyxy_to_int_box(xyxy, W, H, pad=pad)
             boxes.append((xi, yi, xa, ya, name))
 
+    return _sort_boxes_tblr(boxes)
+
+
+def cut_crops(
+        image_path: str,
+        boxes,
+        temp_dir: str = "temp",
+        save_viz: bool = True,
+        image=None,
+):
+    src = Path(image_path)
+    tdir = Path(temp_dir)
+    if tdir.exists():
+        shutil.rmtree(tdir)
+    (tdir).mkdir(parents=True, exist_ok=True)
+
     if not boxes:
         print("[detect] No blocks found")
         return []
 
-    boxes = _sort_boxes_tblr(boxes)
+    page = _read_page(image_path, image)
+
+    # все кропы страницы одним файлом (RGB, как при чтении png через PIL)
+    store_path = str(tdir / "page.crops")
+    write_page_crops(store_path, cv2.cvtColor(page, cv2.COLOR_BGR2RGB), boxes)
 
     results = []
-    page_viz = page.copy()
+    page_viz = page.copy() if save_viz else None
     for idx, (x1, y1, x2, y2, name) in enumerate(boxes, start=1):
-        crop = page[y1:y2, x1:x2, :]
-        out_path = tdir / f"raw_block_{idx:03d}.png"
-        cv2.imwrite(str(out_path), crop)
-        results.append({"idx": idx, "bbox": (x1, y1, x2, y2), "crop_path": str(out_path), "cls": name})
+        results.append({
+            "idx": idx, "bbox": (x1, y1, x2, y2), "cls": name,
+            "crop_path": crop_ref(store_path, idx), "crop_store": store_path,
+        })
         if save_viz:
             color = (0, 255, 0) if name == "formula" else (255, 0, 0)
             cv2.rectangle(page_viz, (x1, y1), (x2, y2), color, 2)
@@ -101,3 +136,17 @@ def detect_blocks(
 
     print(f"[detect] {len(results)} blocks, crops in: {Path(temp_dir).resolve()}")
     return results
+
+
+def detect_blocks(
+        image_path: str,
+        yolo_weights: str = "models/detector/best.pt",
+        conf: float = 0.25,
+        iou: float = 0.5,
+        imgsz: int = 1280,
+        pad: float = 0.04,
+        temp_dir: str = "temp",
+        save_viz: bool = True,
+):
+    boxes = predict_boxes(image_path, yolo_weights=yolo_weights, conf=conf, iou=iou, imgsz=imgsz, pad=pad)
+    return cut_crops(image_path, boxes, temp_dir=temp_dir, save_viz=save_viz)
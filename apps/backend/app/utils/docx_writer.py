@@ -0,0 +1,167 @@
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.utils import omml
+from app.utils.assemble_latex import HEADER, _reading_lines, _unescape_text
+from app.utils.latex_format import split_preamble
+from app.utils.latex_validate import validate_formula
+
+# DOCX без pandoc. Наши документы устроены просто (build_mixed_document):
+# строка = абзац из текста, \(..\) и \[..\], плюс %-комментарии. Такой
+# документ пишем сами через python-docx, формулы — в OMML (omml.py),
+# Word показывает их как родные. Для распознанной страницы берём прямо
+# список блоков, для поправленного tex — разбираем его; tex, вышедший за
+# эти рамки (свои команды, окружения, преамбула), отдаём pandoc.
+#
+# Абзац — список кусков (kind, text):
+#   text / italic — обычный текст, math — формула в строке,
+#   display — выключенная формула, code / center — формула, не прошедшая
+#   проверку (моноширинным текстом, как в pdf; center — отдельной строкой).
+
+Paragraph = List[Tuple[str, str]]
+
+_MONO = "Courier New"
+
+
+def paragraphs_from_blocks(blocks: List[Dict[str, Any]], validate: bool = True) -> List[Paragraph]:
+    # blocks — как в результате пайплайна: idx, kind, content, bbox (и issues, если формулу уже проверили)
+    norm = [
+        {"idx": b["idx"], "kind": b["kind"], "content": b.get("content") or "",
+         "bbox": tuple(float(v) for v in b["bbox"]), "issues": b.get("issues")}
+        for b in blocks
+    ]
+
+    def invalid(b: Dict[str, Any], content: str) -> bool:
+        if not validate:
+            return False
+        return bool(b["issues"]) if b["issues"] is not None else bool(validate_formula(content))
+
+    out: List[Paragraph] = []
+    for line in _reading_lines(norm):
+        if len(line) == 1 and line[0]["kind"] == "formula":
+            f = line[0]["content"].strip()
+            if f:
+                out.append([("center" if invalid(line[0], f) else "display", f)])
+            continue
+        para: Paragraph = []
+        for b in line:
+            content = b["content"].strip() if b["kind"] == "formula" else b["content"]
+            if not content:
+                continue
+            if para:
+                para.append(("text", " "))
+            if b["kind"] != "formula":
+                para.append(("text", re.sub(r"\s+", " ", content)))
+            else:
+                para.append(("code" if invalid(b, content) else "math", content))
+        if para:
+            out.append(_merge(para))
+    return out or [[("italic", "Нет блоков.")]]
+
+
+def _merge(para: Paragraph) -> Paragraph:
+    out: Paragraph = []
+    for kind, value in para:
+        if kind == "text" and out and out[-1][0] == "text":
+            out[-1] = ("text", out[-1][1] + value)
+        else:
+            out.append((kind, value))
+    return out
+
+
+_HEAD_RE = re.compile(r"\\title\{[^{}\\]*\}\s*\\date\{\}\s*\\begin\{document\}")
+# служебные строки HEADER после \begin{document}
+_SETUP = [ln for ln in HEADER.split("\\begin{document}", 1)[1].splitlines() if ln.strip()]
+_TT = r"((?:\\[A-Za-z]+\{\}|\\[^A-Za-z]|[^{}\\])*)"
+_SEGMENT_RE = re.compile(
+    r"\\\[(?P<display>.*?)\\\]"
+    r"|\\begin\{center\}\\texttt\{" + _TT.replace("(", "(?P<center>", 1) + r"\}\\end\{center\}"
+    r"|\\\((?P<math>.*?)\\\)"
+    r"|\\texttt\{" + _TT.replace("(", "(?P<code>", 1) + r"\}"
+    r"|\\textit\{" + _TT.replace("(", "(?P<italic>", 1) + r"\}",
+    re.S,
+)
+# что может остаться в тексте после latex_escape_text
+_TEXT_ESCAPE_RE = re.compile(r"\\(?:textbackslash|textasciitilde|textasciicircum|textquotedbl)\{\}|\\[&%$#_{}]|\\,")
+
+
+def _plain(text: str) -> Optional[str]:
+    # текст между формулами; None — в нём разметка, которую мы не пишем сами
+    if re.search(r"[\\{}$&#^_~%]", _TEXT_ESCAPE_RE.sub("", text)):
+        return None
+    return re.sub(r"\s+", " ", _unescape_text(text.replace("\\,", " ")))
+
+
+def _close(para: Paragraph, out: List[Paragraph]) -> None:
+    para = _merge(para)
+    if para and para[0][0] == "text":
+        para[0] = ("text", para[0][1].lstrip())
+    if para and para[-1][0] == "text":
+        para[-1] = ("text", para[-1][1].rstrip())
+    para = [(k, v) for k, v in para if k != "text" or v]
+    if para:
+        out.append(para)
+
+
+def paragraphs_from_tex(tex: str) -> Optional[List[Paragraph]]:
+    # None — tex не из подмножества build_mixed_document, нужен pandoc
+    rest = split_preamble(tex)
+    if rest is None:
+        return None
+    head = _HEAD_RE.match(rest)
+    end = rest.rfind("\\end{document}")
+    if head is None or end < 0 or rest[end + len("\\end{document}"):].strip():
+        return None
+    lines = [ln for ln in rest[head.end():end].splitlines()
+             if not ln.lstrip().startswith("%") and ln.strip() not in _SETUP]
+    out: List[Paragraph] = []
+    for chunk in re.split(r"\n\s*\n", "\n".join(lines)):
+        para: Paragraph = []
+        pos = 0
+        for m in _SEGMENT_RE.finditer(chunk):
+            text = _plain(chunk[pos:m.start()])
+            if text is None:
+                return None
+            para.append(("text", text))
+            kind = m.lastgroup
+            value = m.group(kind).strip() if kind in ("display", "math") else _unescape_text(m.group(kind))
+            if kind in ("display", "center"):
+                _close(para, out)
+                out.append([(kind, value)])
+                para = []
+            else:
+                para.append((kind, value))
+            pos = m.end()
+        text = _plain(chunk[pos:])
+        if text is None:
+            return None
+        para.append(("text", text))
+        _close(para, out)
+    return out
+
+
+def write_docx(paragraphs: List[Paragraph], out_path: str | Path) -> str:
+    from docx import Document
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+
+    doc = Document()
+    for para in paragraphs:
+        p = doc.add_paragraph()
+        if len(para) == 1 and para[0][0] in ("display", "center"):
+            p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        for kind, value in para:
+            if kind == "math":
+                p._p.append(omml.math(value))
+            elif kind == "display":
+                p._p.append(omml.math_para(value))
+            else:
+                run = p.add_run(value)
+                if kind == "italic":
+                    run.italic = True
+                elif kind in ("code", "center"):
+                    run.font.name = _MONO
+    out = Path(out_path)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    doc.save(str(out))
+    return str(out)
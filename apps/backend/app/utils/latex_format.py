@@ -0,0 +1,121 @@
+import hashlib, os, shutil, subprocess, tempfile, threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from app.config import settings
+from app.utils.assemble_latex import HEADER
+
+# Предкомпилированный формат для нашей стандартной преамбулы. Почти всё
+# время pdflatex на одностраничном документе уходит на загрузку amsmath,
+# lmodern, babel[russian] и т.д. Дампим их один раз:
+#
+#   pdflatex -ini -jobname=<name> "&pdflatex" <name>.ini.tex   (преамбула + \dump)
+#
+# и дальше компилируем документ без преамбулы с -fmt=<name>. Имя формата —
+# хэш преамбулы и версии движка: после обновления TeX формат пересоберётся.
+# Документ с другой преамбулой собирается как раньше.
+#
+# Заранее (при сборке образа): python -m app.utils.latex_format
+
+# неизменная часть HEADER: до \title, который у каждого документа свой
+PREAMBLE = HEADER[:HEADER.index(r"\title{")]
+
+_lock = threading.Lock()
+_failed: set[str] = set()  # не удалось собрать — не пытаемся на каждой компиляции
+
+
+def format_dir() -> Path:
+    return Path(settings.LATEX_FORMAT_DIR or Path(settings.TEMP_DIR) / "latex-fmt")
+
+
+@lru_cache(maxsize=8)
+def tool_version(exe: str) -> str:
+    # первая строка --version: pdfTeX, pandoc — часть ключей формата и кэша сборок
+    try:
+        out = subprocess.run([exe, "--version"], capture_output=True, text=True, timeout=30).stdout
+        return out.splitlines()[0] if out else ""
+    except Exception:
+        return ""
+
+
+def format_name(engine_path: str) -> str:
+    h = hashlib.sha1((PREAMBLE + "\0" + tool_version(engine_path)).encode("utf-8")).hexdigest()
+    return f"note2tex-{h[:12]}"
+
+
+def split_preamble(text: str) -> Optional[str]:
+    # тело документа без стандартной преамбулы; None — преамбула другая
+    stripped = text.lstrip("\ufeff \t\r\n")
+    if not stripped.startswith(PREAMBLE):
+        return None
+    return stripped[len(PREAMBLE):]
+
+
+def with_format_path(env: dict) -> dict:
+    # kpathsea: пустой элемент в конце — «и стандартные пути»
+    env = dict(env)
+    env["TEXFORMATS"] = f"{format_dir()}{os.pathsep}{env.get('TEXFORMATS', '')}"
+    return env
+
+
+def ensure_format(engine_path: str, env: dict, timeout: int = 120) -> Optional[str]:
+    # имя готового формата; None — собрать не вышло (компилируем как обычно)
+    if not settings.LATEX_PRECOMPILED_FORMAT:
+        return None
+    name = format_name(engine_path)
+    if name in _failed:
+        return None
+    target = format_dir() / f"{name}.fmt"
+    if target.exists():
+        return name
+    with _lock:
+        if target.exists():
+            return name
+        if build_format(engine_path, env, timeout) is None:
+            _failed.add(name)
+            return None
+    return name
+
+
+def build_format(engine_path: str, env: dict, timeout: int = 120) -> Optional[Path]:
+    name = format_name(engine_path)
+    out_dir = format_dir()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    # собираем во временной папке и переносим атомарно: параллельные воркеры не увидят недописанный .fmt
+    with tempfile.TemporaryDirectory(prefix="fmt_", dir=out_dir) as tmp:
+        ini = Path(tmp) / f"{name}.ini.tex"
+        ini.write_text(PREAMBLE + "\\dump\n", encoding="utf-8")
+        try:
+            p = subprocess.run(
+                [engine_path, "-ini", "-interaction=nonstopmode", "-halt-on-error",
+                 f"-jobname={name}", "&pdflatex", ini.name],
+                cwd=tmp, env=env, capture_output=True, timeout=timeout,
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            print(f"[latex] format build failed: {e}")
+            return None
+        built = Path(tmp) / f"{name}.fmt"
+        if p.returncode != 0 or not built.exists():
+            print(f"[latex] format build failed (exit {p.returncode}):\n{p.stdout.decode(errors='replace')[-2000:]}")
+            return None
+        target = out_dir / f"{name}.fmt"
+        os.replace(built, target)
+    print(f"[latex] built format {target}")
+    return target
+
+
+def main():
+    from app.utils.latex_to_pdf import _extend_path
+    env = _extend_path(os.environ.copy())
+    engine = shutil.which("pdflatex", path=env.get("PATH"))
+    if not engine:
+        raise SystemExit("pdflatex not found")
+    path = build_format(engine, env)
+    if path is None:
+        raise SystemExit(1)
+    print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,18 @@
+import asyncio
 import os
+import re
 import shutil
 import subprocess
 import tempfile
+import time
 from pathlib import Path
 from typing import Optional, Tuple
 
+from app import metrics, tex_cache
+from app.cancellation import CancelToken, Cancelled, check, kill_process_group, kill_process_tree
+from app.utils import compile_pool
+from app.utils.latex_format import ensure_format, split_preamble, tool_version, with_format_path
+
 MIKTEX_CANDIDATES = [
     r"C:\Program Files\MiKTeX\miktex\bin\x64",
     r"C:\Program Files\MiKTeX 2.9\miktex\bin\x64",
@@ -31,89 +39,337 @@ def _extend_path(env: dict) -> dict:
 def _which(cmd: str, env: Optional[dict] = None) -> Optional[str]:
     return shutil.which(cmd, path=env.get("PATH") if env else None)
 
-def _run(cmd: list, cwd: Path, env: dict, timeout: int) -> Tuple[int, str, str]:
+def _run(cmd: list, cwd: Path, env: dict, timeout: int, cancel: Optional[CancelToken] = None,
+         limits: bool = False) -> Tuple[int, str, str]:
+    # limits — RLIMIT_CPU/RLIMIT_AS для TeX (не для pandoc: GHC резервирует огромное адресное пространство)
+    check(cancel)
     p = subprocess.Popen(
-        cmd,
+        compile_pool.limited(cmd) if limits else cmd,
         cwd=str(cwd),
         env=env,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         shell=False,
         creationflags=subprocess.CREATE_NO_WINDOW if hasattr(subprocess, "CREATE_NO_WINDOW") else 0,
+        start_new_session=os.name == "posix",  # своя группа: при отмене убиваем latexmk вместе с pdflatex
     )
-    out, err = p.communicate(timeout=timeout)
+    detach = cancel.attach_process(p) if cancel is not None else (lambda: None)
+    try:
+        out, err = p.communicate(timeout=cancel.bound(timeout) if cancel is not None else timeout)
+    except subprocess.TimeoutExpired:
+        kill_process_tree(p)
+        p.communicate()
+        check(cancel)  # упёрлись в срок задачи, а не в таймаут команды
+        raise
+    finally:
+        detach()
+    check(cancel)
     return p.returncode, out.decode(errors="replace"), err.decode(errors="replace")
 
-def _compile_common(tex_path: Path, engine: str, timeout: int) -> Path:
-    tex_path = Path(tex_path)
-    assert tex_path.exists(), f"TeX file not found: {tex_path}"
-    work = tex_path.parent
-    jobname = tex_path.stem
-    pdf_path = work / f"{jobname}.pdf"
-    log_path = work / f"{jobname}.log"
+async def run_command_async(cmd: list, cwd: Path, env: dict, timeout: int, cancel: Optional[CancelToken] = None,
+                            limits: bool = False) -> Tuple[int, str, str]:
+    # то же, что _run, но не держит поток: для кода, живущего в event loop
+    check(cancel)
+    p = await asyncio.create_subprocess_exec(
+        *(compile_pool.limited(cmd) if limits else cmd),
+        cwd=str(cwd),
+        env=env,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=os.name == "posix",
+    )
+    detach = cancel.on_cancel(lambda: kill_process_group(p.pid)) if cancel is not None else (lambda: None)
+    try:
+        out, err = await asyncio.wait_for(p.communicate(), timeout=cancel.bound(timeout) if cancel is not None else timeout)
+    except asyncio.TimeoutError:
+        if p.returncode is None:
+            kill_process_group(p.pid)
+            await p.wait()
+        check(cancel)
+        raise
+    except BaseException:
+        # таймаут или отмена корутины: процесс не должен пережить задачу
+        if p.returncode is None:
+            kill_process_group(p.pid)
+            await p.wait()
+        raise
+    finally:
+        detach()
+    check(cancel)
+    return p.returncode, out.decode(errors="replace"), err.decode(errors="replace")
 
-    base_env = os.environ.copy()
-    env = _extend_path(base_env)
-    engine = engine.lower().strip()
+# Проходы компиляции. Наши документы без ссылок, оглавления и меток:
+# одного прохода pdflatex хватает почти всегда. Поэтому без latexmk и без
+# слепых трёх прогонов: после каждого прохода смотрим .log (просьбы
+# «Rerun ...») и .aux (изменились ли метки/ссылки) и решаем, нужен ли ещё.
+# latexmk остаётся для документов с библиографией/индексом (bibtex,
+# makeindex) и на случай, если самого движка нет в PATH.
 
-    latexmk = _which("latexmk", env)
-    eng_path = _which(engine, env)
-    ok = False
-    last_out, last_err = "", ""
+MAX_PASSES = 3
+_XREF_RE = re.compile(r"\\(?:ref|eqref|pageref|autoref|cref|Cref|label|cite\w*|tableofcontents|listof\w+|nameref)\b")
+_EXTERNAL_RE = re.compile(r"\\(?:bibliography|printbibliography|addbibresource|makeindex|printindex|makeglossaries)\b")
+_RERUN_RE = re.compile(
+    r"(Rerun to get [\w\s-]+right|Label\(s\) may have changed|Please rerun LaTeX|Rerun LaTeX"
+    r"|\(rerunfilecheck\)\s+Rerun)"
+)
+_AUX_KEYS = ("\\newlabel", "\\bibcite", "\\@writefile", "\\contentsline")
 
-    print("compilation...")
 
+def _aux_state(aux: Path) -> frozenset:
+    # только то, от чего зависит следующий проход: метки, цитаты, оглавление
     try:
-        if latexmk:
-            cmd = [
+        lines = aux.read_text(encoding="utf-8", errors="replace").splitlines()
+    except OSError:
+        return frozenset()
+    return frozenset(l for l in lines if l.startswith(_AUX_KEYS))
+
+
+class _Plan:
+    def __init__(self, tex_path: Path, engine: str):
+        self.tex_path = Path(tex_path)
+        assert self.tex_path.exists(), f"TeX file not found: {self.tex_path}"
+        self.work = self.tex_path.parent
+        jobname = self.tex_path.stem
+        self.pdf_path = self.work / f"{jobname}.pdf"
+        self.log_path = self.work / f"{jobname}.log"
+        self.aux_path = self.work / f"{jobname}.aux"
+        # по наличию pdf судим об успехе прохода: старый от прошлой сборки мешает
+        self.pdf_path.unlink(missing_ok=True)
+
+        self.env = _extend_path(os.environ.copy())
+        engine = engine.lower().strip()
+        try:
+            source = self.tex_path.read_text(encoding="utf-8")
+        except (OSError, UnicodeDecodeError):
+            source = ""
+        self.xrefs = bool(_XREF_RE.search(source))
+
+        latexmk = _which("latexmk", self.env)
+        eng_path = _which(engine, self.env)
+        self.latexmk = bool(latexmk) and (not eng_path or bool(_EXTERNAL_RE.search(source)))
+        if self.latexmk:
+            self.cmd = [
                 latexmk,
                 "-interaction=nonstopmode",
-                f"-pdflatex={engine} -interaction=nonstopmode -halt-on-error -file-line-error",
+                f"-pdflatex={engine} -interaction=nonstopmode -halt-on-error -file-line-error -no-shell-escape",
                 "-pdf",
                 f"-jobname={jobname}",
-                tex_path.name,
+                self.tex_path.name,
             ]
-            code, out, err = _run(cmd, cwd=work, env=env, timeout=timeout)
-            last_out, last_err = out, err
-            ok = (code == 0) and pdf_path.exists()
         else:
             if not eng_path:
                 raise RuntimeError(
                     "Не найден latexmk и не найден движок "
                     f"'{engine}' в PATH. Установите MiKTeX/TeX Live и добавьте в PATH."
                 )
-            cmd = [
+            self.cmd = [
                 eng_path,
                 "-interaction=nonstopmode",
                 "-halt-on-error",
                 "-file-line-error",
-                tex_path.name,
+                "-no-shell-escape",  # \write18 из пользовательского TeX не запускает команды
+                self.tex_path.name,
             ]
-            for _ in range(3):
-                code, out, err = _run(cmd, cwd=work, env=env, timeout=timeout)
-                last_out, last_err = out, err
-                if pdf_path.exists():
-                    ok = True
-                    break
-
-        if not ok:
-            tail = ""
-            if log_path.exists():
-                try:
-                    lines = log_path.read_text(encoding="utf-8", errors="replace").splitlines()
-                    tail = "\n".join(lines[-80:])
-                except Exception as e:
-                    pass
-            raise RuntimeError(
-                "Компиляция LaTeX → PDF не удалась.\n\n"
-                f"STDOUT:\n{last_out[-2000:]}\n\nSTDERR:\n{last_err[-2000:]}\n\n"
-                f"log tail ({log_path.name}):\n{tail}"
-            )
-        return pdf_path
-    except Exception as e:
-        if pdf_path.exists() and pdf_path.stat().st_size > 0:
-            return pdf_path
-        raise
+        self.engine = "latexmk" if self.latexmk else engine
+        self.fmt_env = self.env
+        self.fmt_cmd = self._format_cmd(engine, latexmk if self.latexmk else None, eng_path, source, jobname)
+
+        self.ok = False
+        self.pass_ms: list[float] = []
+        self.reruns: list[str] = []  # почему понадобился каждый следующий проход
+        self.fell_back = False
+        self.last_out, self.last_err = "", ""  # вывод последнего прохода — для сообщения об ошибке
+        self._aux_before = _aux_state(self.aux_path)
+
+    def _format_cmd(self, engine: str, latexmk: Optional[str], eng_path: Optional[str], source: str,
+                    jobname: str) -> Optional[list]:
+        # документ со стандартной преамбулой: тело отдельно, преамбула — из готового формата
+        if engine != "pdflatex" or not eng_path:
+            return None
+        body = split_preamble(source)
+        if body is None:
+            return None
+        name = ensure_format(eng_path, self.env)
+        if name is None:
+            return None
+        body_path = self.work / f"{jobname}.body.tex"
+        body_path.write_text(body, encoding="utf-8")
+        self.fmt_env = with_format_path(self.env)
+        if latexmk:
+            return [
+                latexmk,
+                "-interaction=nonstopmode",
+                f"-pdflatex={engine} -fmt={name} -interaction=nonstopmode -halt-on-error -file-line-error -no-shell-escape",
+                "-pdf",
+                f"-jobname={jobname}",
+                body_path.name,
+            ]
+        return [eng_path, f"-fmt={name}", "-interaction=nonstopmode", "-halt-on-error",
+                "-file-line-error", "-no-shell-escape", f"-jobname={jobname}", body_path.name]
+
+    def first(self) -> tuple[list, dict]:
+        if self.fmt_cmd is not None:
+            return self.fmt_cmd, self.fmt_env
+        return self.cmd, self.env
+
+    def next(self, code: int, elapsed: float, out: str = "", err: str = "") -> Optional[tuple[list, dict]]:
+        # учитывает прошедший проход; (cmd, env) следующего или None — хватит
+        self.pass_ms.append(elapsed * 1000.0)
+        self.last_out, self.last_err = out, err
+        produced = self.pdf_path.exists() and (code == 0 or not self.latexmk)
+        using_fmt = self.fmt_cmd is not None and not self.fell_back
+        if not produced:
+            if using_fmt:
+                # формат не подошёл (устарел, сломан) — обычная сборка
+                print("[latex] precompiled format failed, compiling with full preamble")
+                metrics.inc("latex.fmt_fallback")
+                self.fell_back = True
+                return self.cmd, self.env
+            return None  # ошибка в документе: повтор того же прохода её не исправит
+        if self.latexmk:
+            self.ok = True  # проходы считает сам latexmk
+            return None
+        reason = self._rerun_reason()
+        if reason is None or len(self.pass_ms) >= MAX_PASSES:
+            self.ok = True
+            return None
+        self.reruns.append(reason)
+        return (self.fmt_cmd, self.fmt_env) if using_fmt else (self.cmd, self.env)
+
+    def _rerun_reason(self) -> Optional[str]:
+        aux = _aux_state(self.aux_path)
+        changed, self._aux_before = aux != self._aux_before, aux
+        try:
+            m = _RERUN_RE.search(self.log_path.read_text(encoding="utf-8", errors="replace"))
+        except OSError:
+            m = None
+        if m:
+            return f"log: {m.group(1)}"
+        if self.xrefs and changed:
+            return "aux changed"
+        return None
+
+    def report(self) -> dict:
+        return {
+            "passes": len(self.pass_ms), "pass_ms": [round(ms, 1) for ms in self.pass_ms],
+            "reruns": self.reruns, "engine": self.engine,
+            "format": self.fmt_cmd is not None and not self.fell_back, "cached": False,
+        }
+
+    def failure(self, last_out: str, last_err: str) -> RuntimeError:
+        tail = ""
+        if self.log_path.exists():
+            try:
+                lines = self.log_path.read_text(encoding="utf-8", errors="replace").splitlines()
+                tail = "\n".join(lines[-80:])
+            except OSError:
+                pass
+        return RuntimeError(
+            "Компиляция LaTeX → PDF не удалась.\n\n"
+            f"STDOUT:\n{last_out[-2000:]}\n\nSTDERR:\n{last_err[-2000:]}\n\n"
+            f"log tail ({self.log_path.name}):\n{tail}"
+        )
+
+    def salvage(self) -> Optional[Path]:
+        if self.pdf_path.exists() and self.pdf_path.stat().st_size > 0:
+            return self.pdf_path
+        return None
+
+def _pdf_cache_key(tex_path: Path, engine: str) -> Optional[str]:
+    if not tex_cache.enabled():
+        return None
+    eng = _which(engine, _extend_path(os.environ.copy()))
+    return tex_cache.key(tex_path, f"pdf:{engine}:{tool_version(eng) if eng else ''}")
+
+def _finish(plan: _Plan, report: Optional[dict]) -> None:
+    rep = plan.report()
+    metrics.observe("latex.passes", rep["passes"])
+    for ms in rep["pass_ms"]:
+        metrics.observe("latex.pass_ms", ms)
+    if plan.reruns:
+        metrics.inc("latex.reruns")
+    if report is not None:
+        report.update(rep)
+
+def _cache_hit(report: Optional[dict]) -> None:
+    metrics.observe("latex.passes", 0)
+    if report is not None:
+        report.update(passes=0, pass_ms=[], reruns=[], engine=None, format=False, cached=True)
+
+def _lookup(tex_path: Path, engine: str, report: Optional[dict]) -> tuple[Optional[str], Optional[Path]]:
+    # ключ кэша и готовый pdf, если такой документ уже собирали
+    ck = _pdf_cache_key(tex_path, engine)
+    if tex_cache.fetch(ck, "out.pdf", tex_path.with_suffix(".pdf")):
+        _cache_hit(report)
+        return ck, tex_path.with_suffix(".pdf")
+    return ck, None
+
+def _outcome(plan: _Plan, ck: Optional[str], tex_path: Path, error: Optional[Exception] = None) -> Path:
+    # итог проходов (общий для sync и async): удачный pdf — в кэш и рядом с исходником;
+    # при ошибке — то, что успело собраться, иначе исключение с хвостом лога
+    if error is None and plan.ok:
+        tex_cache.store(ck, "out.pdf", plan.pdf_path)
+        return compile_pool.export(plan.pdf_path, tex_path.parent)
+    if plan.salvage():
+        return compile_pool.export(plan.pdf_path, tex_path.parent)
+    raise error if error is not None else plan.failure(plan.last_out, plan.last_err)
+
+def _compile_common(tex_path: Path, engine: str, timeout: int, cancel: Optional[CancelToken] = None,
+                    report: Optional[dict] = None) -> Path:
+    ck, cached = _lookup(tex_path, engine, report)
+    if cached is not None:
+        return cached
+
+    print("compilation...")
+
+    with compile_pool.get_pool().slot(cancel, report), compile_pool.scratch(tex_path) as src:
+        plan = _Plan(src, engine)
+        try:
+            step = plan.first()
+            while step is not None:
+                t0 = time.perf_counter()
+                code, out, err = _run(step[0], cwd=plan.work, env=step[1], timeout=timeout, cancel=cancel, limits=True)
+                step = plan.next(code, time.perf_counter() - t0, out, err)
+        except Cancelled:
+            raise
+        except Exception as e:
+            return _outcome(plan, ck, tex_path, e)
+        finally:
+            _finish(plan, report)
+        return _outcome(plan, ck, tex_path)
+
+async def compile_tex_file_to_pdf_async(
+    tex_path: str | Path,
+    engine: str = "pdflatex",
+    timeout: int = 180,
+    cancel: Optional[CancelToken] = None,
+    report: Optional[dict] = None,
+) -> Path:
+    tex_path = Path(tex_path)
+    ck, cached = await asyncio.to_thread(_lookup, tex_path, engine, report)
+    if cached is not None:
+        return cached
+
+    print("compilation...")
+
+    async with compile_pool.get_pool().aslot(cancel, report):
+        with compile_pool.scratch(tex_path) as src:
+            # _Plan может собирать формат (секунды) — не в event loop
+            plan = await asyncio.to_thread(_Plan, src, engine)
+            try:
+                step = plan.first()
+                while step is not None:
+                    t0 = time.perf_counter()
+                    code, out, err = await run_command_async(step[0], cwd=plan.work, env=step[1], timeout=timeout,
+                                                             cancel=cancel, limits=True)
+                    step = await asyncio.to_thread(plan.next, code, time.perf_counter() - t0, out, err)
+            except Cancelled:
+                raise
+            except Exception as e:
+                return await asyncio.to_thread(_outcome, plan, ck, tex_path, e)
+            finally:
+                _finish(plan, report)
+            return await asyncio.to_thread(_outcome, plan, ck, tex_path)
 
 def compile_latex_to_pdf(
     latex_source: str,
@@ -144,5 +400,8 @@ def compile_tex_file_to_pdf(
     tex_path: str | Path,
     engine: str = "pdflatex",
     timeout: int = 180,
+    cancel: Optional[CancelToken] = None,
+    report: Optional[dict] = None,
 ) -> Path:
-    return _compile_common(Path(tex_path), engine=engine, timeout=timeout)
+    # report — если передан, сюда ляжет число проходов и время каждого
+    return _compile_common(Path(tex_path), engine=engine, timeout=timeout, cancel=cancel, report=report)
@@ -0,0 +1,195 @@
+import re
+from typing import Dict, List, Tuple
+
+# Быстрая проверка распознанной формулы до сборки документа. Одна битая
+# формула (лишняя скобка, выдуманная моделью команда) валит весь pdflatex,
+# и страница остаётся без pdf. Проверяем то, на чём pdflatex падает чаще
+# всего: баланс {}, \left/\right и окружений, числа аргументов у \frac и
+# компании, символы, которым не место в формуле. Непрошедшую формулу сборка
+# выводит как текст (см. assemble_latex.quarantine).
+#
+# Незнакомая команда — только предупреждение (formula_warnings): словарь не
+# полон, а в выдаче im2latex полно рабочего plain TeX (\over, \rm, \cal),
+# и прятать из-за этого верную формулу в \texttt хуже, чем рискнуть сборкой.
+
+# команды из LaTeX/amsmath/amssymb, которые встречаются в формулах (словарь TrOCR и im2latex)
+KNOWN_MACROS = frozenset("""
+alpha beta gamma delta epsilon varepsilon zeta eta theta vartheta iota kappa varkappa lambda mu nu xi
+omicron pi varpi rho varrho sigma varsigma tau upsilon phi varphi chi psi omega
+Gamma Delta Theta Lambda Xi Pi Sigma Upsilon Phi Psi Omega digamma
+frac dfrac tfrac cfrac binom dbinom tbinom sqrt root of
+sum prod coprod int iint iiint iiiint oint bigcup bigcap bigsqcup bigvee bigwedge bigodot bigotimes bigoplus biguplus
+lim limsup liminf sup inf max min arg argmin argmax det dim exp gcd hom ker lg ln log Pr deg
+sin cos tan cot sec csc arcsin arccos arctan sinh cosh tanh coth operatorname mod bmod pmod pod
+left right big Big bigg Bigg bigl bigr Bigl Bigr biggl biggr Biggl Biggr middle
+langle rangle lfloor rfloor lceil rceil lbrace rbrace lvert rvert lVert rVert vert Vert backslash
+cdot cdots ldots dots dotsb dotsc dotsm dotsi vdots ddots times div pm mp ast star circ bullet
+cap cup setminus sqcap sqcup vee wedge oplus ominus otimes oslash odot uplus amalg wr dagger ddagger
+leq le geq ge neq ne equiv approx approxeq sim simeq cong propto prec succ preceq succeq ll gg
+subset supset subseteq supseteq subsetneq supsetneq in ni notin not mid nmid parallel nparallel perp
+vdash dashv models asymp doteq bowtie smile frown leqslant geqslant lesssim gtrsim nleq ngeq
+to gets rightarrow leftarrow Rightarrow Leftarrow leftrightarrow Leftrightarrow mapsto longmapsto
+longrightarrow longleftarrow Longrightarrow Longleftarrow longleftrightarrow Longleftrightarrow
+uparrow downarrow Uparrow Downarrow updownarrow nearrow searrow swarrow nwarrow hookrightarrow
+hookleftarrow iff implies impliedby rightleftharpoons leftrightarrows twoheadrightarrow
+infty partial nabla forall exists nexists emptyset varnothing aleph hbar ell wp Re Im angle
+triangle square blacksquare Box Diamond surd top bot neg lnot prime backprime flat sharp natural
+clubsuit diamondsuit heartsuit spadesuit therefore because
+hat widehat tilde widetilde bar overline underline vec overrightarrow overleftarrow dot ddot dddot
+acute grave check breve mathring overbrace underbrace overset underset stackrel xrightarrow xleftarrow
+mathbb mathbf mathrm mathit mathcal mathfrak mathsf mathtt mathscr boldsymbol bm pmb text textrm
+textbf textit mbox hbox displaystyle textstyle scriptstyle scriptscriptstyle
+quad qquad enspace thinspace negthinspace hspace vspace phantom hphantom vphantom
+begin end label nonumber notag tag substack limits nolimits
+colon vartriangle lhd rhd unlhd unrhd imath jmath
+hline cline multicolumn cal rm bf it sf tt mit mathop mathrel mathbin mathord mathopen mathclose
+over atop choose brace brack lbrack rbrack leqq geqq lneq gneq lneqq gneqq nless ngtr
+cr overleftrightarrow underrightarrow underleftarrow boxed fbox bigstar
+""".split())
+
+# окружения, допустимые внутри \[ ... \] (align/equation там — ошибка)
+INNER_ENVS = frozenset("""
+matrix pmatrix bmatrix Bmatrix vmatrix Vmatrix smallmatrix cases dcases array aligned alignedat
+gathered split subarray
+""".split())
+
+# сколько обязательных аргументов
+_ARITY = {
+    "frac": 2, "dfrac": 2, "tfrac": 2, "cfrac": 2, "binom": 2, "dbinom": 2, "tbinom": 2,
+    "overset": 2, "underset": 2, "stackrel": 2, "sqrt": 1, "mathbb": 1, "mathbf": 1, "mathrm": 1,
+    "mathcal": 1, "text": 1, "hat": 1, "vec": 1, "bar": 1, "overline": 1, "underline": 1,
+    "widehat": 1, "widetilde": 1, "tilde": 1, "operatorname": 1,
+}
+
+_TOKEN = re.compile(r"\\([A-Za-z]+)\*?|\\(.)|(.)", re.S)
+
+
+def _tokens(src: str):
+    # (kind, value, pos): ("cs", имя) для \команд, ("sym", символ) для \{ \, и т.п., ("ch", символ)
+    for m in _TOKEN.finditer(src):
+        if m.group(1) is not None:
+            yield "cs", m.group(1), m.start()
+        elif m.group(2) is not None:
+            yield "sym", m.group(2), m.start()
+        else:
+            yield "ch", m.group(3), m.start()
+
+
+def _skip_ws(src: str, pos: int) -> int:
+    while pos < len(src) and src[pos].isspace():
+        pos += 1
+    return pos
+
+
+def _skip_arg(src: str, pos: int) -> int:
+    # позиция после одного аргумента ({группа} или одиночный токен); -1 — аргумента нет
+    pos = _skip_ws(src, pos)
+    if pos >= len(src) or src[pos] in "}&^_":
+        return -1
+    if src[pos] == "{":
+        depth = 0
+        for i in range(pos, len(src)):
+            if src[i] == "{" and (i == 0 or src[i - 1] != "\\"):
+                depth += 1
+            elif src[i] == "}" and (i == 0 or src[i - 1] != "\\"):
+                depth -= 1
+                if depth == 0:
+                    return i + 1
+        return len(src)
+    m = _TOKEN.match(src, pos)
+    return m.end() if m else pos + 1
+
+
+def validate_formula(src: str) -> List[str]:
+    # список проблем; пустой — формулу можно собирать как есть
+    return _check(src)[0]
+
+
+def formula_warnings(src: str) -> List[str]:
+    # подозрительное, но не повод для карантина: незнакомые команды
+    return _warnings(_check(src)[1])
+
+
+def check_formula(src: str) -> Dict[str, List[str]]:
+    # issues и warnings за один разбор — их пайплайн хранит в блоке формулы,
+    # и сборка tex/docx берёт готовые вместо повторной проверки
+    issues, unknown = _check(src)
+    return {"issues": issues, "warnings": _warnings(unknown)}
+
+
+def _warnings(unknown: List[str]) -> List[str]:
+    return ["unknown command(s): " + ", ".join("\\" + u for u in unknown)] if unknown else []
+
+
+def _check(src: str) -> Tuple[List[str], List[str]]:
+    issues: List[str] = []
+    if not src or not src.strip():
+        return issues, []
+    depth = 0
+    lr = 0
+    envs: List[str] = []
+    unknown = []
+    for kind, val, pos in _tokens(src):
+        if kind == "ch":
+            if val == "{":
+                depth += 1
+            elif val == "}":
+                depth -= 1
+                if depth < 0:
+                    issues.append(f"unexpected '}}' at {pos}")
+                    depth = 0
+            elif val in "#$":
+                issues.append(f"stray '{val}' at {pos}")
+            elif val == "%":
+                issues.append(f"comment char '%' at {pos}")
+            elif val == "&" and not envs:
+                issues.append(f"'&' outside alignment at {pos}")
+        elif kind == "sym":
+            if val in "[]()":
+                issues.append(f"nested math '\\{val}' at {pos}")
+        else:
+            if val in ("begin", "end"):
+                m = re.match(r"\s*\{([A-Za-z*]+)\}", src[pos + len(val) + 1:])
+                if not m:
+                    issues.append(f"\\{val} without environment at {pos}")
+                    continue
+                env = m.group(1)
+                if val == "begin":
+                    if env not in INNER_ENVS:
+                        issues.append(f"environment '{env}' not allowed in a formula")
+                    envs.append(env)
+                elif not envs or envs[-1] != env:
+                    issues.append(f"\\end{{{env}}} does not match \\begin{{{envs[-1] if envs else ''}}}")
+                    if env in envs:
+                        envs = envs[:len(envs) - 1 - envs[::-1].index(env)]
+                else:
+                    envs.pop()
+                continue
+            if val == "left":
+                lr += 1
+            elif val == "right":
+                lr -= 1
+                if lr < 0:
+                    issues.append(f"\\right without \\left at {pos}")
+                    lr = 0
+            if val not in KNOWN_MACROS:
+                unknown.append(val)
+                continue
+            p = pos + len(val) + 1
+            if val == "sqrt":  # \sqrt[n]{x}
+                q = _skip_ws(src, p)
+                if src.startswith("[", q):
+                    close = src.find("]", q)
+                    p = close + 1 if close >= 0 else len(src)
+            for _ in range(_ARITY.get(val, 0)):
+                p = _skip_arg(src, p)
+                if p < 0:
+                    issues.append(f"\\{val} is missing an argument")
+                    break
+    if depth > 0:
+        issues.append(f"{depth} unclosed '{{'")
+    if lr > 0:
+        issues.append(f"{lr} \\left without \\right")
+    if envs:
+        issues.append("unclosed environment(s): " + ", ".join(envs))
+    return issues, list(dict.fromkeys(unknown))
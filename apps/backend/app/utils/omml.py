@@ -0,0 +1,492 @@
+from typing import List, Optional, Tuple
+
+from lxml import etree
+
+# LaTeX-формула -> Office Math (OMML) для docx_writer. Покрываем то, что
+# выдаёт распознавание и что пропускает latex_validate: дроби, корни,
+# индексы, большие операторы, \left/\right, матрицы и cases, акценты,
+# шрифты (\mathbb, \mathbf, \text, ...), греческие буквы и символы.
+# Незнакомая команда выводится как есть (\foo), разбор не падает: при
+# любой ошибке формула уходит в документ одним текстовым прогоном.
+
+M_NS = "http://schemas.openxmlformats.org/officeDocument/2006/math"
+_XML_NS = "http://www.w3.org/XML/1998/namespace"
+
+
+def _q(tag: str) -> str:
+    return f"{{{M_NS}}}{tag}"
+
+
+def _el(tag: str, *children, **props) -> etree._Element:
+    # props -> <m:tagPr><m:key m:val=".."/></m:tagPr>
+    e = etree.Element(_q(tag), nsmap={"m": M_NS})
+    if props:
+        pr = etree.SubElement(e, _q(tag + "Pr"))
+        for k, v in props.items():
+            etree.SubElement(pr, _q(k)).set(_q("val"), str(v))
+    for c in children:
+        e.append(c)
+    return e
+
+
+def _box(tag: str, nodes: List[etree._Element]) -> etree._Element:
+    # контейнер аргумента (m:e, m:num, m:sub, ...); соседние прогоны одного стиля склеиваем
+    e = etree.Element(_q(tag), nsmap={"m": M_NS})
+    prev_key = None
+    for n in nodes:
+        key = _run_key(n)
+        if key is not None and key == prev_key:
+            prev_t, t = e[-1].find(_q("t")), n.find(_q("t"))
+            prev_t.text += t.text
+            continue
+        e.append(n)
+        prev_key = key
+    return e
+
+
+def _run_key(n: etree._Element) -> Optional[bytes]:
+    if n.tag != _q("r"):
+        return None
+    pr = n.find(_q("rPr"))
+    return etree.tostring(pr) if pr is not None else b""
+
+
+def _run(text: str, sty: Optional[str] = None, scr: Optional[str] = None) -> etree._Element:
+    r = etree.Element(_q("r"), nsmap={"m": M_NS})
+    if sty or scr:
+        pr = etree.SubElement(r, _q("rPr"))
+        if scr:
+            etree.SubElement(pr, _q("scr")).set(_q("val"), scr)
+        if sty:
+            etree.SubElement(pr, _q("sty")).set(_q("val"), sty)
+    t = etree.SubElement(r, _q("t"))
+    t.text = text
+    t.set(f"{{{_XML_NS}}}space", "preserve")
+    return r
+
+
+def _table(spec: str) -> dict:
+    out = {}
+    for line in spec.strip().splitlines():
+        for pair in line.split():
+            name, _, ch = pair.partition("=")
+            out[name] = ch
+    return out
+
+
+SYMBOLS = _table("""
+alpha=α beta=β gamma=γ delta=δ epsilon=ϵ varepsilon=ε zeta=ζ eta=η theta=θ vartheta=ϑ iota=ι kappa=κ
+varkappa=ϰ lambda=λ mu=μ nu=ν xi=ξ omicron=ο pi=π varpi=ϖ rho=ρ varrho=ϱ sigma=σ varsigma=ς tau=τ
+upsilon=υ phi=ϕ varphi=φ chi=χ psi=ψ omega=ω digamma=ϝ
+Gamma=Γ Delta=Δ Theta=Θ Lambda=Λ Xi=Ξ Pi=Π Sigma=Σ Upsilon=Υ Phi=Φ Psi=Ψ Omega=Ω
+cdot=⋅ cdots=⋯ ldots=… dots=… dotsb=⋯ dotsc=… dotsm=⋯ dotsi=⋯ vdots=⋮ ddots=⋱ times=× div=÷ pm=± mp=∓
+ast=∗ star=⋆ circ=∘ bullet=∙ cap=∩ cup=∪ setminus=∖ sqcap=⊓ sqcup=⊔ vee=∨ wedge=∧ oplus=⊕ ominus=⊖
+otimes=⊗ oslash=⊘ odot=⊙ uplus=⊎ amalg=⨿ wr=≀ dagger=† ddagger=‡
+leq=≤ le=≤ geq=≥ ge=≥ neq=≠ ne=≠ equiv=≡ approx=≈ approxeq=≊ sim=∼ simeq=≃ cong=≅ propto=∝ prec=≺
+succ=≻ preceq=⪯ succeq=⪰ ll=≪ gg=≫ subset=⊂ supset=⊃ subseteq=⊆ supseteq=⊇ subsetneq=⊊ supsetneq=⊋
+in=∈ ni=∋ notin=∉ mid=∣ nmid=∤ parallel=∥ nparallel=∦ perp=⊥ vdash=⊢ dashv=⊣ models=⊨ asymp=≍
+doteq=≐ bowtie=⋈ smile=⌣ frown=⌢ leqslant=⩽ geqslant=⩾ lesssim=≲ gtrsim=≳ nleq=≰ ngeq=≱
+to=→ gets=← rightarrow=→ leftarrow=← Rightarrow=⇒ Leftarrow=⇐ leftrightarrow=↔ Leftrightarrow=⇔
+mapsto=↦ longmapsto=⟼ longrightarrow=⟶ longleftarrow=⟵ Longrightarrow=⟹ Longleftarrow=⟸
+longleftrightarrow=⟷ Longleftrightarrow=⟺ uparrow=↑ downarrow=↓ Uparrow=⇑ Downarrow=⇓ updownarrow=↕
+nearrow=↗ searrow=↘ swarrow=↙ nwarrow=↖ hookrightarrow=↪ hookleftarrow=↩ iff=⟺ implies=⟹ impliedby=⟸
+rightleftharpoons=⇌ leftrightarrows=⇆ twoheadrightarrow=↠
+infty=∞ partial=∂ nabla=∇ forall=∀ exists=∃ nexists=∄ emptyset=∅ varnothing=∅ aleph=ℵ hbar=ℏ ell=ℓ
+wp=℘ Re=ℜ Im=ℑ angle=∠ triangle=△ square=□ blacksquare=■ Box=□ Diamond=◇ surd=√ top=⊤ bot=⊥
+neg=¬ lnot=¬ prime=′ backprime=‵ flat=♭ sharp=♯ natural=♮ clubsuit=♣ diamondsuit=♢ heartsuit=♡
+spadesuit=♠ therefore=∴ because=∵ colon=: vartriangle=△ lhd=⊲ rhd=⊳ unlhd=⊴ unrhd=⊵ imath=ı jmath=ȷ
+langle=⟨ rangle=⟩ lfloor=⌊ rfloor=⌋ lceil=⌈ rceil=⌉ lbrace={ rbrace=} lvert=| rvert=| lVert=‖ rVert=‖
+vert=| Vert=‖ backslash=\\
+""")
+
+# \{ \} \, и т.п.
+ESCAPES = {"{": "{", "}": "}", "|": "‖", "_": "_", "%": "%", "&": "&", "#": "#", "$": "$",
+           ",": " ", ":": " ", ">": " ", ";": " ", "!": "", " ": " "}
+SPACES = {"quad": " ", "qquad": "  ", "enspace": " ", "thinspace": " ",
+          "negthinspace": ""}
+
+NARY = _table("""
+sum=∑ prod=∏ coprod=∐ int=∫ iint=∬ iiint=∭ iiiint=⨌ oint=∮ bigcup=⋃ bigcap=⋂ bigsqcup=⨆ bigvee=⋁
+bigwedge=⋀ bigodot=⨀ bigotimes=⨂ bigoplus=⨁ biguplus=⨄
+""")
+_INTEGRALS = {"int", "iint", "iiint", "iiiint", "oint"}
+
+FUNCS = {n: n for n in """sin cos tan cot sec csc arcsin arccos arctan sinh cosh tanh coth exp ln lg log
+det dim deg gcd hom ker arg Pr max min sup inf lim bmod mod""".split()}
+FUNCS.update(limsup="lim sup", liminf="lim inf", argmin="arg min", argmax="arg max", bmod="mod")
+# у этих нижний индекс в выключенной формуле ставится под имя
+LIMIT_FUNCS = {"lim", "limsup", "liminf", "max", "min", "sup", "inf", "argmin", "argmax", "det", "gcd", "Pr"}
+
+ACCENTS = {"hat": "̂", "widehat": "̂", "tilde": "̃", "widetilde": "̃", "bar": "̅",
+           "vec": "⃗", "dot": "̇", "ddot": "̈", "dddot": "⃛", "acute": "́",
+           "grave": "̀", "check": "̌", "breve": "̆", "mathring": "̊",
+           "overrightarrow": "⃗", "overleftarrow": "⃖"}
+
+# (sty, scr) для шрифтовых команд с математическим аргументом
+FONTS = {"mathbb": ("p", "double-struck"), "mathcal": ("p", "script"), "mathscr": ("p", "script"),
+         "mathfrak": ("p", "fraktur"), "mathsf": ("p", "sans-serif"), "mathtt": ("p", "monospace"),
+         "mathbf": ("b", None), "boldsymbol": ("bi", None), "bm": ("bi", None), "pmb": ("bi", None),
+         "mathit": ("i", None)}
+TEXT_CMDS = {"text", "textrm", "textbf", "textit", "mbox", "hbox", "mathrm", "operatorname"}
+IGNORED = {"displaystyle", "textstyle", "scriptstyle", "scriptscriptstyle", "limits", "nolimits",
+           "nonumber", "notag"}
+SIZED = {"big", "Big", "bigg", "Bigg", "bigl", "bigr", "Bigl", "Bigr", "biggl", "biggr", "Biggl", "Biggr",
+         "middle"}
+SKIP_ARG = {"label", "tag", "phantom", "hphantom", "vphantom", "hspace", "vspace"}
+
+MATRICES = {"matrix": None, "smallmatrix": None, "pmatrix": ("(", ")"), "bmatrix": ("[", "]"),
+            "Bmatrix": ("{", "}"), "vmatrix": ("|", "|"), "Vmatrix": ("‖", "‖"), "array": None,
+            "cases": ("{", ""), "dcases": ("{", ""), "subarray": None}
+EQARRAYS = {"aligned", "alignedat", "gathered", "split"}
+
+# на чём заканчивается «тело» \sum/\int, если оно не в скобках
+_NARY_STOP = set("=<>+-") | {"leq", "le", "geq", "ge", "neq", "ne", "approx", "equiv", "sim", "to",
+                             "rightarrow", "Rightarrow", "implies", "iff", "pm", "mp"}
+
+Token = Tuple[str, str]  # ("cs", имя) | ("ch", символ)
+
+
+class _Parser:
+    def __init__(self, src: str):
+        self.src = src
+        self.pos = 0
+        self.style: Tuple[Optional[str], Optional[str]] = (None, None)
+
+    # --- лексика ---
+
+    def _skip_ws(self) -> None:
+        while self.pos < len(self.src) and self.src[self.pos].isspace():
+            self.pos += 1
+
+    def peek(self) -> Optional[Token]:
+        save = self.pos
+        tok = self.next()
+        self.pos = save
+        return tok
+
+    def next(self) -> Optional[Token]:
+        self._skip_ws()
+        if self.pos >= len(self.src):
+            return None
+        c = self.src[self.pos]
+        if c != "\\":
+            self.pos += 1
+            return ("ch", c)
+        j = self.pos + 1
+        while j < len(self.src) and self.src[j].isalpha():
+            j += 1
+        if j == self.pos + 1:  # \{ \, \\ и т.п.
+            name = self.src[j:j + 1]
+            self.pos = j + 1
+            return ("cs", name)
+        name = self.src[self.pos + 1:j]
+        if j < len(self.src) and self.src[j] == "*":
+            j += 1
+        self.pos = j
+        return ("cs", name)
+
+    def raw_group(self) -> str:
+        # аргумент как есть: {…} или один токен
+        self._skip_ws()
+        if self.pos >= len(self.src):
+            return ""
+        if self.src[self.pos] != "{":
+            start = self.pos
+            self.next()
+            return self.src[start:self.pos]
+        depth, i = 0, self.pos
+        while i < len(self.src):
+            c = self.src[i]
+            if c == "\\":
+                i += 2
+                continue
+            if c == "{":
+                depth += 1
+            elif c == "}":
+                depth -= 1
+                if depth == 0:
+                    out = self.src[self.pos + 1:i]
+                    self.pos = i + 1
+                    return out
+            i += 1
+        out = self.src[self.pos + 1:]
+        self.pos = len(self.src)
+        return out
+
+    def optional(self) -> Optional[str]:
+        self._skip_ws()
+        if self.pos < len(self.src) and self.src[self.pos] == "[":
+            end = self.src.find("]", self.pos)
+            if end < 0:
+                end = len(self.src)
+            out = self.src[self.pos + 1:end]
+            self.pos = end + 1
+            return out
+        return None
+
+    # --- синтаксис ---
+
+    def run(self, text: str) -> etree._Element:
+        return _run(text, *self.style)
+
+    def seq(self, nary_body: bool = False) -> List[etree._Element]:
+        # до конца группы/ячейки: '}', '&', '\\', \end, \right (их не съедаем)
+        out: List[etree._Element] = []
+        while True:
+            tok = self.peek()
+            if tok is None or tok in (("ch", "}"), ("ch", "&"), ("cs", "\\"), ("cs", "end"), ("cs", "right")):
+                return out
+            if nary_body and out and (tok[1] in _NARY_STOP):
+                return out
+            out.extend(self.scripts(self.atom()))
+
+    def arg(self) -> List[etree._Element]:
+        tok = self.peek()
+        if tok == ("ch", "{"):
+            self.next()
+            nodes = self.seq()
+            if self.peek() == ("ch", "}"):
+                self.next()
+            return nodes
+        if tok is None or tok[0] == "ch" and tok[1] in "}&^_":
+            return []
+        return self.atom()
+
+    def scripts(self, base: List[etree._Element]) -> List[etree._Element]:
+        sub = sup = None
+        while True:
+            tok = self.peek()
+            if tok == ("ch", "_") and sub is None:
+                self.next()
+                sub = self.arg()
+            elif tok == ("ch", "^") and sup is None:
+                self.next()
+                sup = self.arg()
+            elif tok == ("ch", "'") and sup is None:
+                primes = ""
+                while self.peek() == ("ch", "'"):
+                    self.next()
+                    primes += "′"
+                sup = [self.run(primes)]
+            else:
+                break
+        if sub is None and sup is None:
+            return base
+        if sub is not None and sup is not None:
+            return [_el("sSubSup", _box("e", base), _box("sub", sub), _box("sup", sup))]
+        if sub is not None:
+            return [_el("sSub", _box("e", base), _box("sub", sub))]
+        return [_el("sSup", _box("e", base), _box("sup", sup))]
+
+    def limits(self) -> Tuple[Optional[list], Optional[list]]:
+        sub = sup = None
+        while True:
+            tok = self.peek()
+            if tok in (("cs", "limits"), ("cs", "nolimits")):
+                self.next()
+            elif tok == ("ch", "_") and sub is None:
+                self.next()
+                sub = self.arg()
+            elif tok == ("ch", "^") and sup is None:
+                self.next()
+                sup = self.arg()
+            else:
+                return sub, sup
+
+    def atom(self) -> List[etree._Element]:
+        tok = self.next()
+        if tok is None:
+            return []
+        kind, val = tok
+        if kind == "ch":
+            if val == "{":
+                nodes = self.seq()
+                if self.peek() == ("ch", "}"):
+                    self.next()
+                return nodes
+            if val == "~":
+                return [self.run(" ")]
+            if val in "^_":  # индекс без основы
+                self.pos -= 1
+                return self.scripts([self.run("")])
+            if val in "}&":
+                return []
+            return [self.run(val)]
+        return self.command(val)
+
+    def command(self, name: str) -> List[etree._Element]:
+        if name in SYMBOLS:
+            return [self.run(SYMBOLS[name])]
+        if name in ESCAPES:
+            return [self.run(ESCAPES[name])] if ESCAPES[name] else []
+        if name in SPACES:
+            return [self.run(SPACES[name])] if SPACES[name] else []
+        if name in ("frac", "dfrac", "tfrac", "cfrac"):
+            return [_el("f", _box("num", self.arg()), _box("den", self.arg()))]
+        if name in ("binom", "dbinom", "tbinom"):
+            f = _el("f", _box("num", self.arg()), _box("den", self.arg()), type="noBar")
+            return [_delim("(", ")", [f])]
+        if name == "sqrt":
+            deg = self.optional()
+            body = _box("e", self.arg())
+            if deg is None:
+                return [_el("rad", _box("deg", []), body, degHide=1)]
+            return [_el("rad", _box("deg", _Parser(deg).parse_nodes()), body)]
+        if name in NARY:
+            sub, sup = self.limits()
+            props = {"chr": NARY[name], "limLoc": "subSup" if name in _INTEGRALS else "undOvr"}
+            if sub is None:
+                props["subHide"] = 1
+            if sup is None:
+                props["supHide"] = 1
+            body = self.scripts(self.atom()) if self.peek() == ("ch", "{") else self.seq(nary_body=True)
+            return [_el("nary", _box("sub", sub or []), _box("sup", sup or []), _box("e", body), **props)]
+        if name in FUNCS:
+            fname = [_run(FUNCS[name], "p")]
+            if name in LIMIT_FUNCS:
+                sub, sup = self.limits()
+                if sub is not None:
+                    fname = [_el("limLow", _box("e", fname), _box("lim", sub))]
+                if sup is not None:
+                    fname = [_el("sSup", _box("e", fname), _box("sup", sup))]
+                return fname
+            return self.scripts(fname) + [_run(" ")]
+        if name == "pmod":
+            return [_run(" (mod ", "p")] + self.arg() + [_run(")", "p")]
+        if name in ACCENTS:
+            return [_el("acc", _box("e", self.arg()), chr=ACCENTS[name])]
+        if name in ("overline", "underline"):
+            return [_el("bar", _box("e", self.arg()), pos="top" if name == "overline" else "bot")]
+        if name in ("overbrace", "underbrace"):
+            top = name == "overbrace"
+            return [_el("groupChr", _box("e", self.arg()), chr="⏞" if top else "⏟", pos="top" if top else "bot",
+                        vertJc="bot" if top else "top")]
+        if name in ("overset", "stackrel", "underset"):
+            lim, base = self.arg(), self.arg()
+            tag = "limLow" if name == "underset" else "limUpp"
+            return [_el(tag, _box("e", base), _box("lim", lim))]
+        if name in ("xrightarrow", "xleftarrow"):
+            self.optional()
+            return [_el("limUpp", _box("e", [self.run("→" if name == "xrightarrow" else "←")]), _box("lim", self.arg()))]
+        if name in FONTS:
+            save, self.style = self.style, FONTS[name]
+            try:
+                return self.arg()
+            finally:
+                self.style = save
+        if name in TEXT_CMDS:
+            text = self.raw_group()
+            sty = "b" if name == "textbf" else "i" if name == "textit" else "p"
+            if name == "operatorname":
+                return [_run(text, "p"), _run(" ")]
+            return [_run(_text(text), sty)]
+        if name == "left":
+            return self.left_right()
+        if name == "not":
+            nxt = self.atom()
+            if nxt and nxt[0].tag == _q("r"):
+                t = nxt[0].find(_q("t"))
+                t.text = (t.text or "") + "̸"
+            return nxt
+        if name == "begin":
+            return self.environment(self.raw_group())
+        if name == "substack":
+            sub = _Parser(self.raw_group())
+            return [sub.eqarray()]
+        if name in SIZED:
+            return [self.run(self.delimiter())]
+        if name in SKIP_ARG:
+            self.raw_group()
+            return [self.run(" ")] if name == "hspace" else []
+        if name in IGNORED:
+            return []
+        return [_run("\\" + name, "p")]
+
+    def delimiter(self) -> str:
+        tok = self.next()
+        if tok is None:
+            return ""
+        kind, val = tok
+        if kind == "ch":
+            return "" if val == "." else val
+        return SYMBOLS.get(val, ESCAPES.get(val, ""))
+
+    def left_right(self) -> List[etree._Element]:
+        beg = self.delimiter()
+        body = self.seq()
+        end = ""
+        if self.peek() == ("cs", "right"):
+            self.next()
+            end = self.delimiter()
+        return [_delim(beg, end, body)]
+
+    def rows(self, env: str) -> List[List[List[etree._Element]]]:
+        rows, cells = [], []
+        while True:
+            cells.append(self.seq())
+            tok = self.next()
+            if tok == ("ch", "&"):
+                continue
+            rows.append(cells)
+            cells = []
+            if tok == ("cs", "\\"):
+                self.optional()  # \\[2pt]
+                continue
+            if tok == ("cs", "end"):
+                self.raw_group()
+            elif tok is not None:  # '}' или \right не из этого окружения
+                self.pos -= len(tok[1]) + (1 if tok[0] == "cs" else 0)
+            break
+        if rows and rows[-1] == [[]] and len(rows) > 1:  # \\ перед \end
+            rows.pop()
+        return rows
+
+    def environment(self, env: str) -> List[etree._Element]:
+        env = env.rstrip("*")
+        if env in ("array", "subarray", "alignedat"):
+            self.raw_group()  # спецификация колонок / число пар
+        rows = self.rows(env)
+        if env in EQARRAYS:
+            return [_el("eqArr", *(_box("e", [n for cell in row for n in cell]) for row in rows))]
+        width = max((len(r) for r in rows), default=1)
+        m = _el("m", *(
+            _el("mr", *(_box("e", row[i] if i < len(row) else []) for i in range(width))) for row in rows
+        ))
+        delims = MATRICES.get(env)
+        return [_delim(delims[0], delims[1], [m])] if delims else [m]
+
+    def eqarray(self) -> etree._Element:
+        rows = self.rows("substack")
+        return _el("eqArr", *(_box("e", [n for cell in row for n in cell]) for row in rows))
+
+    def parse_nodes(self) -> List[etree._Element]:
+        out: List[etree._Element] = []
+        while self.peek() is not None:
+            out.extend(self.seq())
+            if self.peek() is not None:
+                self.next()  # лишние '}', '&', '\\', \end, \right на верхнем уровне
+        return out
+
+
+def _text(s: str) -> str:
+    return s.replace("\\,", " ").replace("\\ ", " ").replace("~", " ").replace("\\{", "{").replace("\\}", "}")
+
+
+def _delim(beg: str, end: str, body: List[etree._Element]) -> etree._Element:
+    return _el("d", _box("e", body), begChr=beg, endChr=end)
+
+
+def math(src: str) -> etree._Element:
+    # <m:oMath> для вставки в абзац
+    try:
+        nodes = _Parser(src or "").parse_nodes()
+    except Exception:
+        nodes = [_run(src or "", "p")]
+    return _box("oMath", nodes)
+
+
+def math_para(src: str) -> etree._Element:
+    # выключенная формула: отдельный абзац <m:oMathPara>
+    para = etree.Element(_q("oMathPara"), nsmap={"m": M_NS})
+    para.append(math(src))
+    return para
@@ -0,0 +1,143 @@
+from typing import Sequence
+
+import numpy as np
+
+# Порядок чтения страницы: колонки слева направо, в колонке — строки сверху
+# вниз, в строке — слева направо. Всё считается по массиву bbox (n, 4)
+# целиком, без циклов по блокам.
+#
+# Колонки ищем по профилю проекции на ось x: сколько блоков покрывает каждую
+# точку. Просвет (гаттер) — участок, где покрытие не больше NOISE от числа
+# блоков, шириной от min_gap, не у края содержимого и с минимум MIN_BLOCKS
+# блоками по каждую сторону. Если по всем блокам просвета нет, профиль
+# строим без широких (заголовок, формула на всю страницу) — они закрывают
+# межколоночный просвет.
+#
+# Просвет между подписью и формулой ("1)  x^2 + ...", "Задача 3.  ...") похож
+# на гаттер, но это не колонки: такие строки идут через просвет. Поэтому
+# колонка уже MIN_COL доли ширины — не колонка, а гаттер отбрасываем, если
+# у большинства блоков с обеих сторон есть сосед по y на другой стороне
+# (строки переходят через просвет), а одна из колонок уже NARROW_COL. Две
+# равные колонки с совпадающими строками так не отсекаются, заметки на полях
+# тоже: у основного текста соседей на полях почти нет.
+#
+# Блок, пересекающий середину гаттера, — "сквозной": он делит страницу на
+# полосы по y. Внутри полосы: сначала сквозной блок, затем колонки по
+# порядку. Без гаттеров вся страница — одна группа, и порядок прежний.
+# Строки внутри группы — assemble_latex._cluster_into_lines (полный порядок
+# блоков — assemble_latex.reading_order), одни и те же для нумерации блоков
+# и для документа.
+
+WIDE = 0.6        # доля ширины содержимого, с которой блок в профиль не идёт
+NOISE = 0.05      # доля блоков, которой разрешено задевать гаттер
+MIN_BLOCKS = 2    # меньше блоков в колонке — не колонка, а случайная дыра
+MIN_COL = 0.1     # доля ширины содержимого: уже — не колонка (номер, подпись)
+NARROW_COL = 0.35 # колонка уже этого и строки через просвет — подписи, а не колонки
+PAIRED = 0.5      # доля блоков с соседом по y на другой стороне гаттера
+MAX_BINS = 2048
+
+
+def _boxes(boxes) -> np.ndarray:
+    a = np.asarray(boxes, dtype=float)
+    return a.reshape(-1, 4) if a.size == 0 else a[:, :4]
+
+
+def _heights(a: np.ndarray) -> np.ndarray:
+    return np.maximum(1.0, a[:, 3] - a[:, 1])
+
+
+def _valleys(a: np.ndarray, lo: float, width: float, min_gap: float) -> np.ndarray:
+    if len(a) < 2 * MIN_BLOCKS:
+        return np.empty((0, 2))
+    nb = int(min(MAX_BINS, max(1, np.ceil(width))))
+    step = width / nb
+    s = np.clip(np.floor((a[:, 0] - lo) / step).astype(int), 0, nb)
+    e = np.clip(np.ceil((a[:, 2] - lo) / step).astype(int), 0, nb)
+    cov = np.zeros(nb + 1)
+    np.add.at(cov, s, 1)
+    np.add.at(cov, e, -1)
+    cov = np.cumsum(cov)[:nb]
+
+    valley = (cov <= int(NOISE * len(a))).astype(np.int8)
+    d = np.diff(np.concatenate(([0], valley, [0])))
+    starts, ends = np.flatnonzero(d == 1), np.flatnonzero(d == -1)
+    keep = (starts > 0) & (ends < nb) & ((ends - starts) * step >= min_gap)
+    return np.stack([lo + starts[keep] * step, lo + ends[keep] * step], axis=1)
+
+
+def column_gutters(boxes: Sequence) -> np.ndarray:
+    # (k, 2): x-интервалы гаттеров слева направо
+    a = _boxes(boxes)
+    none = np.empty((0, 2))
+    if len(a) < 2 * MIN_BLOCKS:
+        return none
+    lo, hi = a[:, 0].min(), a[:, 2].max()
+    width = hi - lo
+    if width <= 0:
+        return none
+    # сначала профиль по всем блокам (поля с заметками, колонки без
+    # заголовка); не нашлось — по узким (заголовок на всю ширину)
+    min_gap = max(float(np.median(_heights(a))), 0.015 * width)
+    gutters = _valleys(a, lo, width, min_gap)
+    if not len(gutters):
+        gutters = _valleys(a[(a[:, 2] - a[:, 0]) < WIDE * width], lo, width, min_gap)
+
+    # в каждой колонке должно быть хоть сколько-то блоков и ширины; иначе
+    # убираем самый узкий из гаттеров вокруг бедной колонки и пересчитываем;
+    # затем — гаттеры, через которые идут строки
+    while len(gutters):
+        col, spanning = _columns(a, gutters)
+        k = len(gutters) + 1
+        inner = ~spanning
+        counts = np.bincount(col[inner], minlength=k)
+        left = np.full(k, np.inf)
+        right = np.full(k, -np.inf)
+        np.minimum.at(left, col[inner], a[inner, 0])
+        np.maximum.at(right, col[inner], a[inner, 2])
+        col_w = np.where(counts > 0, right - left, 0.0)
+        poor = np.flatnonzero((counts < MIN_BLOCKS) | (col_w < MIN_COL * width))
+        if len(poor):
+            c = poor[0]
+            near = [g for g in (c - 1, c) if 0 <= g < len(gutters)]
+            widths = gutters[near, 1] - gutters[near, 0]
+            gutters = np.delete(gutters, near[int(np.argmin(widths))], axis=0)
+            continue
+        crossed = [g for g in range(len(gutters))
+                   if min(col_w[g], col_w[g + 1]) < NARROW_COL * width
+                   and _lines_cross(a[inner & (col == g)], a[inner & (col == g + 1)])]
+        if not crossed:
+            break
+        gutters = np.delete(gutters, crossed[0], axis=0)
+    return gutters
+
+
+def _lines_cross(l: np.ndarray, r: np.ndarray) -> bool:
+    # у большинства блоков по обе стороны есть сосед по y на другой стороне
+    # (перекрытие больше половины меньшей высоты) — строки идут через просвет
+    ovl = np.minimum(l[:, 3:4], r[:, 3]) - np.maximum(l[:, 1:2], r[:, 1])
+    paired = ovl > 0.5 * np.minimum(_heights(l)[:, None], _heights(r)[None, :])
+    return paired.any(axis=1).mean() > PAIRED and paired.any(axis=0).mean() > PAIRED
+
+
+def _columns(a: np.ndarray, gutters: np.ndarray):
+    # номер колонки по центру блока; сквозной — пересекает середину гаттера
+    mids = gutters.mean(axis=1)
+    cx = (a[:, 0] + a[:, 2]) / 2
+    col = np.searchsorted(mids, cx)
+    spanning = ((a[:, 0:1] < mids) & (a[:, 2:3] > mids)).any(axis=1)
+    return col, spanning
+
+
+def reading_groups(boxes: Sequence, gutters=None) -> np.ndarray:
+    # номер группы (полоса × колонка) для каждого блока; группы нумеруются
+    # в порядке чтения. gutters — уже посчитанные column_gutters(boxes)
+    a = _boxes(boxes)
+    if len(a) == 0:
+        return np.zeros(0, dtype=int)
+    gutters = column_gutters(a) if gutters is None else np.asarray(gutters, dtype=float).reshape(-1, 2)
+    if not len(gutters):
+        return np.zeros(len(a), dtype=int)
+    col, spanning = _columns(a, gutters)
+    band = np.searchsorted(np.sort(a[spanning, 1]), a[:, 1], side="right")
+    key = band * (len(gutters) + 2) + np.where(spanning, 0, col + 1)
+    return np.unique(key, return_inverse=True)[1].reshape(-1)
@@ -11,6 +11,9 @@ from PIL import Image
 import torch
 from transformers import TrOCRProcessor, VisionEncoderDecoderModel
 
+from app.cancellation import check
+from app.utils.crop_store import CropStoreWriter
+
 
 def load_trocr(model_dir: str):
     device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -54,6 +57,24 @@ def recognize_one(processor, model, device, image: Image.Image,
     return processor.tokenizer.batch_decode(out, skip_special_tokens=True)[0].strip()
 
 
+@torch.no_grad()
+def recognize_batch(processor, model, device, images: List[Image.Image],
+                    max_new_tokens: int = 224, num_beams: int = 4, length_penalty: float = 1.1) -> List[str]:
+    # то же, что recognize_one, но одним generate на весь список
+    if not images:
+        return []
+    inputs = processor(images=images, return_tensors="pt").to(device)
+    out = model.generate(
+        **inputs,
+        max_new_tokens=max_new_tokens,
+        num_beams=num_beams,
+        length_penalty=length_penalty,
+        no_repeat_ngram_size=2,
+        early_stopping=True,
+    )
+    return [t.strip() for t in processor.tokenizer.batch_decode(out, skip_special_tokens=True)]
+
+
 def otsu_binarize_pil(pil_img: Image.Image, strength: float = 1.2, erode_kernel: Optional[int] = None) -> Image.Image:
     gray = np.array(pil_img.convert("L"))
     blur = cv2.GaussianBlur(gray, (3, 3), 0)
@@ -70,7 +91,7 @@ def otsu_binarize_pil(pil_img: Image.Image, strength: float = 1.2, erode_kernel:
 
 
 def recognize_crops(
-        crop_paths: List[str],
+        crop_paths: List[str] = None,
         model_dir: str = None,
         beams: int = 4,
         max_new_tokens: int = 224,
@@ -79,36 +100,72 @@ def recognize_crops(
         use_binarization: bool = True,
         erode_kernel: int = 3,
         out_dir: str = "temp",
+        crops: Optional[List[Tuple[int, np.ndarray]]] = None,
+        trocr=None,
+        batcher=None,
+        cancel=None,
 ) -> List[Tuple[int, str, str]]:
-    processor, model, device = load_trocr(model_dir)
+    # trocr — уже загруженные (processor, model, device), чтобы не грузить модель на каждый вызов;
+    # batcher — общий MicroBatcher процесса: кропы страницы распознаются вместе с кропами других страниц
+    if batcher is None:
+        processor, model, device = trocr or load_trocr(model_dir)
     out_dir = Path(out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
 
+    # кропы из упакованного хранилища (idx, RGB view) либо по старинке из png
+    if crops is None:
+        items = []
+        for p in crop_paths or []:
+            pth = Path(p)
+            try:
+                idx = int(pth.stem.split("_")[-1])
+            except Exception:
+                idx = -1
+            items.append((idx, pth))
+        packed = None
+    else:
+        items = list(crops)
+        packed = CropStoreWriter(out_dir / ("bin.crops" if use_binarization else "orig.crops"))
+
+    prepared = []
+    try:
+        for idx, src in items:
+            check(cancel)
+            if isinstance(src, np.ndarray):
+                pil = Image.fromarray(src).convert("RGB")
+            else:
+                pil = Image.open(src).convert("RGB")
+
+            if use_binarization:
+                processed_img = otsu_binarize_pil(pil, strength=bin_strength, erode_kernel=erode_kernel)
+                prefix = "bin"
+            else:
+                processed_img = pil
+                prefix = "orig"
+
+            if packed is not None:
+                processed_path = packed.add(idx, np.asarray(processed_img))
+            else:
+                processed_path = out_dir / f"{prefix}_block_{idx:03d}.png"
+                processed_img.save(processed_path)
+            prepared.append((idx, processed_img, str(processed_path)))
+    finally:
+        if packed is not None:
+            packed.close()
+
+    if batcher is not None:
+        latexes = batcher.map([img for _, img, _ in prepared], key=(max_new_tokens, beams, length_penalty), cancel=cancel)
+    else:
+        latexes = []
+        for _, img, _ in prepared:
+            check(cancel)
+            latexes.append(recognize_one(processor, model, device, img,
+                                         max_new_tokens=max_new_tokens,
+                                         num_beams=beams,
+                                         length_penalty=length_penalty))
 
     results = []
-    for p in crop_paths:
-        pth = Path(p)
-        try:
-            idx = int(pth.stem.split("_")[-1])
-        except Exception:
-            idx = -1
-
-        pil = Image.open(pth).convert("RGB")
-
-        if use_binarization:
-            processed_img = otsu_binarize_pil(pil, strength=bin_strength, erode_kernel=erode_kernel)
-            prefix = "bin"
-        else:
-            processed_img = pil
-            prefix = "orig"
-
-        processed_path = out_dir / f"{prefix}_block_{idx:03d}.png"
-        processed_img.save(processed_path)
-
-        latex = recognize_one(processor, model, device, processed_img,
-                              max_new_tokens=max_new_tokens,
-                              num_beams=beams,
-                              length_penalty=length_penalty)
+    for (idx, _, processed_path), latex in zip(prepared, latexes):
         print(f"({idx}) -> {latex}")
-        results.append((idx, latex, str(processed_path)))
+        results.append((idx, latex, processed_path))
     return results
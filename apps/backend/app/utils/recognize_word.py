@@ -202,3 +202,45 @@ def recognize_word(img: Union[str, Image.Image, np.ndarray],
     pil = _to_pil(img)
     src = _prep_tensor_for_model(pil)
     return _greedy_decode(model, src, dev, max_len=max_len)
+
+@torch.no_grad()
+def _greedy_decode_batch(model: nn.Module, src: torch.Tensor, device: str, max_len: int = 100):
+    # _greedy_decode для батча (B,C,H,W): последовательности идут по оси batch
+    # независимо, закончившиеся просто досчитываются до конца цикла
+    src = src.to(device)
+    memory = model.transformer.encoder(model.pos_encoder(model._get_features(src)))
+    bsz = src.shape[0]
+    sos_id = ALPHABET.index("SOS"); eos_id = ALPHABET.index("EOS")
+    out = torch.full((1, bsz), sos_id, dtype=torch.long, device=device)  # (T,B)
+    done = [False] * bsz
+    seqs = [[sos_id] for _ in range(bsz)]
+    logps: List[List[float]] = [[] for _ in range(bsz)]
+    for _ in range(max_len):
+        dec_out = model.transformer.decoder(model.pos_decoder(model.decoder(out)), memory)
+        probs = torch.softmax(model.fc_out(dec_out)[-1].float(), dim=-1)  # (B,V)
+        pmax, tok = torch.max(probs, dim=-1)
+        out = torch.cat([out, tok.unsqueeze(0)], dim=0)
+        for i, (t, p) in enumerate(zip(tok.tolist(), pmax.tolist())):
+            if done[i]:
+                continue
+            seqs[i].append(t)
+            if t not in (sos_id, eos_id) and p > 0:
+                logps[i].append(math.log(p + 1e-12))
+            if t == eos_id:
+                done[i] = True
+        if all(done):
+            break
+    res = []
+    for seq, lp in zip(seqs, logps):
+        res.append((indicies_to_text(seq, ALPHABET), float(np.exp(np.mean(lp))) if lp else 0.0))
+    return res
+
+def recognize_words(imgs: List[Union[str, Image.Image, np.ndarray]],
+                    model: nn.Module,
+                    device: Optional[str] = None,
+                    max_len: int = 100) -> List[Tuple[str, float]]:
+    if not imgs:
+        return []
+    dev = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    src = torch.cat([_prep_tensor_for_model(_to_pil(im)) for im in imgs], dim=0)
+    return _greedy_decode_batch(model, src, dev, max_len=max_len)
@@ -0,0 +1,201 @@
+import asyncio, hashlib, os, threading, time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Optional
+
+from app import metrics
+from app.cancellation import CancelToken
+from app.config import settings
+from app.disk_cache import DiskLRU
+from app.utils import compile_pool
+from app.utils.assemble_latex import quarantine
+from app.utils.latex_format import tool_version
+from app.utils.latex_to_pdf import _extend_path, _run, _which, run_command_async
+from app.utils.latex_validate import validate_formula
+
+# Превью одной формулы: standalone-документ -> pdflatex -> pdftocairo в png/svg.
+# Кэш по тексту формулы (+ формат, dpi, версия движка): правка документа
+# перерисовывает только изменившиеся формулы, остальные берутся с диска.
+# Рендер идёт в слотах compile_pool с теми же лимитами, что и сборка pdf,
+# поэтому много превью разом не отнимут CPU у основных компиляций больше,
+# чем LATEX_MAX_CONCURRENCY.
+
+SNIPPET_DOC = r"""\documentclass[preview,border=2pt]{standalone}
+\usepackage[T1]{fontenc}
+\usepackage[utf8]{inputenc}
+\usepackage{lmodern}
+\usepackage{amsmath, amssymb}
+\usepackage[russian]{babel}
+\begin{document}
+%BODY%
+\end{document}
+"""
+
+MEDIA_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+_cache: DiskLRU | None = None
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+_inflight: dict[str, asyncio.Task] = {}  # ключ -> идущий рендер, общий для одновременных запросов
+
+
+def get_cache() -> DiskLRU:
+    global _cache
+    if _cache is None:
+        _cache = DiskLRU(
+            settings.SNIPPET_CACHE_DIR or os.path.join(settings.TEMP_DIR, "cache", "snippets"),
+            settings.SNIPPET_CACHE_MAX_MB * 1024 * 1024,
+            name="snippet_cache",
+        )
+    return _cache
+
+
+def document(formula: str) -> str:
+    # формулу, не прошедшую проверку, показываем так же, как в документе — текстом
+    f = (formula or "").strip()
+    body = quarantine(f) if validate_formula(f) else f"$\\displaystyle {f}$"
+    return SNIPPET_DOC.replace("%BODY%", body)
+
+
+def _engine(env: dict) -> str:
+    eng = _which("pdflatex", env)
+    if not eng:
+        raise RuntimeError("pdflatex not found")
+    return eng
+
+
+def key(formula: str, fmt: str) -> str:
+    eng = _which("pdflatex", _extend_path(os.environ.copy()))
+    h = hashlib.sha256(
+        f"app={settings.APP_VERSION}\n{fmt}:{settings.SNIPPET_DPI}\n{tool_version(eng) if eng else ''}\n".encode("utf-8")
+    )
+    h.update((formula or "").strip().encode("utf-8"))
+    return h.hexdigest()
+
+
+def _commands(work: Path, fmt: str, env: dict) -> list[list[str]]:
+    conv = _which("pdftocairo", env)
+    if not conv:
+        raise RuntimeError("pdftocairo not found")
+    to_image = ([conv, "-svg", "snippet.pdf", "snippet.svg"] if fmt == "svg" else
+                [conv, "-png", "-singlefile", "-transp", "-r", str(settings.SNIPPET_DPI), "snippet.pdf", "snippet"])
+    return [
+        [_engine(env), "-interaction=nonstopmode", "-halt-on-error", "-no-shell-escape", "snippet.tex"],
+        to_image,
+    ]
+
+
+def _lookup(k: str, fname: str) -> Optional[bytes]:
+    with get_cache().pinned(k) as hit:
+        if not hit or fname not in hit["files"]:
+            return None
+        try:
+            return Path(hit["files"][fname]).read_bytes()
+        except OSError:
+            return None
+
+
+def _store(k: str, fname: str, src: Path) -> bytes:
+    data = src.read_bytes()
+    try:
+        get_cache().put(k, {fname: src})
+    except Exception as e:
+        print(f"[snippet] failed to store {k[:12]}: {e}")
+    return data
+
+
+def _check_fmt(fmt: str) -> str:
+    if fmt not in MEDIA_TYPES:
+        raise ValueError(f"unsupported snippet format: {fmt}")
+    return f"snippet.{fmt}"
+
+
+def render(formula: str, fmt: str = "png", cancel: Optional[CancelToken] = None) -> bytes:
+    fname = _check_fmt(fmt)
+    k = key(formula, fmt)
+    data = _lookup(k, fname)
+    if data is not None:
+        return data
+    t0 = time.perf_counter()
+    env = _extend_path(os.environ.copy())
+    with compile_pool.get_pool().slot(cancel), compile_pool.scratch_dir("snip_") as work:
+        (work / "snippet.tex").write_text(document(formula), encoding="utf-8")
+        for cmd in _commands(work, fmt, env):
+            code, out, _ = _run(cmd, cwd=work, env=env, timeout=settings.SNIPPET_TIMEOUT_SEC,
+                                cancel=cancel, limits=True)
+            if code != 0:
+                raise RuntimeError(f"snippet render failed ({Path(cmd[0]).name} exit {code}):\n{out[-1000:]}")
+        data = _store(k, fname, work / fname)
+    metrics.observe("snippet.render_ms", (time.perf_counter() - t0) * 1000.0)
+    return data
+
+
+async def render_async(formula: str, fmt: str = "png", cancel: Optional[CancelToken] = None) -> bytes:
+    # одна формула, запрошенная разом с нескольких вкладок, рисуется один раз;
+    # shield — отмена одного ожидающего не обрывает рендер остальным
+    _check_fmt(fmt)
+    k = await asyncio.to_thread(key, formula, fmt)
+    task = _inflight.get(k)
+    if task is None:
+        task = _inflight[k] = asyncio.ensure_future(_render_async(k, fmt, formula, cancel))
+        task.add_done_callback(lambda t: _forget(k, t))
+    return await asyncio.shield(task)
+
+
+def _forget(k: str, task: asyncio.Task) -> None:
+    _inflight.pop(k, None)
+    if not task.cancelled():
+        task.exception()  # все ожидавшие могли уйти — не шумим "exception was never retrieved"
+
+
+async def _render_async(k: str, fmt: str, formula: str, cancel: Optional[CancelToken]) -> bytes:
+    fname = f"snippet.{fmt}"
+    data = await asyncio.to_thread(_lookup, k, fname)
+    if data is not None:
+        return data
+    t0 = time.perf_counter()
+    env = _extend_path(os.environ.copy())
+    async with compile_pool.get_pool().aslot(cancel):
+        with compile_pool.scratch_dir("snip_") as work:
+            (work / "snippet.tex").write_text(document(formula), encoding="utf-8")
+            for cmd in _commands(work, fmt, env):
+                code, out, _ = await run_command_async(cmd, cwd=work, env=env, timeout=settings.SNIPPET_TIMEOUT_SEC,
+                                                       cancel=cancel, limits=True)
+                if code != 0:
+                    raise RuntimeError(f"snippet render failed ({Path(cmd[0]).name} exit {code}):\n{out[-1000:]}")
+            data = await asyncio.to_thread(_store, k, fname, work / fname)
+    metrics.observe("snippet.render_ms", (time.perf_counter() - t0) * 1000.0)
+    return data
+
+
+async def render_many_async(formulas: Iterable[str], fmt: str = "png",
+                            cancel: Optional[CancelToken] = None) -> list:
+    # параллельно, сколько пустит compile_pool; ошибка одной формулы — исключение на её месте
+    return await asyncio.gather(*(render_async(f, fmt, cancel) for f in formulas), return_exceptions=True)
+
+
+def shared_cache() -> bool:
+    # кэш, который заполняет воркер, увидит API: явно общий путь или воркеры в том же процессе
+    return bool(settings.SNIPPET_CACHE_DIR) or settings.INPROCESS_WORKERS > 0
+
+
+def prewarm(formulas: Iterable[str], fmt: str = "png") -> list[Future]:
+    # не ждём: превью рисуются в фоне, пока идут остальные этапы; уже готовые — только проверка кэша
+    global _executor
+    if not settings.SNIPPET_PREWARM or settings.SNIPPET_CACHE_MAX_MB <= 0 or not shared_cache():
+        return []
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=compile_pool.get_pool().size, thread_name_prefix="snippet")
+    futs = []
+    for f in dict.fromkeys(f for f in formulas if f and f.strip()):
+        fut = _executor.submit(render, f, fmt)
+        fut.add_done_callback(_log_failure)
+        futs.append(fut)
+    return futs
+
+
+def _log_failure(fut: Future) -> None:
+    if not fut.cancelled() and fut.exception() is not None:
+        metrics.inc("snippet.failed")
+        print(f"[snippet] prewarm failed: {fut.exception()}")
@@ -1,62 +1,196 @@
-import asyncio, os, uuid
+import argparse
+import asyncio, json, os, re, socket, uuid
 import shutil
-import subprocess
 import sys
 from pathlib import Path
 from typing import Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from app.database import AsyncSessionLocal
-from app.models import Project, ProjectStatus
+from app.models import Job, JobStatus, Project, ProjectStatus
 from app.config import settings
-from app.storage import upload_file, make_download_url, delete_objects, fetch_to_path
-from app.pipeline import run_full_pipeline
-from app.utils.latex_to_pdf import compile_tex_file_to_pdf
-import re
-from app.utils.assemble_latex import HEADER, FOOTER
+from app.storage import upload_file, upload_bytes, make_download_url, delete_objects, fetch_to_path
+from app import admission, inference_pool, jobqueue, metrics, notify, qos, result_cache, pipeline_record, tex_cache
+from app.quotas import is_premium
+from app.workspace import workspaces, MB
+from app.cancellation import CancelToken, Cancelled, DeadlineExceeded
+from app.loop_monitor import monitor_loop_lag
+from app.memwatch import PeakTracker, rss_mb
+from app.utils.latex_format import tool_version
+from app.utils.latex_to_pdf import compile_tex_file_to_pdf_async, run_command_async
+from app.utils.assemble_latex import HEADER, FOOTER, formulas_from_tex
+from app.utils import docx_writer, snippets
 
-queue: "asyncio.Queue[dict]" = asyncio.Queue()
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+_rss = PeakTracker(settings.RSS_SAMPLE_SEC)
 
-async def submit_infer_job(project_id):
-    await queue.put({"kind": "infer", "project_id": project_id})
 
-async def submit_texjob(project_id, tex_content: str):
-    await queue.put({"kind": "tex", "project_id": project_id, "tex": tex_content})
+async def _run_job(job: Job, token: Optional[CancelToken] = None):
+    if job.kind == "infer":
+        await _do_infer(job.project_id, token)
+    elif job.kind == "tex":
+        await _do_build_tex(job.project_id, job.payload.get("tex", ""), job.payload.get("rev"), token,
+                            prepared=job.payload.get("prepared", False), blocks=job.payload.get("blocks"))
+    else:
+        raise ValueError(f"unknown job kind: {job.kind}")
 
-async def worker():
+
+def _job_deadline(kind: str) -> Optional[float]:
+    sec = {"infer": settings.JOB_DEADLINE_INFER_SEC, "tex": settings.JOB_DEADLINE_TEX_SEC}.get(kind, 0)
+    return sec or None
+
+
+async def _cancel_watch(job: Job, worker_id: str, token: CancelToken):
+    # задачу сняли снаружи (проект удалён — строка ушла каскадом) — бросаем работу
+    while not token.cancelled:
+        await asyncio.sleep(settings.JOB_CANCEL_POLL_SEC)
+        try:
+            async with AsyncSessionLocal() as session:
+                row = (await session.execute(
+                    select(Job.status, Job.worker_id).where(Job.id == job.id)
+                )).one_or_none()
+        except Exception as e:
+            print(f"[worker] cancel check failed for job {job.id}: {e}")
+            continue
+        if row is None:
+            token.cancel("job deleted")
+        elif row.status != JobStatus.running or row.worker_id != worker_id:
+            token.cancel(f"job {row.status.value}")
+
+
+async def _heartbeat_loop(job: Job, worker_id: str, task: asyncio.Task):
+    while True:
+        await asyncio.sleep(settings.JOB_HEARTBEAT_SEC)
+        try:
+            async with AsyncSessionLocal() as session:
+                still_ours = await jobqueue.heartbeat(session, job.id, worker_id)
+        except Exception as e:
+            print(f"[worker] heartbeat failed for job {job.id}: {e}")
+            continue
+        if not still_ours:
+            print(f"[worker] lost lease on job {job.id}, stopping it")
+            task.cancel()
+            return
+
+
+async def worker(worker_id: str = WORKER_ID, kinds: Optional[list[str]] = None):
+    last_reap = 0.0
     while True:
-        job = await queue.get()
+        loop_now = asyncio.get_running_loop().time()
+        try:
+            if loop_now - last_reap > settings.JOB_LEASE_SEC / 2:
+                last_reap = loop_now
+                async with AsyncSessionLocal() as session:
+                    requeued, failed = await jobqueue.requeue_expired(session)
+                    await jobqueue.publish_depths(session)
+                if requeued or failed:
+                    print(f"[worker] expired leases: {requeued} requeued, {failed} failed")
+            async with AsyncSessionLocal() as session:
+                job = await jobqueue.lease(session, worker_id, kinds)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[worker] queue unavailable: {e}")
+            await asyncio.sleep(settings.WORKER_POLL_SEC * 5)
+            continue
+        if job is None:
+            await asyncio.sleep(settings.WORKER_POLL_SEC)
+            continue
+
+        token = CancelToken(_job_deadline(job.kind))
+        _rss.begin(job.id)
+        task = asyncio.create_task(_run_job(job, token))
+        hb = asyncio.create_task(_heartbeat_loop(job, worker_id, task))
+        watch = asyncio.create_task(_cancel_watch(job, worker_id, token))
+        # срок будит и тех, кто сейчас ничего не проверяет (ждёт latexmk, пул)
+        timer = asyncio.get_running_loop().call_later(token.remaining(), token.expire) if token.deadline else None
         try:
-            if job["kind"] == "infer":
-                await _do_infer(job["project_id"])
-            elif job["kind"] == "tex":
-                await _do_build_tex(job["project_id"], job["tex"])
+            await task
+            async with AsyncSessionLocal() as session:
+                await jobqueue.complete(session, job.id, worker_id)
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                # останавливают сам воркер — задачу заберёт другой после истечения аренды
+                raise
+            # задачу остановил хартбит: аренда потеряна, результат уже не наш
+        except DeadlineExceeded as e:
+            # повтор упрётся в тот же срок: сразу окончательный провал
+            print(f"[worker] job {job.id} ({job.kind}) deadline exceeded: {e}")
+            metrics.inc(f"jobs.deadline_exceeded.{job.kind}")
+            try:
+                async with AsyncSessionLocal() as session:
+                    await jobqueue.fail(session, job.id, worker_id, f"deadline exceeded: {e}", retry=False)
+            except Exception as e2:
+                print(f"[worker] failed to record job failure: {e2}")
+        except Cancelled as e:
+            print(f"[worker] job {job.id} ({job.kind}) cancelled: {e}")
+            try:
+                async with AsyncSessionLocal() as session:
+                    await jobqueue.cancel(session, job.id, worker_id, str(e) or "cancelled")
+            except Exception as e2:
+                print(f"[worker] failed to record job cancellation: {e2}")
         except Exception as e:
+            print(f"[worker] job {job.id} ({job.kind}) failed: {e}")
             try:
                 async with AsyncSessionLocal() as session:
-                    p = await _load_proj(session, job.get("project_id"))
-                    if p:
-                        p.status = ProjectStatus.failed
-                        await session.commit()
-            except Exception:
-                pass
-            print(f"[worker] job failed: {e}")
+                    retried = await jobqueue.fail(session, job.id, worker_id, repr(e))
+                print(f"[worker] job {job.id} {'requeued' if retried else 'gave up'}")
+            except Exception as e2:
+                print(f"[worker] failed to record job failure: {e2}")
         finally:
-            queue.task_done()
+            # пик считается на процесс: параллельные задачи слотов видят общий
+            metrics.observe(f"worker.job_peak_rss_mb.{job.kind}", _rss.end(job.id))
+            metrics.set_gauge("worker.rss_mb", rss_mb())
+            hb.cancel()
+            watch.cancel()
+            if timer is not None:
+                timer.cancel()
+
+
+async def _jobs_gc_loop(interval_sec: float):
+    # таблица jobs не растёт бесконечно: старые завершённые задачи удаляем
+    while True:
+        try:
+            async with AsyncSessionLocal() as session:
+                removed = await jobqueue.prune_finished(session)
+            if removed:
+                print(f"[worker] pruned {removed} finished job(s)")
+        except Exception as e:
+            print(f"[worker] job gc failed: {e}")
+        await asyncio.sleep(interval_sec)
+
+
+async def run_workers(concurrency: int, kinds: Optional[list[str]] = None, with_gc: bool = True,
+                      tex_slots: int = 0):
+    tasks = [asyncio.create_task(worker(f"{WORKER_ID}:{i}", kinds)) for i in range(concurrency)]
+    if tex_slots > 0 and (not kinds or "tex" in kinds):
+        # выделенные слоты под перекомпиляции: правка TeX не ждёт, пока освободится распознавание
+        tasks += [asyncio.create_task(worker(f"{WORKER_ID}:tex{i}", ["tex"])) for i in range(tex_slots)]
+    if with_gc:
+        tasks.append(asyncio.create_task(workspaces.gc_loop(settings.WORKSPACE_GC_INTERVAL_SEC)))
+        tasks.append(asyncio.create_task(_jobs_gc_loop(settings.JOB_GC_INTERVAL_SEC)))
+        tasks.append(asyncio.create_task(monitor_loop_lag("worker")))
+    print(f"[worker] {WORKER_ID} started: {concurrency} slot(s) + {tex_slots} tex slot(s), kinds={kinds or 'all'}")
+    await asyncio.gather(*tasks)
+
+
+async def _do_infer(project_id, token: Optional[CancelToken] = None):
+    async with workspaces.job("infer", size_hint=settings.INFER_WORKSPACE_HINT_MB * MB) as workdir:
+        await _run_infer(project_id, workdir, token)
 
-async def _do_infer(project_id):
+async def _run_infer(project_id, workdir: str, token: Optional[CancelToken] = None):
+    token = token or CancelToken()
     async with AsyncSessionLocal() as session:
         p = await _load_proj(session, project_id)
         if not p or not p.image_key:
             return
-        workdir = os.path.join(settings.TEMP_DIR, "work", uuid.uuid4().hex)
-        os.makedirs(workdir, exist_ok=True)
         local_image = os.path.join(workdir, "input.png")
         try:
             await asyncio.to_thread(fetch_to_path, p.image_key, local_image)
         except Exception as e:
             print(f"[worker] failed to fetch image '{p.image_key}': {e}")
             p.status = ProjectStatus.failed
+            await notify.publish(session, p.id)
             await session.commit()
             return
 
@@ -65,6 +199,7 @@ async def _do_infer(project_id):
             detector_weights=settings.DETECTOR_WEIGHTS,
             words_ocr_weights=settings.WORDS_OCR_WEIGHTS,
             trocr_dir=settings.TROCR_DIR,
+            htr_weights=settings.HTR_WEIGHTS,
             det_conf=settings.DET_CONF,
             det_iou=settings.DET_IOU,
             det_imgsz=settings.DET_IMGSZ,
@@ -79,80 +214,197 @@ async def _do_infer(project_id):
             make_csv=False,
             make_pdf=True,
         )
+        # очередь длинная — считаем дешевле, чтобы удержать время ожидания
+        tier = qos.pick(await admission.queue_depth(session, "infer"), is_premium(p.user))
+        params.update(qos.params_for(tier))
+        p.quality_tier = tier
+        metrics.inc(f"qos.tier.{tier}")
+        rec_key = pipeline_record.record_key(p.user_id, p.id)
 
+        cached_key = None  # запись кэша, из которой грузим артефакты: не вытеснять до конца загрузки
         try:
-            result = await asyncio.to_thread(run_full_pipeline, **params)
+            image_sha = await asyncio.to_thread(result_cache.sha256_file, local_image)
+            cache_key = await asyncio.to_thread(result_cache.result_key, local_image, params, image_sha)
+            result = await asyncio.to_thread(result_cache.lookup, cache_key)
+            if result:
+                cached_key = cache_key
+                print(f"[worker] result cache hit for project {p.id}")
+                docx_path = result.get("docx_path")
+            else:
+                record = await asyncio.to_thread(_load_record, rec_key, workdir)
+                token.raise_if_cancelled()
+                result = await _run_pipeline(dict(params, record=record, image_sha=image_sha), token)
+                if result.get("record"):
+                    await asyncio.to_thread(upload_bytes, pipeline_record.dump_record(result["record"]), rec_key)
+                if settings.UPLOAD_DEBUG_CROPS and result.get("crop_store"):
+                    await asyncio.to_thread(upload_file, result["crop_store"], f"users/{p.user_id}/projects/{p.id}/debug/page.crops")
+                result["docx_path"] = docx_path = await _maybe_make_docx_async(
+                    result.get("tex_path"), token, blocks=result.get("blocks"))
+                await asyncio.to_thread(result_cache.store, cache_key, result)
+            token.raise_if_cancelled()
+            # превью формул рисуются в фоне, пока грузятся артефакты; здесь, а не в
+            # pipeline: тот идёт в дочернем процессе, и там был бы свой пул на каждого
+            snippets.prewarm(b.get("content") for b in result.get("blocks") or [] if b.get("kind") == "formula")
             tex_path = result.get("tex_path"); pdf_path = result.get("pdf_path")
-            docx_path = await asyncio.to_thread(_maybe_make_docx, tex_path)
-            if tex_path: upload_file(tex_path, f"users/{p.user_id}/projects/{p.id}/formulas.tex"); p.tex_key = f"users/{p.user_id}/projects/{p.id}/formulas.tex"
-            if pdf_path: upload_file(pdf_path, f"users/{p.user_id}/projects/{p.id}/formulas.pdf"); p.pdf_key = f"users/{p.user_id}/projects/{p.id}/formulas.pdf"
-            if docx_path: upload_file(docx_path, f"users/{p.user_id}/projects/{p.id}/formulas.docx"); p.docx_key = f"users/{p.user_id}/projects/{p.id}/formulas.docx"
+            base = f"users/{p.user_id}/projects/{p.id}"
+            arts = [(path, ext) for path, ext in ((tex_path, "tex"), (pdf_path, "pdf"), (docx_path, "docx")) if path]
+            await asyncio.gather(*(asyncio.to_thread(upload_file, path, f"{base}/formulas.{ext}") for path, ext in arts))
+            if tex_path: p.tex_key = f"{base}/formulas.tex"
+            if pdf_path: p.pdf_key = f"{base}/formulas.pdf"
+            if docx_path: p.docx_key = f"{base}/formulas.docx"
+            p.blocks = _stored_blocks(result.get("blocks"))
             p.status = ProjectStatus.ready
+        except Cancelled:
+            raise
         except Exception as e:
             print(e)
             p.status = ProjectStatus.failed
+        finally:
+            if cached_key is not None:
+                result_cache.release(cached_key)
+        await notify.publish(session, p.id)
         await session.commit()
 
-async def _do_build_tex(project_id, tex_content: str):
+def _stored_blocks(blocks: Optional[list]) -> list:
+    # то, из чего собран tex: хватает, чтобы пересобрать строку после правки блока;
+    # issues/warnings проверки формулы — для ответа API и повторной сборки без новой проверки
+    return [{"idx": b["idx"], "kind": b["kind"], "bbox": [float(v) for v in b["bbox"]],
+             "content": b.get("content") or "",
+             **{k: b[k] for k in ("issues", "warnings") if k in b}} for b in blocks or []]
+
+async def _do_build_tex(project_id, tex_content: str, rev: Optional[int] = None,
+                        token: Optional[CancelToken] = None, prepared: bool = False,
+                        blocks: Optional[list] = None):
+    # мелкая задача: оценка ~ исходник + pdf/docx, подходит для tmpfs
+    async with workspaces.job("tex", size_hint=len(tex_content or "") * 4 + 2 * MB) as workdir:
+        token = token or CancelToken()
+        watch = asyncio.create_task(_watch_revision(project_id, rev, token)) if rev is not None else None
+        try:
+            await _run_build_tex(project_id, tex_content, workdir, rev, token, prepared=prepared, blocks=blocks)
+        finally:
+            if watch is not None:
+                watch.cancel()
+
+async def _watch_revision(project_id, rev: int, token: CancelToken):
+    # пришла правка новее — сборка этой ревизии больше никому не нужна, убиваем latexmk
+    while not token.cancelled:
+        await asyncio.sleep(settings.TEX_SUPERSEDE_POLL_SEC)
+        try:
+            current = await _tex_revision(project_id)
+        except Exception as e:
+            print(f"[worker] revision check failed for {project_id}: {e}")
+            continue
+        if current is None or current > rev:
+            token.cancel(f"superseded by revision {current}" if current is not None else "project deleted")
+
+async def _tex_revision(project_id) -> Optional[int]:
+    async with AsyncSessionLocal() as session:
+        return (await session.execute(select(Project.tex_revision).where(Project.id == project_id))).scalar_one_or_none()
+
+async def _run_build_tex(project_id, tex_content: str, workdir: str, rev: Optional[int] = None,
+                         token: Optional[CancelToken] = None, prepared: bool = False,
+                         blocks: Optional[list] = None):
+    token = token or CancelToken()
     async with AsyncSessionLocal() as session:
         p = await _load_proj(session, project_id)
         if not p:
             return
-        tex_content = _wrap_tex_if_needed(tex_content)
+        if rev is not None and p.tex_revision > rev:
+            raise Cancelled(f"superseded by revision {p.tex_revision}")
+        if not prepared:
+            tex_content = _wrap_tex_if_needed(tex_content)
 
-        workdir = os.path.join(settings.TEMP_DIR, "work", uuid.uuid4().hex)
-        os.makedirs(workdir, exist_ok=True)
         tex_path = os.path.join(workdir, "patched.tex")
 
         with open(tex_path, "w", encoding="utf-8") as f:
             f.write(tex_content)
+        # превью: перерисуются только изменённые формулы, остальные уже в кэше
+        snippets.prewarm(formulas_from_tex(tex_content).values())
 
-        pdf_path = None
-        docx_path = None
-        try:
-            pdf_path = compile_tex_file_to_pdf(tex_path, engine="pdflatex", timeout=240)
-        except Exception as e:
-            print(f"[worker] pdf compile failed (patch): {e}")
-            pdf_path = None
+        pdf_path, docx_path = await _build_tex_artifacts(tex_path, token)
 
+        token.raise_if_cancelled()
+        # выкладываем под ключи этой ревизии без блокировок: текущие файлы
+        # проекта не трогаем, правки (PATCH) в это время не ждут
+        base = f"users/{p.user_id}/projects/{p.id}/rev{rev if rev is not None else uuid.uuid4().hex[:12]}"
+        keys = {"tex": f"{base}/formulas.tex"}
+        keys.update({ext: f"{base}/formulas.{ext}" for path, ext in ((pdf_path, "pdf"), (docx_path, "docx")) if path})
+        paths = {"tex": tex_path, "pdf": pdf_path, "docx": docx_path}
         try:
-            docx_path = _maybe_make_docx(tex_path)
+            await asyncio.gather(*(asyncio.to_thread(upload_file, paths[ext], key) for ext, key in keys.items()))
+            uploaded = True
         except Exception as e:
-            print(f"[worker] docx make failed (patch): {e}")
-            docx_path = None
-
-        try:
-            upload_file(tex_path, f"users/{p.user_id}/projects/{p.id}/formulas.tex")
-            p.tex_key = f"users/{p.user_id}/projects/{p.id}/formulas.tex"
+            print(f"[worker] upload failed (patch): {e}")
+            uploaded = False
 
-            if pdf_path:
-                upload_file(pdf_path, f"users/{p.user_id}/projects/{p.id}/formulas.pdf")
-                p.pdf_key = f"users/{p.user_id}/projects/{p.id}/formulas.pdf"
-            else:
-                p.pdf_key = None
-
-            if docx_path:
-                upload_file(docx_path, f"users/{p.user_id}/projects/{p.id}/formulas.docx")
-                p.docx_key = f"users/{p.user_id}/projects/{p.id}/formulas.docx"
-            else:
-                p.docx_key = None
+        # строку блокируем только на проверку ревизии и смену ключей
+        p = (await session.execute(
+            select(Project).where(Project.id == project_id).with_for_update()
+            .execution_options(populate_existing=True)
+        )).unique().scalar_one_or_none()
+        current = p.tex_revision if p else None
+        if current is None or (rev is not None and current > rev) or token.cancelled:
+            await session.rollback()
+            await asyncio.to_thread(_delete_quietly, list(keys.values()))
+            if current is None:
+                return
+            token.raise_if_cancelled()
+            raise Cancelled(f"superseded by revision {current}")
 
-            p.status = ProjectStatus.ready if p.tex_key else ProjectStatus.failed
-        except Exception as e:
-            print(f"[worker] upload or status update failed (patch): {e}")
+        stale = []
+        if uploaded:
+            stale = [k for k in (p.tex_key, p.pdf_key, p.docx_key) if k and k not in keys.values()]
+            p.tex_key = keys["tex"]
+            p.pdf_key = keys.get("pdf")
+            p.docx_key = keys.get("docx")
+            if blocks is not None:
+                p.blocks = blocks  # блоки правки — вместе с её tex, не раньше
+            p.status = ProjectStatus.ready
+        else:
+            stale = list(keys.values())  # что успело выложиться — никому не нужно
             p.status = ProjectStatus.failed
 
+        await notify.publish(session, p.id)
         await session.commit()
+        # прежние файлы больше никто не читает: ключи в строке уже новые
+        await asyncio.to_thread(_delete_quietly, stale)
+
+def _delete_quietly(keys: list[str]) -> None:
+    if not keys:
+        return
+    try:
+        delete_objects(keys)
+    except Exception as e:
+        print(f"[worker] failed to delete {keys}: {e}")
+
 
+async def _run_pipeline(params: dict, token: Optional[CancelToken] = None) -> dict:
+    if settings.INFER_POOL_SIZE <= 0:
+        from app.pipeline import run_full_pipeline
+        return await asyncio.to_thread(run_full_pipeline, cancel=token, **params)
+    page = await asyncio.to_thread(_decode_page, params["image_path"])
+    return await inference_pool.get_pool().run(page, params, cancel=token)
+
+def _decode_page(path: str):
+    import cv2
+    page = cv2.imread(path, cv2.IMREAD_COLOR)
+    if page is None:
+        raise ValueError(f"cannot decode image: {path}")
+    return page
+
+def _load_record(key: str, workdir: str) -> dict | None:
+    local = os.path.join(workdir, "pipeline.json")
+    try:
+        fetch_to_path(key, local)
+        return json.loads(Path(local).read_text(encoding="utf-8"))
+    except Exception:
+        return None
 
 async def _load_proj(session: AsyncSession, pid):
     res = await session.execute(select(Project).where(Project.id==pid))
     return res.unique().scalar_one_or_none()
 
-def _maybe_make_docx(tex_path: str) -> str | None:
-    tex_path = str(Path(tex_path).resolve())
-    out = tex_path.replace(".tex", ".docx")
-
+def _pandoc_exe() -> str | None:
     pandoc_exe = shutil.which("pandoc")
     if not pandoc_exe and sys.platform.startswith("win"):
         candidates = [
@@ -163,24 +415,9 @@ def _maybe_make_docx(tex_path: str) -> str | None:
             if os.path.exists(c):
                 pandoc_exe = c
                 break
+    return pandoc_exe
 
-    if pandoc_exe:
-        try:
-            print(f"[worker] using pandoc: {pandoc_exe}")
-            subprocess.run(
-                [pandoc_exe, tex_path, "-o", out],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            if os.path.exists(out):
-                return out
-        except subprocess.CalledProcessError as e:
-            print(f"[worker] pandoc failed:\n{e.stderr}")
-        except Exception as e:
-            print(f"[worker] pandoc error: {e}")
-
+def _fallback_docx(tex_path: str, out: str) -> str | None:
     try:
         from docx import Document
         txt = Path(tex_path).read_text(encoding="utf-8", errors="ignore")
@@ -192,6 +429,80 @@ def _maybe_make_docx(tex_path: str) -> str | None:
         print(f"[worker] fallback docx failed: {e}")
         return None
 
+def _docx_cache_key(tex_path: str, pandoc_exe: str) -> str | None:
+    if not tex_cache.enabled():
+        return None
+    return tex_cache.key(tex_path, f"docx:{tool_version(pandoc_exe)}")
+
+def _native_docx(tex_path: str, out: str, blocks: Optional[list] = None) -> str | None:
+    # None — tex вне подмножества build_mixed_document, нужен pandoc
+    if blocks is not None:
+        paragraphs = docx_writer.paragraphs_from_blocks(blocks, validate=settings.LATEX_VALIDATE)
+    else:
+        paragraphs = docx_writer.paragraphs_from_tex(Path(tex_path).read_text(encoding="utf-8", errors="replace"))
+    if paragraphs is None:
+        return None
+    return docx_writer.write_docx(paragraphs, out)
+
+async def _maybe_make_docx_async(tex_path: str, cancel: Optional[CancelToken] = None,
+                                 blocks: Optional[list] = None) -> str | None:
+    # blocks — блоки распознавания, из которых собран tex: docx пишем прямо по ним
+    tex_path = str(Path(tex_path).resolve())
+    out = tex_path.replace(".tex", ".docx")
+
+    if settings.DOCX_NATIVE:
+        try:
+            if await asyncio.to_thread(_native_docx, tex_path, out, blocks):
+                metrics.inc("docx.native")
+                return out
+        except Exception as e:
+            print(f"[worker] native docx failed, falling back to pandoc: {e}")
+
+    pandoc_exe = _pandoc_exe()
+    if pandoc_exe:
+        ck = await asyncio.to_thread(_docx_cache_key, tex_path, pandoc_exe)
+        if await asyncio.to_thread(tex_cache.fetch, ck, "out.docx", out):
+            return out
+        try:
+            print(f"[worker] using pandoc: {pandoc_exe}")
+            code, _, err = await run_command_async(
+                [pandoc_exe, tex_path, "-o", out], cwd=Path(tex_path).parent, env=dict(os.environ),
+                timeout=settings.PANDOC_TIMEOUT_SEC, cancel=cancel,
+            )
+            if code == 0 and os.path.exists(out):
+                metrics.inc("docx.pandoc")
+                await asyncio.to_thread(tex_cache.store, ck, "out.docx", out)
+                return out
+            print(f"[worker] pandoc failed:\n{err}")
+        except (Cancelled, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            print(f"[worker] pandoc error: {e}")
+
+    return await asyncio.to_thread(_fallback_docx, tex_path, out)
+
+async def _build_tex_artifacts(tex_path: str, cancel: Optional[CancelToken] = None) -> tuple[str | None, str | None]:
+    # pdf (pdflatex) и docx независимы: собираем параллельно, ошибка одного не мешает другому
+    report: dict = {}
+    pdf_res, docx_res = await asyncio.gather(
+        compile_tex_file_to_pdf_async(tex_path, engine="pdflatex", timeout=settings.LATEX_COMPILE_TIMEOUT_SEC,
+                                      cancel=cancel, report=report),
+        _maybe_make_docx_async(tex_path, cancel),
+        return_exceptions=True,
+    )
+    for res in (pdf_res, docx_res):
+        if isinstance(res, (Cancelled, asyncio.CancelledError)):
+            raise res
+    if report:
+        print(f"[worker] pdf: {report['passes']} pass(es) {report['pass_ms']} ms, cached={report['cached']}")
+    if isinstance(pdf_res, BaseException):
+        print(f"[worker] pdf compile failed (patch): {pdf_res}")
+        pdf_res = None
+    if isinstance(docx_res, BaseException):
+        print(f"[worker] docx make failed (patch): {docx_res}")
+        docx_res = None
+    return (str(pdf_res) if pdf_res else None), docx_res
+
 
 def _wrap_tex_if_needed(tex_content: str) -> str:
     body = (tex_content or "").strip()
@@ -210,3 +521,23 @@ def _wrap_tex_if_needed(tex_content: str) -> str:
 
     header = HEADER.replace("%TITLE%", "Patched")
     return header + body + FOOTER
+
+
+def main(argv: Optional[list[str]] = None):
+    ap = argparse.ArgumentParser(description="Note2Tex job worker")
+    ap.add_argument("--concurrency", type=int, default=settings.WORKER_CONCURRENCY)
+    ap.add_argument("--kinds", default="", help="comma-separated job kinds (infer,tex); empty = all")
+    ap.add_argument("--tex-slots", type=int, default=settings.WORKER_TEX_SLOTS, help="extra slots serving only tex jobs")
+    args = ap.parse_args(argv)
+    kinds = [k.strip() for k in args.kinds.split(",") if k.strip()] or None
+    settings.WORKER_CONCURRENCY = args.concurrency  # от неё — потоки процесса пула (inference_pool.job_threads)
+    try:
+        asyncio.run(run_workers(args.concurrency, kinds, tex_slots=args.tex_slots))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        inference_pool.shutdown_pool()
+
+
+if __name__ == "__main__":
+    main()
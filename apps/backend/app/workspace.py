@@ -0,0 +1,177 @@
+import asyncio, hashlib, os, shutil, socket, time, uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Optional
+
+from app import metrics
+from app.config import settings
+
+# Рабочие папки задач: выдаются на время задачи и удаляются после неё.
+# Имя папки <kind>-<node>-<pid>-<uuid>: GC считает папку сиротой, если на
+# этом узле процесса с таким pid больше нет или папка старше
+# WORKSPACE_ORPHAN_TTL_SEC (папки других узлов на общем томе — только по TTL).
+
+MB = 1024 * 1024
+NODE = hashlib.sha1(socket.gethostname().encode("utf-8")).hexdigest()[:8]
+
+
+def _dir_size(p: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(p):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _owner_pid(name: str) -> Optional[int]:
+    parts = name.rsplit("-", 3)
+    if len(parts) == 4 and parts[1] == NODE and parts[2].isdigit():
+        return int(parts[2])
+    return None
+
+
+class WorkspaceManager:
+    def __init__(
+        self,
+        root: str | Path,
+        tmpfs_root: str | Path | None = None,
+        quota_bytes: int = 0,
+        tmpfs_max_bytes: int = 0,
+        orphan_ttl_sec: float = 6 * 3600,
+        gc_only_roots: tuple = (),
+    ):
+        self.root = Path(root)
+        self.tmpfs_root = Path(tmpfs_root) if tmpfs_root else None
+        self.quota_bytes = int(quota_bytes)
+        self.tmpfs_max_bytes = int(tmpfs_max_bytes)
+        self.orphan_ttl_sec = orphan_ttl_sec
+        self.gc_only_roots = [Path(r) for r in gc_only_roots]
+        self._active: dict[Path, int] = {}  # папка -> зарезервированный объём
+        self._foreign_bytes = 0             # чужие процессы, по последнему замеру GC
+        self._cond: Optional[asyncio.Condition] = None
+
+    def _condition(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def _roots(self) -> list[Path]:
+        return [r for r in (self.root, self.tmpfs_root) if r is not None]
+
+    def bytes_in_use(self) -> int:
+        return self._foreign_bytes + sum(self._active.values())
+
+    def _fits(self, reserve: int) -> bool:
+        if self.quota_bytes <= 0 or not self._active:
+            # без квоты или при пустом процессе пускаем всегда, чтобы не встать навсегда
+            return True
+        return self.bytes_in_use() + reserve <= self.quota_bytes
+
+    def _pick_root(self, size_hint: int) -> Path:
+        if self.tmpfs_root and 0 < size_hint <= self.tmpfs_max_bytes:
+            try:
+                self.tmpfs_root.mkdir(parents=True, exist_ok=True)
+                usage = shutil.disk_usage(self.tmpfs_root)
+                if usage.free > 4 * size_hint:
+                    return self.tmpfs_root
+            except OSError:
+                pass
+        return self.root
+
+    def _publish(self) -> None:
+        metrics.set_gauge("workspace.bytes_in_use", self.bytes_in_use())
+        metrics.set_gauge("workspace.active", len(self._active))
+
+    @asynccontextmanager
+    async def job(self, kind: str, size_hint: int = 0):
+        reserve = max(int(size_hint), settings.WORKSPACE_MIN_RESERVE_MB * MB)
+        cond = self._condition()
+        t0 = time.monotonic()
+        async with cond:
+            await cond.wait_for(lambda: self._fits(reserve))
+            path = self._pick_root(size_hint) / f"{kind}-{NODE}-{os.getpid()}-{uuid.uuid4().hex}"
+            self._active[path] = reserve
+        metrics.observe("workspace.wait_sec", time.monotonic() - t0)
+        self._publish()
+        try:
+            path.mkdir(parents=True, exist_ok=True)
+            yield str(path)
+        finally:
+            await asyncio.to_thread(shutil.rmtree, path, True)
+            async with cond:
+                self._active.pop(path, None)
+                cond.notify_all()
+            self._publish()
+
+    def collect(self) -> int:
+        # удаляет сирот и пересчитывает занятый чужими процессами объём
+        now = time.time()
+        removed = 0
+        foreign = 0
+        for root in self._roots() + self.gc_only_roots:
+            if not root.exists():
+                continue
+            for d in root.iterdir():
+                if d in self._active:
+                    continue
+                try:
+                    age = now - d.stat().st_mtime
+                except OSError:
+                    continue
+                pid = _owner_pid(d.name)
+                orphan = age > self.orphan_ttl_sec or (pid is not None and not _pid_alive(pid))
+                if orphan:
+                    if d.is_dir():
+                        shutil.rmtree(d, ignore_errors=True)
+                    else:
+                        try:
+                            d.unlink()
+                        except OSError:
+                            pass
+                    removed += 1
+                elif d.is_dir():
+                    foreign += _dir_size(d)
+        self._foreign_bytes = foreign
+        if removed:
+            metrics.inc("workspace.gc_removed", removed)
+        self._publish()
+        return removed
+
+    async def gc_loop(self, interval_sec: float = 300.0):
+        while True:
+            try:
+                removed = await asyncio.to_thread(self.collect)
+                if removed:
+                    print(f"[workspace] gc removed {removed} orphan(s)")
+                cond = self._condition()
+                async with cond:
+                    cond.notify_all()
+            except Exception as e:
+                print(f"[workspace] gc failed: {e}")
+            await asyncio.sleep(interval_sec)
+
+
+workspaces = WorkspaceManager(
+    root=os.path.join(settings.TEMP_DIR, "work"),
+    tmpfs_root=settings.WORKSPACE_TMPFS_DIR or None,
+    quota_bytes=settings.WORKSPACE_QUOTA_MB * MB,
+    tmpfs_max_bytes=settings.WORKSPACE_TMPFS_MAX_MB * MB,
+    orphan_ttl_sec=settings.WORKSPACE_ORPHAN_TTL_SEC,
+    # старый inbox из create_project: файлы там больше не создаются, только подчищаем
+    gc_only_roots=(os.path.join(settings.TEMP_DIR, "inbox"),),
+)
@@ -0,0 +1,92 @@
+"""Пропускная способность распознавания в зависимости от числа страниц в работе.
+
+Сравнивает покадровые вызовы модели (как до MicroBatcher) и общий батчер
+процесса. По умолчанию модель синтетическая: вызов стоит
+--overhead-ms + --item-ms * размер батча (sleep отпускает GIL, как torch).
+С --trocr-dir меряется настоящий TrOCR на случайных кропах.
+
+    python -m benchmarks.bench_batching --pages 1 2 4 8 16 --crops 12
+
+Сколько страниц на деле идёт в одном процессе пула — inference_pool.job_threads():
+по умолчанию WORKER_CONCURRENCY / INFER_POOL_SIZE (2 / 1 -> 2 страницы);
+строка "default" в выводе — пропускная способность при этой конфигурации.
+"""
+import argparse, threading, time
+
+from app import inference_pool, metrics
+from app.batcher import MicroBatcher
+from app.config import settings
+
+
+def synthetic_model(overhead_ms: float, item_ms: float):
+    def run(items, key=()):
+        time.sleep((overhead_ms + item_ms * len(items)) / 1000.0)
+        return [f"x{i}" for i in range(len(items))]
+    return run
+
+
+def trocr_model(model_dir: str, beams: int):
+    import numpy as np
+    from PIL import Image
+    from app.utils.recognize_formula import load_trocr, recognize_batch
+    processor, model, device = load_trocr(model_dir)
+    rng = np.random.default_rng(0)
+    crop = Image.fromarray(rng.integers(0, 255, (64, 256, 3), dtype=np.uint8))
+
+    def run(items, key=()):
+        return recognize_batch(processor, model, device, [crop] * len(items), max_new_tokens=64, num_beams=beams)
+    return run
+
+
+def _drive(pages: int, crops: int, per_page) -> float:
+    threads = [threading.Thread(target=per_page, args=(crops,)) for _ in range(pages)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return pages / (time.perf_counter() - t0)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pages", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    ap.add_argument("--crops", type=int, default=12, help="кропов на страницу")
+    ap.add_argument("--max-batch", type=int, default=16)
+    ap.add_argument("--max-wait-ms", type=float, default=5.0)
+    ap.add_argument("--overhead-ms", type=float, default=20.0)
+    ap.add_argument("--item-ms", type=float, default=2.0)
+    ap.add_argument("--trocr-dir", default="")
+    ap.add_argument("--beams", type=int, default=4)
+    args = ap.parse_args(argv)
+
+    fn = trocr_model(args.trocr_dir, args.beams) if args.trocr_dir else synthetic_model(args.overhead_ms, args.item_ms)
+    model_lock = threading.Lock()  # без батчера модель одна на процесс и вызывается по очереди
+
+    def unbatched(n):
+        for i in range(n):
+            with model_lock:
+                fn([i])
+
+    batcher = MicroBatcher(fn, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms, name="bench")
+
+    def batched(n):
+        batcher.map(range(n))
+
+    print(f"{'pages':>6} {'unbatched p/s':>14} {'batched p/s':>12} {'speedup':>8} {'avg batch':>10}")
+    for pages in args.pages:
+        metrics.reset()
+        u = _drive(pages, args.crops, unbatched)
+        b = _drive(pages, args.crops, batched)
+        avg = metrics.snapshot()["summaries"].get("batch.bench.size", {}).get("avg", 0.0)
+        print(f"{pages:>6} {u:>14.2f} {b:>12.2f} {b / u:>7.2f}x {avg:>10.1f}")
+    default = inference_pool.job_threads()
+    metrics.reset()
+    u, b = _drive(default, args.crops, unbatched), _drive(default, args.crops, batched)
+    print(f"default: WORKER_CONCURRENCY={settings.WORKER_CONCURRENCY} INFER_POOL_SIZE={settings.INFER_POOL_SIZE} "
+          f"-> {default} page(s) per process, {u:.2f} -> {b:.2f} p/s")
+    batcher.close()
+
+
+if __name__ == "__main__":
+    main()
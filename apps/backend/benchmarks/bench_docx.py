@@ -0,0 +1,78 @@
+"""Время сборки docx для распознанной страницы: свой писатель против pandoc.
+
+Страница синтетическая: --lines строк, в каждой текст и пара формул в
+строке, через одну — выключенная формула. Свой писатель меряется и по
+блокам (как после распознавания), и по tex (как после правки). pandoc —
+если есть в PATH, запуск на каждый замер, как у воркера.
+
+    python -m benchmarks.bench_docx --runs 10 --lines 30
+"""
+import argparse, shutil, statistics, subprocess, tempfile, time
+from pathlib import Path
+
+from app.utils import docx_writer
+from app.utils.assemble_latex import build_mixed_document
+
+FORMULAS = [r"\int_0^{1} x^2\,dx = \frac{1}{3}", r"\sum_{i=1}^{n} a_i b_i", r"\sqrt{x^2+y^2}",
+            r"\left( \frac{a}{b} \right)^{2}", r"\begin{pmatrix} 1 & 0 \\ 0 & 1 \end{pmatrix}"]
+
+
+def _blocks(lines: int) -> list[dict]:
+    out, idx = [], 0
+    for i in range(lines):
+        y = i * 100.0
+        if i % 2:
+            out.append({"idx": idx, "kind": "formula", "content": FORMULAS[i % len(FORMULAS)], "bbox": (0, y, 400, y + 40)})
+            idx += 1
+            continue
+        for j, (kind, content) in enumerate((("text", f"строка {i}"), ("formula", "x_{%d}^2" % i),
+                                             ("text", "и"), ("formula", FORMULAS[i % len(FORMULAS)]))):
+            out.append({"idx": idx, "kind": kind, "content": content, "bbox": (j * 100, y, j * 100 + 90, y + 30)})
+            idx += 1
+    return out
+
+
+def _timed(fn, runs: int) -> list[float]:
+    out = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory(prefix="bench_docx_") as d:
+            t0 = time.perf_counter()
+            fn(Path(d))
+            out.append((time.perf_counter() - t0) * 1000.0)
+    return out
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=10)
+    ap.add_argument("--lines", type=int, default=30)
+    args = ap.parse_args(argv)
+
+    blocks = _blocks(args.lines)
+    tex = build_mixed_document([(b["idx"], b["kind"], b["content"], *b["bbox"]) for b in blocks], title="Bench")
+
+    def from_blocks(d: Path):
+        docx_writer.write_docx(docx_writer.paragraphs_from_blocks(blocks), d / "page.docx")
+
+    def from_tex(d: Path):
+        docx_writer.write_docx(docx_writer.paragraphs_from_tex(tex), d / "page.docx")
+
+    rows = [("native/blocks", _timed(from_blocks, args.runs)), ("native/tex", _timed(from_tex, args.runs))]
+    pandoc = shutil.which("pandoc")
+    if pandoc:
+        def with_pandoc(d: Path):
+            (d / "page.tex").write_text(tex, encoding="utf-8")
+            subprocess.run([pandoc, "page.tex", "-o", "page.docx"], cwd=d, check=True, capture_output=True)
+        rows.append(("pandoc", _timed(with_pandoc, args.runs)))
+    else:
+        print("pandoc not found: native only")
+
+    print(f"{'writer':>14} {'median ms':>10} {'mean ms':>9} {'min ms':>8}")
+    for label, ms in rows:
+        print(f"{label:>14} {statistics.median(ms):>10.1f} {statistics.mean(ms):>9.1f} {min(ms):>8.1f}")
+    if pandoc:
+        print(f"speedup vs pandoc: {statistics.median(rows[-1][1]) / statistics.median(rows[0][1]):.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Время компиляции одностраничного документа с предкомпилированной преамбулой и без.
+
+Нужен pdflatex (latexmk — если есть, как в проде). Каждая компиляция — в
+своей свежей папке, как у воркера. Формат собирается один раз до замеров,
+его время печатается отдельно.
+
+    python -m benchmarks.bench_latex_format --runs 10 --formulas 20
+"""
+import argparse, os, statistics, tempfile, time
+from pathlib import Path
+
+from app.config import settings
+from app.utils import latex_format
+from app.utils.assemble_latex import FOOTER, HEADER
+from app.utils.latex_to_pdf import _extend_path, _which, compile_tex_file_to_pdf
+
+
+def _document(formulas: int) -> str:
+    body = "".join(f"\\[\n\\int_0^{{{i}}} x^2\\,dx = \\frac{{{i}^3}}{{3}}\n\\]\nТекст строки {i}.\n" for i in range(formulas))
+    return HEADER.replace("%TITLE%", "Bench") + body + FOOTER
+
+
+def _timed(doc: str, runs: int) -> list[float]:
+    out = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory(prefix="bench_tex_") as d:
+            tex = Path(d) / "formulas.tex"
+            tex.write_text(doc, encoding="utf-8")
+            t0 = time.perf_counter()
+            compile_tex_file_to_pdf(tex, timeout=240)
+            out.append((time.perf_counter() - t0) * 1000.0)
+    return out
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=10)
+    ap.add_argument("--formulas", type=int, default=20)
+    args = ap.parse_args(argv)
+
+    env = _extend_path(os.environ.copy())
+    engine = _which("pdflatex", env)
+    if not engine:
+        raise SystemExit("pdflatex not found")
+    doc = _document(args.formulas)
+
+    with tempfile.TemporaryDirectory(prefix="bench_fmt_") as fmt_dir:
+        settings.LATEX_FORMAT_DIR = fmt_dir
+        t0 = time.perf_counter()
+        if latex_format.build_format(engine, env) is None:
+            raise SystemExit("format build failed")
+        print(f"format build: {(time.perf_counter() - t0) * 1000.0:.0f} ms")
+
+        rows = []
+        for label, enabled in (("full preamble", False), ("precompiled", True)):
+            settings.LATEX_PRECOMPILED_FORMAT = enabled
+            rows.append((label, _timed(doc, args.runs)))
+
+    print(f"{'mode':>14} {'median ms':>10} {'mean ms':>9} {'min ms':>8}")
+    for label, ms in rows:
+        print(f"{label:>14} {statistics.median(ms):>10.0f} {statistics.mean(ms):>9.0f} {min(ms):>8.0f}")
+    base, fast = (statistics.median(ms) for _, ms in rows)
+    print(f"speedup: {base / fast:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
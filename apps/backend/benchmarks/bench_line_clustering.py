@@ -0,0 +1,87 @@
+"""Время разбивки блоков на строки (_cluster_into_lines) в зависимости от их числа.
+
+Страница синтетическая: строки текста по --per-line блоков с разбросом по
+высоте и редкими высокими формулами; 10k блоков — это десятки склеенных
+страниц. Прежняя реализация (каждый блок против каждой строки) меряется
+только до --legacy-max блоков — дальше она идёт минутами.
+
+    python -m benchmarks.bench_line_clustering --sizes 100 1000 10000 --runs 3
+"""
+import argparse, random, statistics, time
+
+from app.utils.assemble_latex import _cluster_into_lines, _vertical_overlap, _x_left, _y_center
+
+
+def _legacy(blocks):
+    bs = [b for b in blocks if b["content"].strip()]
+    bs_sorted = sorted(bs, key=lambda b: (b["bbox"][1], b["bbox"][0]))
+    heights = [max(1.0, float(b["bbox"][3] - b["bbox"][1])) for b in bs_sorted]
+    med_h = statistics.median(heights)
+    y_tol = max(10.0, 0.6 * med_h)
+    if statistics.pstdev(heights) > 0.8 * (med_h + 1e-6):
+        y_tol *= 1.25
+    lines = []
+    for b in bs_sorted:
+        cy = _y_center(b)
+        best, best_score = -1, -1.0
+        for i, line in enumerate(lines):
+            line_cy = statistics.median([_y_center(x) for x in line])
+            dy = abs(cy - line_cy)
+            ovl = max(_vertical_overlap(b, x) for x in line)
+            score = (max(0.0, y_tol - dy) / y_tol) + 0.5 * ovl
+            if (dy <= y_tol or ovl >= 0.5) and score > best_score:
+                best_score, best = score, i
+        if best >= 0:
+            lines[best].append(b)
+        else:
+            lines.append([b])
+    for line in lines:
+        line.sort(key=_x_left)
+    lines.sort(key=lambda ln: min(b["bbox"][1] for b in ln))
+    return lines
+
+
+def _blocks(n: int, per_line: int, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    out = []
+    for i in range(n):
+        row, col = divmod(i, per_line)
+        h = rng.uniform(14, 26) * (4 if rng.random() < 0.02 else 1)
+        y = row * 32 + rng.uniform(-3, 3)
+        x = col * 90 + rng.uniform(0, 10)
+        out.append({"idx": i, "kind": "text", "content": "x", "bbox": (x, y, x + 80, y + h)})
+    return out
+
+
+def _timed(fn, blocks, runs: int) -> list[float]:
+    out = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn(blocks)
+        out.append((time.perf_counter() - t0) * 1000.0)
+    return out
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    ap.add_argument("--runs", type=int, default=3)
+    ap.add_argument("--per-line", type=int, default=6)
+    ap.add_argument("--legacy-max", type=int, default=1000)
+    args = ap.parse_args(argv)
+
+    print(f"{'blocks':>7} {'lines':>6} {'sweep ms':>9} {'legacy ms':>10} {'speedup':>8}")
+    for n in args.sizes:
+        blocks = _blocks(n, args.per_line)
+        lines = _cluster_into_lines(blocks)
+        new = statistics.median(_timed(_cluster_into_lines, blocks, args.runs))
+        if n <= args.legacy_max:
+            assert [[b["idx"] for b in ln] for ln in _legacy(blocks)] == [[b["idx"] for b in ln] for ln in lines]
+            old = statistics.median(_timed(_legacy, blocks, args.runs))
+            print(f"{n:>7} {len(lines):>6} {new:>9.1f} {old:>10.1f} {old / new:>7.1f}x")
+        else:
+            print(f"{n:>7} {len(lines):>6} {new:>9.1f} {'-':>10} {'-':>8}")
+
+
+if __name__ == "__main__":
+    main()
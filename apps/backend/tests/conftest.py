@@ -0,0 +1,57 @@
+import uuid
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app import worker
+from app.database import Base, get_session
+from app.main import app
+from app.models import Project, ProjectStatus, User
+
+# Общая БД для тестов: SQLite в памяти вместо Postgres (FOR UPDATE SKIP LOCKED
+# просто опускается), своя на каждый тест. Фабрикой сессий пользуются и API
+# (get_session), и воркер (AsyncSessionLocal).
+
+
+@pytest.fixture
+async def Session(monkeypatch):
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    maker = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    async def _session():
+        async with maker() as s:
+            yield s
+
+    monkeypatch.setitem(app.dependency_overrides, get_session, _session)
+    monkeypatch.setattr(worker, "AsyncSessionLocal", maker)
+    yield maker
+    await engine.dispose()
+
+
+@pytest.fixture
+def make_user(Session):
+    async def make(**kw) -> User:
+        async with Session() as s:
+            u = User(email=f"{uuid.uuid4().hex}@x.io", username=uuid.uuid4().hex[:12], password_hash="h",
+                     email_verified=True, **kw)
+            s.add(u)
+            await s.commit()
+            return u
+    return make
+
+
+@pytest.fixture
+def make_project(Session, make_user):
+    # проект в обработке у нового пользователя, если user не передан
+    async def make(user: User | None = None, **kw) -> Project:
+        user = user or await make_user()
+        async with Session() as s:
+            p = Project(user_id=user.id, **{"title": "t", "description": "", "status": ProjectStatus.processing, **kw})
+            s.add(p)
+            await s.commit()
+            return p
+    return make
@@ -0,0 +1,149 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import select
+
+from app import admission, jobqueue
+from app.config import settings
+from app.models import Job, JobStatus, Project, User
+
+
+@pytest.fixture(autouse=True)
+def _admission(monkeypatch):
+    monkeypatch.setattr(admission, "_service_cache", {})
+    monkeypatch.setattr(admission, "_order_cache", {})
+    monkeypatch.setattr(settings, "ADMISSION_WORKER_SLOTS", 2)
+
+
+@pytest.fixture
+def projects(make_user, make_project):
+    # n проектов одного нового пользователя
+    async def make(n: int) -> list:
+        u = await make_user()
+        return [(await make_project(u, title=f"t{i}")).id for i in range(n)]
+    return make
+
+
+async def _history(s, kind: str, seconds: list[float]):
+    t = datetime.now(timezone.utc) - timedelta(hours=1)
+    pid = (await s.execute(select(Project.id))).scalars().first()
+    for sec in seconds:
+        s.add(Job(kind=kind, project_id=pid, payload={}, status=JobStatus.done, attempts=1, max_attempts=3,
+                  created_at=t, started_at=t, finished_at=t + timedelta(seconds=sec)))
+    await s.commit()
+
+
+async def test_service_time_from_recent_jobs(Session, projects):
+    await projects(1)
+    async with Session() as s:
+        assert await admission.service_time(s, "infer") == 20.0  # по умолчанию, истории нет
+        admission._service_cache.clear()
+        await _history(s, "infer", [10, 30])
+        assert await admission.service_time(s, "infer") == pytest.approx(20.0)
+        await _history(s, "tex", [4])
+        assert await admission.service_time(s, "tex") == pytest.approx(4.0)
+
+
+async def test_queue_position_and_eta(Session, projects):
+    pids = await projects(3)
+    async with Session() as s:
+        await _history(s, "infer", [10])
+        for pid in pids:
+            await jobqueue.enqueue(s, "infer", pid)
+        await s.commit()
+        await jobqueue.lease(s, "w1")
+    async with Session() as s:
+        info = await admission.queue_info(s, pids)
+    assert info[pids[0]].position == 0
+    assert info[pids[1]] == admission.QueueInfo(1, 10)
+    # впереди одна задача, два слота: 10 * 1 / 2 + 10
+    assert info[pids[2]] == admission.QueueInfo(2, 15)
+
+
+async def test_admit_rejects_with_retry_after(Session, monkeypatch, projects):
+    monkeypatch.setattr(settings, "ADMISSION_MAX_QUEUE", 3)
+    monkeypatch.setattr(settings, "ADMISSION_MAX_WAIT_SEC", 0)
+    pids = await projects(4)
+    async with Session() as s:
+        await _history(s, "infer", [8])
+        for pid in pids[:2]:
+            await jobqueue.enqueue(s, "infer", pid)
+        await s.commit()
+        await admission.admit(s, "infer")
+        await jobqueue.enqueue(s, "infer", pids[2])
+        await s.commit()
+        with pytest.raises(HTTPException) as ei:
+            await admission.admit(s, "infer")
+    assert ei.value.status_code == 429
+    # одна лишняя задача, 8 с на задачу, два слота
+    assert ei.value.headers["Retry-After"] == "4"
+
+
+async def test_admit_limits_estimated_wait(Session, monkeypatch, projects):
+    monkeypatch.setattr(settings, "ADMISSION_MAX_QUEUE", 0)
+    monkeypatch.setattr(settings, "ADMISSION_MAX_WAIT_SEC", 30)
+    pids = await projects(4)
+    async with Session() as s:
+        await _history(s, "infer", [20])
+        for pid in pids:
+            await jobqueue.enqueue(s, "infer", pid)
+        await s.commit()
+        # 4 * 20 / 2 = 40 с > 30
+        with pytest.raises(HTTPException) as ei:
+            await admission.admit(s, "infer")
+    assert int(ei.value.headers["Retry-After"]) == 10
+
+
+async def test_queue_position_follows_fair_share(Session, projects):
+    a = await projects(3)
+    b = await projects(1)  # другой пользователь, поставил позже
+    async with Session() as s:
+        await _history(s, "infer", [10])
+        for pid in a + b:
+            owner = (await s.execute(select(User).join(Project).where(Project.id == pid))).scalar_one()
+            await jobqueue.enqueue(s, "infer", pid, user=owner)
+        await s.commit()
+    async with Session() as s:
+        info = await admission.queue_info(s, a + b)
+    # round-robin: первая задача b идёт сразу за первой задачей a
+    assert [info[pid].position for pid in a + b] == [1, 3, 4, 2]
+
+
+async def test_queue_order_is_shared_between_polls(Session, projects):
+    from sqlalchemy import event
+
+    pids = await projects(10)
+    async with Session() as s:
+        for pid in pids:
+            await jobqueue.enqueue(s, "infer", pid)
+        await s.commit()
+        await admission.service_time(s, "infer")
+        await admission.queue_info(s, pids[:1])
+        statements = []
+        engine = s.get_bind()
+        event.listen(engine, "before_cursor_execute", lambda *a: statements.append(a[2]))
+        info = await admission.queue_info(s, pids)
+    # очередь целиком уже упорядочена: остаётся один запрос по своим задачам
+    assert len(info) == 10 and len(statements) == 1
+    assert "row_number" not in statements[0].lower()
+
+
+async def test_job_enqueued_after_snapshot_gets_its_place(Session, monkeypatch, projects):
+    a = await projects(2)
+    b = await projects(1)
+    async with Session() as s:
+        for pid in a:
+            owner = (await s.execute(select(User).join(Project).where(Project.id == pid))).scalar_one()
+            await jobqueue.enqueue(s, "infer", pid, user=owner)
+        await s.commit()
+        await admission.queue_order(s)
+        owner = (await s.execute(select(User).join(Project).where(Project.id == b[0]))).scalar_one()
+        await jobqueue.enqueue(s, "infer", b[0], user=owner)
+        await s.commit()
+        info = await admission.queue_info(s, b)
+        # снимок ещё старый, но новая задача b — первая у своего пользователя и встаёт за первой a
+        assert info[b[0]].position == 2
+        monkeypatch.setattr(settings, "ADMISSION_QUEUE_TTL_SEC", 0)
+        info = await admission.queue_info(s, a + b)
+    assert [info[pid].position for pid in a + b] == [1, 3, 2]
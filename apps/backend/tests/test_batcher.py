@@ -0,0 +1,106 @@
+import threading, time
+
+import pytest
+
+from app.batcher import MicroBatcher
+from app.cancellation import CancelToken, Cancelled
+
+
+def _recording(calls):
+    def fn(items, key):
+        calls.append((key, list(items)))
+        return [(key, x * 10) for x in items]
+    return fn
+
+
+def test_concurrent_callers_share_a_batch_and_get_their_results():
+    calls = []
+    b = MicroBatcher(_recording(calls), max_batch=64, max_wait_ms=50)
+    out = {}
+    barrier = threading.Barrier(4)
+
+    def page(n):
+        barrier.wait()
+        out[n] = b.map([n * 100 + i for i in range(3)])
+
+    threads = [threading.Thread(target=page, args=(n,)) for n in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    b.close()
+
+    assert len(calls) == 1 and len(calls[0][1]) == 12
+    for n in range(4):
+        assert out[n] == [((), (n * 100 + i) * 10) for i in range(3)]
+
+
+def test_max_batch_and_keys_split_batches():
+    calls = []
+    b = MicroBatcher(_recording(calls), max_batch=4, max_wait_ms=20)
+    f1 = [b.submit(i, key="a") for i in range(6)]
+    f2 = [b.submit(i, key="b") for i in range(2)]
+    assert [f.result(2) for f in f1] == [("a", i * 10) for i in range(6)]
+    assert [f.result(2) for f in f2] == [("b", i * 10) for i in range(2)]
+    b.close()
+
+    assert all(len(items) <= 4 for _, items in calls)
+    assert {key for key, _ in calls} == {"a", "b"}
+
+
+def test_full_batch_does_not_wait_for_timeout():
+    b = MicroBatcher(lambda items, key: items, max_batch=2, max_wait_ms=5000)
+    t0 = time.monotonic()
+    assert b.map([1, 2]) == [1, 2]
+    assert time.monotonic() - t0 < 1.0
+    b.close()
+
+
+def test_errors_reach_every_caller_in_the_batch():
+    def boom(items, key):
+        raise ValueError("model crashed")
+    b = MicroBatcher(boom, max_batch=8, max_wait_ms=1)
+    futs = [b.submit(i) for i in range(3)]
+    for f in futs:
+        with pytest.raises(ValueError):
+            f.result(2)
+    # батчер продолжает работать после ошибки
+    b.fn = lambda items, key: items
+    assert b.map([7]) == [7]
+    b.close()
+    with pytest.raises(RuntimeError):
+        b.submit(1)
+
+
+def test_cancelled_caller_leaves_and_its_items_are_dropped():
+    calls = []
+    release = threading.Event()
+
+    def slow(items, key):
+        calls.append(list(items))
+        release.wait(5)
+        return items
+
+    b = MicroBatcher(slow, max_batch=1, max_wait_ms=0)
+    token = CancelToken()
+    threading.Timer(0.1, token.cancel, args=("job deleted",)).start()
+    with pytest.raises(Cancelled):
+        b.map([1, 2, 3], cancel=token)
+    release.set()
+    b.close()
+    # первый элемент уже ушёл в модель, остальные сняты до неё
+    assert calls == [[1]]
+
+
+def test_retired_batcher_serves_holders_and_releases_its_thread():
+    calls = []
+    b = MicroBatcher(_recording(calls), max_batch=8, max_wait_ms=1)
+    assert b.map([1]) == [((), 10)]
+    thread = b._thread
+    b.retire()
+    thread.join(timeout=2)
+    assert not thread.is_alive() and b._thread is None
+    # страница, взявшая модели до смены, продолжает со следующим этапом
+    assert b.map([2, 3]) == [((), 20), ((), 30)]
+    deadline = time.monotonic() + 2
+    while b._thread is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert b._thread is None
@@ -0,0 +1,168 @@
+import httpx
+import pytest
+from sqlalchemy import select
+
+from app import jobqueue, worker
+from app.config import settings
+from app.main import app
+from app.models import Job, JobStatus, Project, ProjectStatus
+from app.security import create_access_token
+from app.utils.assemble_latex import build_mixed_document, formulas_from_tex, splice_block
+
+BLOCKS = [
+    {"idx": 0, "kind": "formula", "bbox": [0, 0, 200, 30], "content": r"\int_0^1 f(x)\,dx"},
+    {"idx": 1, "kind": "text", "bbox": [0, 100, 40, 120], "content": "где"},
+    {"idx": 2, "kind": "formula", "bbox": [50, 100, 120, 120], "content": "f(x)=x^2"},
+    {"idx": 3, "kind": "text", "bbox": [0, 200, 300, 220], "content": "конец 50%"},
+]
+
+
+def _build(blocks):
+    return build_mixed_document([(b["idx"], b["kind"], b["content"], *b["bbox"]) for b in blocks], title="t")
+
+
+def _edit(blocks, idx, content):
+    return [dict(b, content=content) if b["idx"] == idx else b for b in blocks]
+
+
+@pytest.mark.parametrize("idx,content", [
+    (2, "g(x)=x^3"), (0, r"\sum_{i=1}^{n} i"), (3, "итог: 100% & $"), (2, r"\frac{a}{b"), (1, "  где  "),
+])
+def test_splice_equals_full_rebuild(idx, content):
+    tex = _build(BLOCKS)
+    assert splice_block(tex, BLOCKS, idx, content) == _build(_edit(BLOCKS, idx, content))
+
+
+def test_splice_touches_only_its_line():
+    tex = _build(BLOCKS)
+    out = splice_block(tex, BLOCKS, 2, "y")
+    old_lines, new_lines = tex.splitlines(), out.splitlines()
+    assert len(old_lines) == len(new_lines)
+    assert [i for i, (a, b) in enumerate(zip(old_lines, new_lines)) if a != b] == [old_lines.index(r"где \(f(x)=x^2\)")]
+    assert formulas_from_tex(out)[2] == "y"
+
+
+def test_empty_content_rebuilds_layout():
+    tex = _build(BLOCKS)
+    assert splice_block(tex, BLOCKS, 1, "") == _build(_edit(BLOCKS, 1, ""))
+    gone = _edit(BLOCKS, 1, "")
+    assert splice_block(_build(gone), gone, 1, "и") == _build(BLOCKS[:1] + [dict(BLOCKS[1], content="и")] + BLOCKS[2:])
+
+
+def test_hand_edited_line_is_not_overwritten():
+    tex = _build(BLOCKS)
+    # PATCH tex схлопывает \[..\] — это не правка
+    collapsed = tex.replace("\\[\n\\int_0^1 f(x)\\,dx\n\\]", "\\[\\int_0^1 f(x)\\,dx\\]")
+    assert splice_block(collapsed, BLOCKS, 0, "x") == _build(_edit(BLOCKS, 0, "x"))
+    edited = tex.replace(r"где \(f(x)=x^2\)", r"где, как видно, \(f(x)=x^2\)")
+    assert splice_block(edited, BLOCKS, 2, "y") is None
+    # правка соседней строки не мешает
+    out = splice_block(edited, BLOCKS, 3, "финал")
+    assert "как видно" in out and "финал" in out
+    assert splice_block(edited, BLOCKS, 1, "") is None
+    assert splice_block(tex.replace("(#2 formula", "(#9 formula"), BLOCKS, 2, "y") is None
+
+
+@pytest.fixture
+async def blocks_project(Session, tmp_path, monkeypatch, make_user, make_project):
+    monkeypatch.setattr(settings, "STORAGE_BACKEND", "local")
+    monkeypatch.setattr(settings, "FILES_DIR", str(tmp_path / "files"))
+    u = await make_user()
+    p = await make_project(u, status=ProjectStatus.ready, tex_key=f"users/{u.id}/projects/x/formulas.tex", blocks=BLOCKS)
+    tex_file = tmp_path / "files" / p.tex_key
+    tex_file.parent.mkdir(parents=True)
+    tex_file.write_text(_build(BLOCKS), encoding="utf-8")
+    return u, p
+
+
+async def _build_job(Session, tmp_path, monkeypatch, pid) -> Job:
+    # воркер без latexmk/pandoc: только выкладка tex и смена ключей
+    async def no_artifacts(tex_path, token):
+        return None, None
+
+    monkeypatch.setattr(worker, "_build_tex_artifacts", no_artifacts)
+    async with Session() as s:
+        job = await jobqueue.lease(s, "w1", ["tex"])
+    assert job is not None and job.project_id == pid
+    wd = tmp_path / f"work{job.payload['rev']}"
+    wd.mkdir()
+    await worker._run_build_tex(pid, job.payload["tex"], str(wd), job.payload["rev"],
+                                prepared=job.payload.get("prepared", False), blocks=job.payload.get("blocks"))
+    async with Session() as s:
+        await jobqueue.complete(s, job.id, "w1")
+    return job
+
+
+async def test_patch_block_endpoint(Session, tmp_path, monkeypatch, blocks_project, make_project):
+    u, p = blocks_project
+    bare = await make_project(u, status=ProjectStatus.ready, tex_key=f"users/{u.id}/projects/y/formulas.tex")
+    headers = {"Authorization": f"Bearer {create_access_token(u)}"}
+    files = tmp_path / "files"
+    before = (files / p.tex_key).read_text(encoding="utf-8")
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t") as c:
+        r = await c.patch(f"/projects/{p.id}/blocks/2", json={"content": "g(x)"}, headers=headers)
+        assert r.status_code == 200 and r.json()["status"] == "processing"
+
+        assert (await c.patch(f"/projects/{p.id}/blocks/7", json={"content": "x"}, headers=headers)).status_code == 404
+        assert (await c.patch(f"/projects/{bare.id}/blocks/0", json={"content": "x"}, headers=headers)).status_code == 404
+        # пока первая правка не собрана — вторая ждёт
+        assert (await c.patch(f"/projects/{p.id}/blocks/0", json={"content": "y"}, headers=headers)).status_code == 409
+
+        # до сборки ни tex, ни blocks не тронуты
+        assert (files / p.tex_key).read_text(encoding="utf-8") == before
+        async with Session() as s:
+            assert (await s.get(Project, p.id)).blocks == BLOCKS
+        job = await _build_job(Session, tmp_path, monkeypatch, p.id)
+        assert job.kind == "tex" and job.payload["prepared"] is True and job.payload["rev"] == 1
+
+        async with Session() as s:
+            fresh = await s.get(Project, p.id)
+        assert fresh.status == ProjectStatus.ready and fresh.tex_revision == 1
+        # правленая формула проверена один раз, замечания — в её блоке
+        assert fresh.blocks == [dict(b, issues=[], warnings=[]) if b["idx"] == 2 else b for b in _edit(BLOCKS, 2, "g(x)")]
+        assert (files / fresh.tex_key).read_text(encoding="utf-8") == _build(_edit(BLOCKS, 2, "g(x)"))
+
+        tex_file = files / fresh.tex_key
+        tex_file.write_text(tex_file.read_text(encoding="utf-8").replace("где", "где-то"), encoding="utf-8")
+        r = await c.patch(f"/projects/{p.id}/blocks/2", json={"content": "h(x)"}, headers=headers)
+        assert r.status_code == 409
+
+
+async def test_whole_tex_patch_then_block_patch(Session, tmp_path, monkeypatch, blocks_project):
+    # PATCH tex только ставит сборку: правка блока до воркера не должна
+    # ни править старый tex, ни снимать ждущую сборку целого документа
+    u, p = blocks_project
+    headers = {"Authorization": f"Bearer {create_access_token(u)}"}
+    whole = _build(BLOCKS).replace("конец", "итог")
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t") as c:
+        assert (await c.patch(f"/projects/{p.id}", json={"tex": whole}, headers=headers)).status_code == 200
+        r = await c.patch(f"/projects/{p.id}/blocks/2", json={"content": "g(x)"}, headers=headers)
+        assert r.status_code == 409
+
+        async with Session() as s:
+            jobs = (await s.execute(select(Job).where(Job.project_id == p.id))).scalars().all()
+        assert [(j.status, j.payload.get("rev")) for j in jobs] == [(JobStatus.queued, 1)]
+
+        await _build_job(Session, tmp_path, monkeypatch, p.id)
+        async with Session() as s:
+            fresh = await s.get(Project, p.id)
+        assert "итог" in (tmp_path / "files" / fresh.tex_key).read_text(encoding="utf-8")
+        assert fresh.blocks == BLOCKS
+        # после сборки правка блока идёт уже поверх нового tex
+        r = await c.patch(f"/projects/{p.id}/blocks/2", json={"content": "g(x)"}, headers=headers)
+        assert r.status_code == 200
+        async with Session() as s:
+            job = (await s.execute(select(Job).where(Job.project_id == p.id, Job.status == JobStatus.queued))).scalar_one()
+        assert "итог" in job.payload["tex"] and "g(x)" in job.payload["tex"]
+
+
+async def test_patched_formula_issues_reach_project(Session, tmp_path, monkeypatch, blocks_project):
+    u, p = blocks_project
+    headers = {"Authorization": f"Bearer {create_access_token(u)}"}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t") as c:
+        r = await c.patch(f"/projects/{p.id}/blocks/2", json={"content": r"\frac{a}{b"}, headers=headers)
+        assert r.status_code == 200 and r.json()["validation"] == []
+        await _build_job(Session, tmp_path, monkeypatch, p.id)
+        r = await c.get(f"/projects/{p.id}", headers=headers)
+    assert r.json()["validation"] == [{"idx": 2, "issues": ["1 unclosed '{'"], "warnings": []}]
@@ -0,0 +1,75 @@
+import os, sys, threading, time
+
+import pytest
+
+from app.cancellation import CancelToken, Cancelled, DeadlineExceeded
+from app.utils.latex_to_pdf import _run
+
+
+def test_callbacks_fire_once_and_late_registration_runs_immediately():
+    t = CancelToken()
+    calls = []
+    detach = t.on_cancel(lambda: calls.append("a"))
+    t.on_cancel(lambda: calls.append("b"))
+    detach()
+    t.cancel("newer revision")
+    t.cancel("again")
+    assert calls == ["b"] and t.reason == "newer revision"
+    t.on_cancel(lambda: calls.append("late"))
+    assert calls == ["b", "late"]
+    with pytest.raises(Cancelled, match="newer revision"):
+        t.raise_if_cancelled()
+
+
+@pytest.mark.skipif(os.name != "posix", reason="process groups")
+def test_cancel_kills_subprocess_and_its_children(tmp_path):
+    # как latexmk -> pdflatex: родитель ждёт ребёнка, убить надо обоих
+    pidfile = tmp_path / "child.pid"
+    script = f"sleep 30 & echo $! > {pidfile}; wait"
+    token = CancelToken()
+    threading.Timer(0.3, token.cancel, args=("superseded",)).start()
+    t0 = time.monotonic()
+    with pytest.raises(Cancelled):
+        _run(["sh", "-c", script], cwd=tmp_path, env=dict(os.environ), timeout=30, cancel=token)
+    assert time.monotonic() - t0 < 5
+    child = int(pidfile.read_text())
+    for _ in range(50):
+        try:
+            os.kill(child, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.05)
+    else:
+        pytest.fail("child process survived cancellation")
+
+
+def test_cancelled_token_prevents_start(tmp_path):
+    token = CancelToken()
+    token.cancel()
+    with pytest.raises(Cancelled):
+        _run([sys.executable, "-c", "open('ran', 'w')"], cwd=tmp_path, env=dict(os.environ), timeout=5, cancel=token)
+    assert not (tmp_path / "ran").exists()
+
+
+def test_stage_deadline_is_capped_by_parent_and_named():
+    job = CancelToken(timeout=0.2)
+    with job.stage("formulas", timeout=60) as st:
+        assert st.remaining() <= 0.2
+    with pytest.raises(DeadlineExceeded, match="^text: "):
+        with job.stage("text", timeout=0.05) as st:
+            time.sleep(0.1)
+            st.raise_if_cancelled()
+    # срок этапа не трогает задачу, отмена задачи доходит до этапа
+    job.raise_if_cancelled()
+    with job.stage("compile") as st:
+        job.cancel("project deleted")
+        with pytest.raises(Cancelled, match="project deleted"):
+            st.raise_if_cancelled()
+
+
+def test_deadline_cuts_subprocess_timeout(tmp_path):
+    token = CancelToken(timeout=0.3)
+    t0 = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        _run(["sleep", "30"], cwd=tmp_path, env=dict(os.environ), timeout=30, cancel=token)
+    assert time.monotonic() - t0 < 5
@@ -0,0 +1,133 @@
+import asyncio, os, sys, threading, time
+
+import pytest
+
+from app.cancellation import CancelToken, Cancelled
+from app.config import settings
+from app.utils import compile_pool
+from app.utils.latex_to_pdf import compile_tex_file_to_pdf, compile_tex_file_to_pdf_async
+
+# pdflatex-заглушка: отмечает начало/конец (для подсчёта одновременных), пишет свои лимиты
+FAKE_PDFLATEX = """#!/bin/sh
+if [ "$1" = "--version" ]; then echo "pdfTeX fake"; exit 0; fi
+for a in "$@"; do case "$a" in *.tex) job="${{a%.tex}}";; esac; done
+echo "start $(pwd)" >> "{log}"
+echo "cpu=$(ulimit -t) mem=$(ulimit -v)" > "{limits}"
+sleep {sleep}
+printf 'aux' > "$job.aux"; printf 'log' > "$job.log"
+printf '%%PDF-1.4 fake' > "$job.pdf"
+echo "end" >> "{log}"
+"""
+
+DOC = "\\documentclass{article}\n\\begin{document}\nx\n\\end{document}\n"
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="shell stand-in for pdflatex")
+
+
+@pytest.fixture
+def tex(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    log, limits = tmp_path / "calls.log", tmp_path / "limits.txt"
+    exe = bindir / "pdflatex"
+    exe.write_text(FAKE_PDFLATEX.format(log=log, limits=limits, sleep=0.3))
+    exe.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(settings, "TEX_CACHE_MAX_MB", 0)
+    monkeypatch.setattr(settings, "LATEX_PRECOMPILED_FORMAT", False)
+    monkeypatch.setattr(settings, "LATEX_MAX_CONCURRENCY", 1)
+    monkeypatch.setattr(settings, "LATEX_SCRATCH_DIR", str(tmp_path / "scratch"))
+    monkeypatch.setattr(compile_pool, "_pool", None)
+
+    def make(name):
+        d = tmp_path / name
+        d.mkdir()
+        p = d / "doc.tex"
+        p.write_text(DOC)
+        return p
+    make.log, make.limits = log, limits
+    return make
+
+
+def _max_parallel(log) -> int:
+    cur = peak = 0
+    for line in log.read_text().splitlines():
+        cur += 1 if line.startswith("start") else -1
+        peak = max(peak, cur)
+    return peak
+
+
+def test_concurrency_is_bounded_and_wait_is_reported_separately(tex):
+    reports = [{} for _ in range(3)]
+    threads = [threading.Thread(target=compile_tex_file_to_pdf, args=(tex(f"d{i}"),), kwargs={"report": reports[i]})
+               for i in range(3)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert _max_parallel(tex.log) == 1
+    waits = sorted(r["queue_ms"] for r in reports)
+    assert waits[0] < 200 and waits[-1] >= 500
+    assert all(r["run_ms"] >= 250 for r in reports)
+
+
+async def test_async_compile_shares_the_limit(tex):
+    await asyncio.gather(*(compile_tex_file_to_pdf_async(tex(f"a{i}")) for i in range(2)))
+    assert _max_parallel(tex.log) == 1
+
+
+def test_scratch_dir_and_rlimits(tex, monkeypatch):
+    monkeypatch.setattr(settings, "LATEX_CPU_LIMIT_SEC", 7)
+    monkeypatch.setattr(settings, "LATEX_MEM_LIMIT_MB", 512)
+    src = tex("d")
+    pdf = compile_tex_file_to_pdf(src)
+    # наружу — только pdf; компилировали в отдельной папке, которую потом удалили
+    assert sorted(p.name for p in src.parent.iterdir()) == ["doc.pdf", "doc.tex"]
+    ran_in = tex.log.read_text().split()[1]
+    assert ran_in != str(src.parent) and not os.path.exists(ran_in)
+    if sys.platform.startswith("linux"):
+        assert tex.limits.read_text().split() == ["cpu=7", f"mem={512 * 1024}"]
+    assert pdf.read_bytes().startswith(b"%PDF")
+
+
+async def test_slots_are_handed_out_in_arrival_order():
+    pool = compile_pool.CompilePool(1)
+    order = []
+    with pool.slot():
+        async def job(n):
+            async with pool.aslot():
+                order.append(n)
+                await asyncio.sleep(0.01)
+
+        tasks = []
+        for n in range(4):
+            tasks.append(asyncio.create_task(job(n)))
+            await asyncio.sleep(0.01)  # встали в очередь по порядку
+        await asyncio.sleep(0.05)
+        assert order == []
+    await asyncio.gather(*tasks)
+    assert order == [0, 1, 2, 3]
+
+
+def test_abandoned_waiter_passes_its_slot_on():
+    pool = compile_pool.CompilePool(1)
+    token, got = CancelToken(), threading.Event()
+    with pool.slot():
+        def cancelled():
+            with pytest.raises(Cancelled):
+                with pool.slot(token):
+                    pass
+
+        def next_in_line():
+            with pool.slot():
+                got.set()
+
+        a = threading.Thread(target=cancelled)
+        a.start()
+        time.sleep(0.05)
+        b = threading.Thread(target=next_in_line)
+        b.start()
+        time.sleep(0.05)
+        token.cancel()
+        a.join(2)
+        assert not got.is_set()
+    b.join(2)
+    assert got.is_set() and pool._free == 1 and not pool._waiters
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from app.utils.crop_store import CropStore, CropStoreWriter, write_page_crops
+
+
+def test_page_crops_roundtrip_zero_copy(tmp_path):
+    rng = np.random.default_rng(0)
+    page = rng.integers(0, 255, size=(120, 200, 3), dtype=np.uint8)
+    boxes = [(10, 5, 60, 25, "formula"), (0, 40, 200, 70, "text_line"), (33, 80, 34, 81, "formula")]
+
+    path = write_page_crops(tmp_path / "page.crops", page, boxes)
+
+    with CropStore(path) as store:
+        assert len(store) == 3
+        assert store.index["page"] == [200, 120]
+        for idx, (x1, y1, x2, y2, name) in enumerate(boxes, start=1):
+            crop = store.get(idx)
+            np.testing.assert_array_equal(crop, page[y1:y2, x1:x2])
+            assert store.meta(idx)["bbox"] == [x1, y1, x2, y2]
+            assert store.meta(idx)["cls"] == name
+            assert crop.base is not None and not crop.flags.writeable
+            assert store.meta(idx)["offset"] % 64 == 0
+
+
+def test_mixed_dtypes_and_empty_store(tmp_path):
+    with CropStoreWriter(tmp_path / "x.crops") as w:
+        w.add(7, np.arange(6, dtype=np.float32).reshape(2, 3))
+        w.add(9, np.zeros((4,), dtype=np.uint8))
+    with CropStore(tmp_path / "x.crops") as store:
+        np.testing.assert_array_equal(store.get(7), np.arange(6, dtype=np.float32).reshape(2, 3))
+        assert [it["idx"] for it, _ in store.items()] == [7, 9]
+
+    CropStoreWriter(tmp_path / "empty.crops").close()
+    assert len(CropStore(tmp_path / "empty.crops")) == 0
+
+
+def test_rejects_foreign_file(tmp_path):
+    (tmp_path / "bad.crops").write_bytes(b"not a store at all, definitely")
+    with pytest.raises(ValueError):
+        CropStore(tmp_path / "bad.crops")
@@ -0,0 +1,108 @@
+import os
+
+import pytest
+from docx import Document
+from lxml import etree
+
+from app import worker
+from app.config import settings
+from app.utils import docx_writer, omml
+from app.utils.assemble_latex import FOOTER, HEADER, build_mixed_document
+
+FAKE_PANDOC = """#!/bin/sh
+echo pandoc >> "{log}"
+while [ $# -gt 0 ]; do [ "$1" = "-o" ] && out="$2"; shift; done
+printf 'docx' > "$out"
+"""
+
+BLOCKS = [
+    {"idx": 0, "kind": "formula", "content": r"\int_0^1 f(x)\,dx", "bbox": (0, 0, 200, 30)},
+    {"idx": 1, "kind": "text", "content": "где 50%", "bbox": (0, 100, 40, 120)},
+    {"idx": 2, "kind": "formula", "content": "f(x)=x^2", "bbox": (50, 100, 120, 120)},
+    {"idx": 3, "kind": "formula", "content": r"\frac{a}{b", "bbox": (0, 200, 100, 220)},
+]
+
+
+def _xml(src: str) -> str:
+    return etree.tostring(omml.math(src), encoding="unicode")
+
+
+def _tags(src: str) -> list[str]:
+    return [etree.QName(e).localname for e in omml.math(src).iter()]
+
+
+def test_omml_structures():
+    assert {"f", "num", "den"} <= set(_tags(r"\frac{a}{b}"))
+    assert "sSubSup" in _tags("x_i^2")
+    assert "rad" in _tags(r"\sqrt[3]{x}") and "degHide" in _tags(r"\sqrt{x}")
+    nary = _xml(r"\sum_{i=1}^{n} a_i = 1")
+    assert 'm:val="∑"' in nary and "undOvr" in nary
+    # тело суммы заканчивается на '='
+    assert nary.index("</m:nary>") < nary.index(">=1<")
+    assert 'm:val="("' in _xml(r"\left( x \right)") and 'm:val=""' in _xml(r"\left. x \right|")
+    m = omml.math(r"\begin{pmatrix} 1 & 2 \\ 3 & 4 \end{pmatrix}")
+    assert len(m.findall(f".//{{{omml.M_NS}}}mr")) == 2
+    assert "double-struck" in _xml(r"\mathbb{R}") and "limLow" in _tags(r"\lim_{x \to 0} f")
+    assert ">α≤β<" in _xml(r"\alpha \leq \beta")
+
+
+def test_omml_never_raises():
+    for src in (r"\frac{a}{b", r"\left( x", r"\begin{matrix} 1 &", "}{", r"\foo_", "^", ""):
+        assert omml.math(src).tag == f"{{{omml.M_NS}}}oMath"
+    assert "\\foo" in _xml(r"\foo x")
+
+
+def test_tex_roundtrip_matches_blocks():
+    tex = build_mixed_document([(b["idx"], b["kind"], b["content"], *b["bbox"]) for b in BLOCKS], title="t")
+    paragraphs = docx_writer.paragraphs_from_blocks(BLOCKS)
+    assert paragraphs == [
+        [("display", r"\int_0^1 f(x)\,dx")],
+        [("text", "где 50% "), ("math", "f(x)=x^2")],
+        [("center", r"\frac{a}{b")],
+    ]
+    assert docx_writer.paragraphs_from_tex(tex) == paragraphs
+
+
+def test_tex_outside_subset_goes_to_pandoc():
+    assert docx_writer.paragraphs_from_tex("\\documentclass{article}\n\\begin{document}x\\end{document}") is None
+    patched = HEADER.replace("%TITLE%", "Patched") + "\\section{Итоги}\n\\[x\\]\n" + FOOTER
+    assert docx_writer.paragraphs_from_tex(patched) is None
+    ok = HEADER.replace("%TITLE%", "Patched") + "Текст \\(a\\)\n\n\\[x = y\\]" + FOOTER
+    assert docx_writer.paragraphs_from_tex(ok) == [[("text", "Текст "), ("math", "a")], [("display", "x = y")]]
+
+
+def test_write_docx_has_native_math(tmp_path):
+    out = docx_writer.write_docx(docx_writer.paragraphs_from_blocks(BLOCKS), tmp_path / "page.docx")
+    doc = Document(out)
+    assert len(doc.paragraphs) == 3
+    body = doc.element.body
+    assert len(body.findall(f".//{{{omml.M_NS}}}oMathPara")) == 1
+    assert len(body.findall(f".//{{{omml.M_NS}}}oMath")) == 2
+    assert "где 50%" in doc.paragraphs[1].text and doc.paragraphs[2].text == r"\frac{a}{b"
+
+
+@pytest.mark.skipif(os.name != "posix", reason="shell stand-in for pandoc")
+async def test_worker_uses_pandoc_only_outside_subset(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    log = tmp_path / "calls.log"
+    log.write_text("")
+    (bindir / "pandoc").write_text(FAKE_PANDOC.format(log=log))
+    (bindir / "pandoc").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(settings, "TEX_CACHE_MAX_MB", 0)
+
+    ours = tmp_path / "a" / "formulas.tex"
+    ours.parent.mkdir()
+    ours.write_text(build_mixed_document([(0, "formula", "x^2", 0, 0, 10, 10)], title="t"), encoding="utf-8")
+    out = await worker._maybe_make_docx_async(str(ours))
+    assert Document(out).element.body.find(f".//{{{omml.M_NS}}}oMathPara") is not None
+    out = await worker._maybe_make_docx_async(str(ours), blocks=BLOCKS)
+    assert len(Document(out).paragraphs) == 3
+    assert log.read_text() == ""
+
+    foreign = tmp_path / "b" / "formulas.tex"
+    foreign.parent.mkdir()
+    foreign.write_text("\\documentclass{article}\n\\begin{document}\n\\[x^2\\]\n\\end{document}\n")
+    out = await worker._maybe_make_docx_async(str(foreign))
+    assert open(out).read() == "docx" and log.read_text().split() == ["pandoc"]
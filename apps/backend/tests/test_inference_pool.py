@@ -0,0 +1,112 @@
+import asyncio, os, time
+
+import numpy as np
+import pytest
+
+from app.cancellation import CancelToken, Cancelled, DeadlineExceeded
+from app import metrics
+from app.config import settings
+from app.inference_pool import InferencePool, job_threads
+from app.memwatch import recycle_reason
+
+# раннеры для дочерних процессов: вместо моделей — простые функции над страницей
+
+
+def page_stats(image, scale=1):
+    return {"sum": int(image.sum()) * scale, "shape": list(image.shape), "pid": os.getpid()}
+
+
+def explode(image):
+    raise ValueError("bad page")
+
+
+def slow_until_cancelled(image, cancel):
+    # как пайплайн: работает кусками и проверяет токен между ними
+    for _ in range(300):
+        cancel.raise_if_cancelled()
+        time.sleep(0.01)
+    return {"done": True}
+
+
+@pytest.fixture
+def pool():
+    p = InferencePool(size=2, runner=f"{__name__}:page_stats").start()
+    yield p
+    p.shutdown()
+
+
+async def test_page_goes_through_shared_memory(pool):
+    page = np.arange(6 * 5 * 3, dtype=np.uint8).reshape(6, 5, 3)
+    got = await pool.run(page, {"scale": 2})
+    assert got["sum"] == int(page.sum()) * 2
+    assert got["shape"] == [6, 5, 3]
+    assert got["pid"] != os.getpid()
+
+
+async def test_processes_are_reused():
+    pool = InferencePool(size=1, runner=f"{__name__}:page_stats").start()
+    try:
+        page = np.ones((4, 4, 3), dtype=np.uint8)
+        pids = {(await pool.run(page, {}))["pid"] for _ in range(3)}
+        assert len(pids) == 1
+    finally:
+        pool.shutdown()
+
+
+async def test_errors_are_propagated():
+    pool = InferencePool(size=1, runner=f"{__name__}:explode").start()
+    try:
+        with pytest.raises(RuntimeError, match="bad page"):
+            await pool.run(np.zeros((2, 2, 3), dtype=np.uint8), {})
+    finally:
+        pool.shutdown()
+
+
+async def test_cancel_and_deadline_reach_the_child():
+    pool = InferencePool(size=1, runner=f"{__name__}:slow_until_cancelled").start()
+    try:
+        page = np.zeros((2, 2, 3), dtype=np.uint8)
+        token = CancelToken()
+        asyncio.get_running_loop().call_later(0.2, token.cancel, "job deleted")
+        t0 = time.monotonic()
+        with pytest.raises(Cancelled, match="job deleted"):
+            await pool.run(page, {}, cancel=token)
+        assert time.monotonic() - t0 < 2
+        # срок передаётся ребёнку: он сам бросает работу, без сигнала от родителя
+        with pytest.raises(DeadlineExceeded):
+            await pool.run(page, {}, cancel=CancelToken(timeout=0.3))
+        assert await asyncio.wait_for(pool.run(page, {}, cancel=CancelToken()), 10) == {"done": True}
+    finally:
+        pool.shutdown()
+
+
+async def test_worker_is_recycled_after_n_jobs_without_losing_pages():
+    pool = InferencePool(size=1, runner=f"{__name__}:page_stats", recycle_jobs=2).start()
+    try:
+        page = np.ones((4, 4, 3), dtype=np.uint8)
+        pids = [(await pool.run(page, {}))["pid"] for _ in range(5)]
+        assert pids[0] == pids[1] != pids[2] == pids[3] != pids[4]
+        # страницы, пришедшие во время смены процесса, ждут в backlog и не теряются
+        got = await asyncio.wait_for(asyncio.gather(*(pool.run(page, {}) for _ in range(6))), 60)
+        assert all(g["sum"] == int(page.sum()) for g in got)
+        assert metrics.snapshot()["summaries"]["infer_pool.job_peak_rss_mb"]["max"] > 0
+    finally:
+        pool.shutdown()
+
+
+def test_recycle_reason():
+    assert recycle_reason(10, 100.0, max_jobs=0, max_rss_mb=0) is None
+    assert "jobs" in recycle_reason(10, 100.0, max_jobs=10, max_rss_mb=0)
+    assert "rss" in recycle_reason(1, 4096.0, max_jobs=10, max_rss_mb=4000)
+
+
+def test_job_threads_follow_worker_concurrency(monkeypatch):
+    monkeypatch.setattr(settings, "INFER_JOB_THREADS", 0)
+    monkeypatch.setattr(settings, "WORKER_CONCURRENCY", 2)
+    monkeypatch.setattr(settings, "INFER_POOL_SIZE", 1)
+    assert job_threads() == 2  # по умолчанию обе страницы воркера — в одном процессе, батчи общие
+    monkeypatch.setattr(settings, "WORKER_CONCURRENCY", 5)
+    monkeypatch.setattr(settings, "INFER_POOL_SIZE", 2)
+    assert job_threads() == 3
+    monkeypatch.setattr(settings, "INFER_JOB_THREADS", 1)
+    assert job_threads() == 1
@@ -0,0 +1,155 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update
+
+from app import jobqueue
+from app.models import Job, JobStatus, Project, ProjectStatus
+
+
+async def test_lease_prefers_tex_and_is_exclusive(Session, make_project):
+    pid = (await make_project()).id
+    async with Session() as s:
+        await jobqueue.enqueue(s, "infer", pid)
+        await jobqueue.enqueue(s, "tex", pid, {"tex": "x"})
+        await s.commit()
+
+    async with Session() as s:
+        first = await jobqueue.lease(s, "w1")
+    async with Session() as s:
+        second = await jobqueue.lease(s, "w2")
+    async with Session() as s:
+        assert await jobqueue.lease(s, "w3") is None
+
+    assert (first.kind, second.kind) == ("tex", "infer")
+    assert first.payload == {"tex": "x"}
+    assert first.status == JobStatus.running and first.attempts == 1
+
+
+async def test_lease_filters_by_kind(Session, make_project):
+    pid = (await make_project()).id
+    async with Session() as s:
+        await jobqueue.enqueue(s, "infer", pid)
+        await s.commit()
+    async with Session() as s:
+        assert await jobqueue.lease(s, "w1", kinds=["tex"]) is None
+        assert (await jobqueue.lease(s, "w1", kinds=["infer"])).kind == "infer"
+
+
+async def test_heartbeat_complete_and_foreign_worker(Session, make_project):
+    pid = (await make_project()).id
+    async with Session() as s:
+        await jobqueue.enqueue(s, "infer", pid)
+        await s.commit()
+    async with Session() as s:
+        job = await jobqueue.lease(s, "w1")
+        assert await jobqueue.heartbeat(s, job.id, "w1") is True
+        assert await jobqueue.heartbeat(s, job.id, "intruder") is False
+        await jobqueue.complete(s, job.id, "w1")
+        assert await jobqueue.heartbeat(s, job.id, "w1") is False
+        got = (await s.execute(select(Job).where(Job.id == job.id))).scalar_one()
+        assert got.status == JobStatus.done
+
+
+async def test_failures_retry_then_fail_project(Session, monkeypatch, make_project):
+    monkeypatch.setattr(jobqueue.settings, "JOB_MAX_ATTEMPTS", 2, raising=False)
+    pid = (await make_project()).id
+    async with Session() as s:
+        await jobqueue.enqueue(s, "infer", pid)
+        await s.commit()
+
+    async with Session() as s:
+        job = await jobqueue.lease(s, "w1")
+        assert await jobqueue.fail(s, job.id, "w1", "boom") is True
+    async with Session() as s:
+        job = await jobqueue.lease(s, "w1")
+        assert job.attempts == 2
+        assert await jobqueue.fail(s, job.id, "w1", "boom again") is False
+    async with Session() as s:
+        p = (await s.execute(select(Project).where(Project.id == pid))).scalar_one()
+        assert p.status == ProjectStatus.failed
+
+
+async def test_deadline_failure_is_not_retried(Session, make_project):
+    pid = (await make_project()).id
+    async with Session() as s:
+        await jobqueue.enqueue(s, "infer", pid)
+        await s.commit()
+    async with Session() as s:
+        job = await jobqueue.lease(s, "w1")
+        assert await jobqueue.fail(s, job.id, "w1", "deadline exceeded", retry=False) is False
+    async with Session() as s:
+        job = (await s.execute(select(Job).where(Job.id == job.id))).scalar_one()
+        p = (await s.execute(select(Project).where(Project.id == pid))).scalar_one()
+        assert job.status == JobStatus.failed and job.attempts == 1
+        assert p.status == ProjectStatus.failed
+
+
+async def test_expired_lease_is_requeued(Session, make_project):
+    pid = (await make_project()).id
+    async with Session() as s:
+        await jobqueue.enqueue(s, "infer", pid)
+        await s.commit()
+    async with Session() as s:
+        job = await jobqueue.lease(s, "dead-worker")
+        await s.execute(update(Job).where(Job.id == job.id).values(
+            lease_until=datetime.now(timezone.utc) - timedelta(seconds=1)))
+        await s.commit()
+    async with Session() as s:
+        assert await jobqueue.requeue_expired(s) == (1, 0)
+    async with Session() as s:
+        again = await jobqueue.lease(s, "w2")
+        assert again.id == job.id and again.attempts == 2
+        # старый владелец больше не может ни продлить, ни завершить
+        assert await jobqueue.heartbeat(s, job.id, "dead-worker") is False
+
+
+async def test_newer_tex_supersedes_queued_one(Session, make_project):
+    pid = (await make_project()).id
+    async with Session() as s:
+        await jobqueue.submit_texjob(pid, "v1", session=s, revision=1)
+        await jobqueue.submit_texjob(pid, "v2", session=s, revision=2)
+        await s.commit()
+    async with Session() as s:
+        jobs = (await s.execute(select(Job).order_by(Job.created_at))).scalars().all()
+        assert [(j.payload["rev"], j.status) for j in jobs] == [(1, JobStatus.cancelled), (2, JobStatus.queued)]
+        job = await jobqueue.lease(s, "w1")
+        assert job.payload == {"tex": "v2", "rev": 2}
+        await jobqueue.cancel(s, job.id, "w1", "superseded by revision 3")
+        got = (await s.execute(select(Job).where(Job.id == job.id))).scalar_one()
+        assert got.status == JobStatus.cancelled and got.error == "superseded by revision 3"
+
+
+async def test_prune_finished_keeps_recent_and_unfinished(Session, monkeypatch, make_project):
+    from app.config import settings
+
+    monkeypatch.setattr(settings, "JOB_RETENTION_DAYS", 7)
+    pid = (await make_project()).id
+    old = datetime.now(timezone.utc) - timedelta(days=8)
+    recent = datetime.now(timezone.utc) - timedelta(days=1)
+    async with Session() as s:
+        for status, t in [(JobStatus.done, old), (JobStatus.failed, old), (JobStatus.cancelled, old),
+                          (JobStatus.done, recent), (JobStatus.queued, old)]:
+            s.add(Job(kind="infer", project_id=pid, payload={}, status=status, created_at=t,
+                      finished_at=t if status != JobStatus.queued else None))
+        await s.commit()
+        assert await jobqueue.prune_finished(s, batch=2) == 3
+        left = (await s.execute(select(Job.status))).scalars().all()
+    assert sorted(left) == sorted([JobStatus.done, JobStatus.queued])
+
+
+async def test_last_served_looks_at_recent_window_only(Session, monkeypatch, make_user, make_project):
+    from app.config import settings
+
+    monkeypatch.setattr(settings, "SCHED_SERVED_WINDOW_SEC", 3600)
+    u = await make_user()
+    pid = (await make_project(u)).id
+    now = datetime.now(timezone.utc)
+    async with Session() as s:
+        s.add(Job(kind="infer", project_id=pid, user_id=u.id, payload={}, status=JobStatus.done,
+                  created_at=now - timedelta(days=2), started_at=now - timedelta(days=2)))
+        await s.commit()
+        assert await jobqueue._last_served(s, {u.id}) == {}
+        s.add(Job(kind="infer", project_id=pid, user_id=u.id, payload={}, status=JobStatus.done,
+                  created_at=now - timedelta(minutes=5), started_at=now - timedelta(minutes=5)))
+        await s.commit()
+        assert list(await jobqueue._last_served(s, {u.id})) == [u.id]
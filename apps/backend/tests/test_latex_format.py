@@ -0,0 +1,80 @@
+import os, shutil
+
+import pytest
+
+from app import metrics
+from app.config import settings
+from app.utils import latex_format
+from app.utils.assemble_latex import FOOTER, HEADER
+from app.utils.latex_to_pdf import compile_tex_file_to_pdf
+
+# pdflatex-заглушка: -ini «дампит» формат, -fmt= требует его в TEXFORMATS
+FAKE_PDFLATEX = """#!/bin/sh
+if [ "$1" = "--version" ]; then echo "pdfTeX 3.14 fake"; exit 0; fi
+echo "$@" >> "{log}"
+for a in "$@"; do case "$a" in -ini) ini=1;; -jobname=*) job="${{a#-jobname=}}";; -fmt=*) fmt="${{a#-fmt=}}";; *.tex) src="$a";; esac; done
+[ -z "$job" ] && job="${{src%.tex}}"
+if [ -n "$ini" ]; then printf 'fmt' > "$job.fmt"; exit 0; fi
+if [ -n "$fmt" ]; then
+  [ -n "$FAIL_FMT" ] && exit 1
+  [ -f "${{TEXFORMATS%%:*}}/$fmt.fmt" ] || exit 1
+fi
+printf '%%PDF-1.4 fake' > "$job.pdf"
+"""
+
+DOC = HEADER.replace("%TITLE%", "T") + "\\[x^2\\]\n" + FOOTER
+
+
+@pytest.fixture
+def fake_pdflatex(tmp_path, monkeypatch):
+    if shutil.which("latexmk"):
+        pytest.skip("real latexmk on PATH")
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    log = tmp_path / "calls.log"
+    exe = bindir / "pdflatex"
+    exe.write_text(FAKE_PDFLATEX.format(log=log))
+    exe.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(settings, "LATEX_FORMAT_DIR", str(tmp_path / "fmt"))
+    monkeypatch.setattr(settings, "LATEX_PRECOMPILED_FORMAT", True)
+    monkeypatch.setattr(settings, "TEX_CACHE_MAX_MB", 0)
+    monkeypatch.setattr(latex_format, "_failed", set())
+    latex_format.tool_version.cache_clear()
+    return log
+
+
+def _doc(tmp_path, name, text=DOC):
+    d = tmp_path / name
+    d.mkdir()
+    tex = d / "formulas.tex"
+    tex.write_text(text, encoding="utf-8")
+    return tex
+
+
+def test_split_preamble():
+    assert latex_format.split_preamble(DOC).startswith("\\title{T}")
+    assert latex_format.split_preamble("\\documentclass{book}\n\\begin{document}x\\end{document}") is None
+
+
+@pytest.mark.skipif(os.name != "posix", reason="shell stand-in for pdflatex")
+def test_standard_preamble_uses_format_built_once(tmp_path, fake_pdflatex):
+    for name in ("a", "b"):
+        assert compile_tex_file_to_pdf(_doc(tmp_path, name)).exists()
+    calls = fake_pdflatex.read_text().splitlines()
+    assert sum("-ini" in c for c in calls) == 1
+    assert all("-fmt=" in c and "formulas.body.tex" in c for c in calls if "-ini" not in c)
+
+    other = "\\documentclass{article}\n\\begin{document}x\\end{document}\n"
+    assert compile_tex_file_to_pdf(_doc(tmp_path, "c", other)).exists()
+    assert "-fmt=" not in fake_pdflatex.read_text().splitlines()[-1]
+
+
+@pytest.mark.skipif(os.name != "posix", reason="shell stand-in for pdflatex")
+def test_broken_format_falls_back_to_full_compile(tmp_path, fake_pdflatex, monkeypatch):
+    monkeypatch.setenv("FAIL_FMT", "1")
+    before = metrics.snapshot()["counters"].get("latex.fmt_fallback", 0)
+    assert compile_tex_file_to_pdf(_doc(tmp_path, "a")).exists()
+    last = fake_pdflatex.read_text().splitlines()[-1]
+    assert "-fmt=" not in last and last.endswith("formulas.tex")
+    assert metrics.snapshot()["counters"]["latex.fmt_fallback"] == before + 1
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from app.config import settings
+from app.utils.latex_to_pdf import compile_tex_file_to_pdf
+
+# pdflatex-заглушка: документ со \ref на первом проходе пишет метку в .aux
+# и просит перезапуск, на втором метка уже есть — просьбы нет
+FAKE_PDFLATEX = r"""#!/bin/sh
+if [ "$1" = "--version" ]; then echo "pdfTeX fake"; exit 0; fi
+echo pdflatex >> "{log}"
+for a in "$@"; do case "$a" in *.tex) src="$a"; job="${{a%.tex}}";; esac; done
+if grep -q 'undefinedcmd' "$src"; then echo '! Undefined control sequence.' > "$job.log"; exit 1; fi
+if grep -q 'ref{{' "$src"; then
+  if grep -qs newlabel "$job.aux"; then echo 'Output written' > "$job.log"
+  else echo 'LaTeX Warning: Label(s) may have changed. Rerun to get cross-references right.' > "$job.log"; fi
+  printf '%s\n' '\newlabel{{eq}}{{{{1}}{{1}}}}' > "$job.aux"
+else
+  printf '%s\n' '\relax' > "$job.aux"; echo 'Output written' > "$job.log"
+fi
+printf '%%PDF-1.4 fake' > "$job.pdf"
+"""
+
+FAKE_LATEXMK = """#!/bin/sh
+echo latexmk >> "{log}"
+for a in "$@"; do case "$a" in -jobname=*) job="${{a#-jobname=}}";; esac; done
+printf '%%PDF-1.4 fake' > "$job.pdf"
+"""
+
+SIMPLE = "\\documentclass{article}\n\\begin{document}\n\\[x^2\\]\n\\end{document}\n"
+
+
+@pytest.fixture
+def tools(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    log = tmp_path / "calls.log"
+    log.write_text("")
+    for name, body in (("pdflatex", FAKE_PDFLATEX), ("latexmk", FAKE_LATEXMK)):
+        exe = bindir / name
+        exe.write_text(body.format(log=log))
+        exe.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(settings, "TEX_CACHE_MAX_MB", 0)
+    monkeypatch.setattr(settings, "LATEX_PRECOMPILED_FORMAT", False)
+    return lambda: log.read_text().split()
+
+
+def _compile(tmp_path, text, report):
+    tex = tmp_path / "doc.tex"
+    tex.write_text(text)
+    return compile_tex_file_to_pdf(tex, report=report)
+
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="shell stand-ins for TeX")
+
+
+def test_plain_document_takes_one_pass_without_latexmk(tmp_path, tools):
+    report = {}
+    assert _compile(tmp_path, SIMPLE, report).exists()
+    assert tools() == ["pdflatex"]
+    assert report["passes"] == 1 and len(report["pass_ms"]) == 1 and report["reruns"] == []
+
+
+def test_rerun_only_while_log_or_aux_ask_for_it(tmp_path, tools):
+    report = {}
+    doc = SIMPLE.replace("\\[x^2\\]", "\\begin{equation}\\label{eq}x\\end{equation} see \\ref{eq}")
+    _compile(tmp_path, doc, report)
+    assert tools() == ["pdflatex", "pdflatex"]
+    assert report["passes"] == 2 and report["reruns"][0].startswith("log: ")
+
+
+def test_failed_pass_is_not_repeated(tmp_path, tools):
+    report = {}
+    with pytest.raises(RuntimeError, match="LaTeX"):
+        _compile(tmp_path, SIMPLE.replace("x^2", "\\undefinedcmd"), report)
+    assert tools() == ["pdflatex"] and report["passes"] == 1
+
+
+def test_bibliography_goes_through_latexmk(tmp_path, tools):
+    report = {}
+    _compile(tmp_path, SIMPLE.replace("\\end{document}", "\\bibliography{refs}\n\\end{document}"), report)
+    assert tools() == ["latexmk"] and report["engine"] == "latexmk"
@@ -0,0 +1,87 @@
+import pytest
+
+from app.utils.assemble_latex import build_mixed_document
+from app.utils.latex_validate import check_formula, formula_warnings, validate_formula
+
+
+@pytest.mark.parametrize("src", [
+    r"\frac{a}{b}+\sqrt[3]{x^{2}}",
+    r"\left( \sum _ { i = 1 } ^ { n } x _ { i } \right)",
+    r"\begin{pmatrix} 1 & 2 \\ 3 & 4 \end{pmatrix}",
+    r"f(x)=\begin{cases} x & x>0 \\ 0 & \text{иначе} \end{cases}",
+    r"\{ x \mid x \in \mathbb { R } \}",
+    r"\left. \frac { d y } { d x } \right| _ { x = 0 }",
+    r"\operatorname*{arg\,max}_x f",
+    r"\begin{array}{cc} a & b \\ \hline c & d \end{array}",
+    r"{\cal L} = {\rm d} x + {\bf v}",
+    r"\mathop{\rm lim}_{n \to \infty} {a \over b}",
+    r"\lbrack 0 , 1 \rbrack",
+    r"x \leqq y",
+    r"\foo{x} + \bar{y}",
+    "",
+])
+def test_valid_formulas(src):
+    assert validate_formula(src) == []
+
+
+@pytest.mark.parametrize("src, needle", [
+    (r"\frac{a}{b", "unclosed '{'"),
+    (r"a}+b", "unexpected '}'"),
+    (r"\left( x", "\\left without \\right"),
+    (r"x \right)", "\\right without \\left"),
+    (r"\begin{pmatrix} 1 \end{bmatrix}", "does not match"),
+    (r"\begin{matrix} 1", "unclosed environment"),
+    (r"\begin{align} x \end{align}", "not allowed"),
+    (r"\frac{a}", "missing an argument"),
+    (r"\frac{a}}", "missing an argument"),
+    (r"a & b", "outside alignment"),
+    (r"x % y", "comment char"),
+    (r"$x$", "stray '$'"),
+    (r"\[ x \]", "nested math"),
+])
+def test_invalid_formulas(src, needle):
+    issues = validate_formula(src)
+    assert any(needle in i for i in issues), issues
+
+
+def test_unknown_commands_are_warnings():
+    assert formula_warnings(r"\foo \foo \baz") == ["unknown command(s): \\foo, \\baz"]
+    assert formula_warnings(r"{a \over b}") == []
+    assert validate_formula(r"\foo \foo \baz") == []
+
+
+def test_document_quarantines_invalid_formula():
+    tex = build_mixed_document([
+        (0, "formula", r"\frac{a}{b", 0, 0, 100, 20),
+        (1, "formula", r"x^2", 0, 100, 100, 120),
+        (2, "text", "где", 0, 200, 40, 220),
+        (3, "formula", r"\frac{1}", 50, 200, 90, 220),
+        (4, "formula", r"\oops_1", 0, 300, 100, 320),
+    ], title="t")
+    # битая display-формула — текстом, с причиной в комментарии
+    assert "% invalid #0: 1 unclosed '{'" in tex
+    assert r"\texttt{\textbackslash{}frac\{a\}\{b}" in tex
+    assert r"\frac{a}{b" not in tex.replace(r"\texttt{", "")
+    # валидная — как была
+    assert "\\[\nx^2\n\\]" in tex
+    # inline тоже в карантин, строка с текстом не ломается
+    assert r"где \texttt{\textbackslash{}frac\{1\}}" in tex
+    assert "% invalid #3: \\frac is missing an argument" in tex
+    # незнакомая команда — не повод для карантина
+    assert "\\[\n\\oops_1\n\\]" in tex
+    assert "invalid #4" not in tex
+
+
+def test_document_without_validation_keeps_source():
+    tex = build_mixed_document([(0, "formula", r"\frac{a}{b", 0, 0, 100, 20)], title="t", validate=False)
+    assert "\\[\n\\frac{a}{b\n\\]" in tex
+    assert "invalid" not in tex
+
+
+def test_stored_issues_are_not_rechecked():
+    assert check_formula(r"\frac{a}{b \foo") == {
+        "issues": validate_formula(r"\frac{a}{b \foo"), "warnings": formula_warnings(r"\frac{a}{b \foo")}
+    blocks = [(0, "formula", r"\frac{a}{b", 0, 0, 100, 20), (1, "formula", "x^2", 0, 100, 100, 120)]
+    # проверка уже была (в пайплайне): сборка берёт её результат как есть
+    tex = build_mixed_document(blocks, title="t", issues={0: [], 1: ["stored"]})
+    assert "\\[\n\\frac{a}{b\n\\]" in tex and "% invalid #1: stored" in tex
@@ -0,0 +1,103 @@
+import random
+import statistics
+
+import pytest
+
+from app.utils import assemble_latex
+from app.utils.assemble_latex import (
+    _cluster_into_lines, _vertical_overlap, _x_left, _y_center, build_mixed_document,
+)
+
+
+def _legacy(blocks):
+    # прежняя версия: каждый блок против каждой строки, медиана с нуля
+    bs = [b for b in blocks if isinstance(b.get("content", ""), str) and b["content"].strip() != ""]
+    if not bs:
+        return []
+    bs_sorted = sorted(bs, key=lambda b: (b["bbox"][1], b["bbox"][0]))
+    heights = [max(1.0, float(b["bbox"][3] - b["bbox"][1])) for b in bs_sorted]
+    med_h = statistics.median(heights) if heights else 20.0
+    y_tol = max(10.0, 0.6 * med_h)
+    if statistics.pstdev(heights) > 0.8 * (med_h + 1e-6):
+        y_tol *= 1.25
+    lines = []
+    for b in bs_sorted:
+        cy = _y_center(b)
+        best, best_score = -1, -1.0
+        for i, line in enumerate(lines):
+            line_cy = statistics.median([_y_center(x) for x in line])
+            dy = abs(cy - line_cy)
+            ovl = max(_vertical_overlap(b, x) for x in line)
+            score = (max(0.0, y_tol - dy) / y_tol) + 0.5 * ovl
+            if (dy <= y_tol or ovl >= 0.5) and score > best_score:
+                best_score, best = score, i
+        if best >= 0:
+            lines[best].append(b)
+        else:
+            lines.append([b])
+    for line in lines:
+        line.sort(key=_x_left)
+    lines.sort(key=lambda ln: min(b["bbox"][1] for b in ln))
+    return lines
+
+
+def _ids(lines):
+    return [[b["idx"] for b in line] for line in lines]
+
+
+def _block(i, x, y, w, h, content="x"):
+    return {"idx": i, "kind": "text", "content": content, "bbox": (x, y, x + w, y + h)}
+
+
+def _page(rng, n, dense=False, tall=False, grid=False):
+    out = []
+    for i in range(n):
+        if grid:
+            # целые координаты — много равных центров и ничьих по score
+            x, y = rng.randrange(0, 10) * 50, rng.randrange(0, n // 3 + 1) * 10
+            w, h = 40, rng.choice((10, 20, 30))
+        else:
+            x = rng.uniform(0, 1000)
+            y = rng.uniform(0, 300 if dense else 30 * n)
+            w, h = rng.uniform(10, 200), rng.uniform(8, 40)
+        if tall and rng.random() < 0.1:
+            h *= rng.uniform(3, 10)
+        out.append(_block(i, x, y, w, h, "" if rng.random() < 0.05 else "x"))
+    return out
+
+
+def test_fixture_lines():
+    blocks = [
+        _block(0, 0, 0, 100, 20), _block(1, 120, 4, 60, 18),
+        _block(2, 0, 40, 300, 30),
+        _block(3, 200, 90, 50, 20), _block(4, 0, 92, 150, 20),
+        _block(5, 0, 130, 40, 200),  # высокая формула сбоку
+        _block(6, 50, 140, 40, 20), _block(7, 50, 300, 40, 20),
+        _block(8, 0, 400, 40, 20, "   "),
+    ]
+    assert _ids(_cluster_into_lines(blocks)) == _ids(_legacy(blocks))
+    assert _ids(_cluster_into_lines(blocks))[:3] == [[0, 1], [2], [4, 3]]
+    assert _cluster_into_lines([]) == [] and _cluster_into_lines([_block(0, 0, 0, 1, 1, "")]) == []
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_matches_legacy_on_random_pages(seed):
+    rng = random.Random(seed)
+    for kw in ({}, {"dense": True}, {"tall": True}, {"grid": True}, {"dense": True, "tall": True}):
+        blocks = _page(rng, rng.randrange(1, 120), **kw)
+        assert _ids(_cluster_into_lines(blocks)) == _ids(_legacy(blocks)), kw
+
+
+def test_degenerate_boxes_match_legacy():
+    # y2 < y1 и нулевая высота: отсечение строк не должно на них полагаться
+    rng = random.Random(7)
+    blocks = [_block(i, rng.uniform(0, 500), rng.uniform(0, 400), 30, rng.uniform(-60, 40)) for i in range(150)]
+    assert _ids(_cluster_into_lines(blocks)) == _ids(_legacy(blocks))
+
+
+def test_document_unchanged_on_multi_page(monkeypatch):
+    rng = random.Random(1)
+    items = [(b["idx"], "text", f"t{b['idx']}", *b["bbox"]) for b in _page(rng, 400)]
+    tex = build_mixed_document(items, title="t")
+    monkeypatch.setattr(assemble_latex, "_cluster_into_lines", _legacy)
+    assert build_mixed_document(items, title="t") == tex
@@ -0,0 +1,175 @@
+import os, time
+
+import pytest
+from sqlalchemy import select
+
+from app import worker
+from app.loop_monitor import measure_lag
+from app.models import Project, ProjectStatus
+
+# Порог блокировки event loop: всё, что дольше, — синхронный вызов в корутине
+MAX_LAG_SEC = 0.1
+STEP_SEC = 0.6
+
+FAKE_LATEXMK = f"""#!/bin/sh
+for a in "$@"; do case "$a" in -jobname=*) job="${{a#-jobname=}}";; esac; done
+sleep {STEP_SEC}
+printf '%%PDF-1.4 fake' > "$job.pdf"
+"""
+
+FAKE_PANDOC = f"""#!/bin/sh
+while [ $# -gt 0 ]; do [ "$1" = "-o" ] && out="$2"; shift; done
+sleep {STEP_SEC}
+printf 'docx' > "$out"
+"""
+
+
+@pytest.fixture
+def fake_tex_tools(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    for name, body in (("latexmk", FAKE_LATEXMK), ("pandoc", FAKE_PANDOC)):
+        exe = bindir / name
+        exe.write_text(body)
+        exe.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(worker.settings, "TEX_CACHE_MAX_MB", 0)
+
+
+@pytest.mark.skipif(os.name != "posix", reason="shell stand-ins for latexmk/pandoc")
+async def test_tex_build_does_not_block_event_loop(Session, fake_tex_tools, tmp_path, monkeypatch, make_project):
+    uploaded = []
+
+    def slow_upload(src, key, content_type=None):
+        time.sleep(0.2)  # сетевой вызов S3
+        uploaded.append(key)
+        return key
+
+    monkeypatch.setattr(worker, "upload_file", slow_upload)
+    p = await make_project(tex_revision=1)
+
+    workdir = tmp_path / "work"
+    workdir.mkdir()
+    t0 = time.monotonic()
+    async with measure_lag() as probe:
+        await worker._run_build_tex(p.id, "\\[x = y\\]", str(workdir), rev=1)
+    elapsed = time.monotonic() - t0
+
+    assert probe.samples > 10
+    assert probe.max_lag < MAX_LAG_SEC, f"event loop blocked for {probe.max_lag * 1000:.0f} ms"
+    # pdf и docx собирались параллельно, а не друг за другом
+    assert elapsed < 2 * STEP_SEC
+    async with Session() as s:
+        got = (await s.execute(select(Project).where(Project.id == p.id))).unique().scalar_one()
+    assert got.status == ProjectStatus.ready
+    assert got.pdf_key.endswith("formulas.pdf") and got.docx_key.endswith("formulas.docx")
+    assert len(uploaded) == 3
+
+
+@pytest.mark.skipif(os.name != "posix", reason="shell stand-ins for latexmk/pandoc")
+async def test_tex_build_switches_to_revision_keys(Session, fake_tex_tools, tmp_path, monkeypatch, make_project):
+    deleted = []
+    monkeypatch.setattr(worker, "upload_file", lambda src, key, content_type=None: key)
+    monkeypatch.setattr(worker, "delete_objects", deleted.extend)
+    p = await make_project(tex_revision=3, tex_key="old/formulas.tex", pdf_key="old/formulas.pdf")
+    workdir = tmp_path / "work"
+    workdir.mkdir()
+    await worker._run_build_tex(p.id, "\\[x\\]", str(workdir), rev=3)
+    async with Session() as s:
+        got = await s.get(Project, p.id)
+    assert got.tex_key.endswith("/rev3/formulas.tex") and got.docx_key.endswith("/rev3/formulas.docx")
+    assert deleted == ["old/formulas.tex", "old/formulas.pdf"]
+
+
+@pytest.mark.skipif(os.name != "posix", reason="shell stand-ins for latexmk/pandoc")
+async def test_edit_during_upload_supersedes_build(Session, fake_tex_tools, tmp_path, monkeypatch, make_project):
+    import asyncio
+    from sqlalchemy import update
+
+    deleted, uploading = [], asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def slow_upload(src, key, content_type=None):
+        loop.call_soon_threadsafe(uploading.set)
+        time.sleep(0.3)
+        return key
+
+    monkeypatch.setattr(worker, "upload_file", slow_upload)
+    monkeypatch.setattr(worker, "delete_objects", deleted.extend)
+    p = await make_project(tex_revision=1, tex_key="old/formulas.tex")
+    workdir = tmp_path / "work"
+    workdir.mkdir()
+    build = asyncio.create_task(worker._run_build_tex(p.id, "\\[x\\]", str(workdir), rev=1))
+    await uploading.wait()
+    # правка, пришедшая во время выкладки, не ждёт её
+    async with Session() as s:
+        await s.execute(update(Project).where(Project.id == p.id).values(tex_revision=2))
+        await s.commit()
+    with pytest.raises(worker.Cancelled):
+        await build
+    async with Session() as s:
+        got = await s.get(Project, p.id)
+    assert got.tex_key == "old/formulas.tex"
+    assert sorted(k.rsplit("/", 1)[1] for k in deleted) == ["formulas.docx", "formulas.pdf", "formulas.tex"]
+
+
+def _slow(fn=None, sec=0.2):
+    # синхронный сетевой вызов (S3): если его дёрнут прямо в корутине — loop встанет на sec
+    def call(*args, **kwargs):
+        time.sleep(sec)
+        return fn(*args, **kwargs) if fn else (args[1] if len(args) > 1 else None)
+    return call
+
+
+async def test_infer_does_not_block_event_loop(Session, tmp_path, monkeypatch, make_project):
+    import sys, types
+    from app.utils.assemble_latex import write_mixed_latex_file
+
+    def fetch(key, dest):
+        if key.endswith("pipeline.json"):
+            raise FileNotFoundError(key)
+        open(dest, "wb").write(b"\x89PNG fake page")
+        return dest
+
+    def run_full_pipeline(cancel=None, **params):
+        time.sleep(0.5)  # модели: в потоке воркера, не в loop
+        blocks = [{"idx": 1, "kind": "formula", "content": "x^2", "bbox": (0, 0, 100, 20)}]
+        tex = write_mixed_latex_file([(1, "formula", "x^2", 0, 0, 100, 20)], f"{params['temp_dir']}/page.tex")
+        return {"tex_path": tex, "pdf_path": None, "blocks": blocks, "record": None}
+
+    monkeypatch.setitem(sys.modules, "app.pipeline", types.SimpleNamespace(run_full_pipeline=run_full_pipeline))
+    monkeypatch.setattr(worker.settings, "INFER_POOL_SIZE", 0)
+    monkeypatch.setattr(worker.settings, "RESULT_CACHE_DIR", str(tmp_path / "results"))
+    monkeypatch.setattr(worker.result_cache, "_cache", None)
+    monkeypatch.setattr(worker, "fetch_to_path", _slow(fetch))
+    monkeypatch.setattr(worker, "upload_file", _slow())
+    p = await make_project(image_key="in/image.png")
+    workdir = tmp_path / "work"
+    workdir.mkdir()
+
+    async with measure_lag() as probe:
+        await worker._run_infer(p.id, str(workdir))
+
+    assert probe.samples > 10
+    assert probe.max_lag < MAX_LAG_SEC, f"event loop blocked for {probe.max_lag * 1000:.0f} ms"
+    async with Session() as s:
+        got = await s.get(Project, p.id)
+    assert got.status == ProjectStatus.ready and got.docx_key.endswith("formulas.docx")
+
+
+async def test_create_project_does_not_block_event_loop(tmp_path, monkeypatch, make_user):
+    import sys
+    import httpx
+    from app.main import app
+    from app.security import create_access_token
+
+    projects = sys.modules["app.routers.projects"]
+    monkeypatch.setattr(projects, "upload_file", _slow())
+    monkeypatch.setattr(worker.settings, "TEMP_DIR", str(tmp_path))
+    u = await make_user()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t") as c:
+        async with measure_lag() as probe:
+            r = await c.post("/projects", files={"image": ("page.png", b"\x89PNG" + b"0" * 4096, "image/png")},
+                             headers={"Authorization": f"Bearer {create_access_token(u)}"})
+    assert r.status_code == 200, r.text
+    assert probe.max_lag < MAX_LAG_SEC, f"event loop blocked for {probe.max_lag * 1000:.0f} ms"
@@ -0,0 +1,35 @@
+from app import pipeline_record as pr
+
+PARAMS = dict(
+    detector_weights="missing/best.pt", trocr_dir="missing/trocr", htr_weights="missing/htr.pt",
+    det_conf=0.25, det_iou=0.5, det_imgsz=1280, det_pad=0.001,
+    beams=4, max_new_tokens=224, length_penalty=1.1, bin_strength=0.75, erode_kernel=3,
+)
+
+
+def test_decoding_params_do_not_invalidate_detection():
+    det = pr.stage_key("detect", PARAMS, "sha")
+    form = pr.stage_key("formulas", PARAMS)
+
+    changed = dict(PARAMS, beams=2, bin_strength=0.9, erode_kernel=5)
+    assert pr.stage_key("detect", changed, "sha") == det
+    assert pr.stage_key("formulas", changed) != form
+    assert pr.stage_key("text", changed) == pr.stage_key("text", PARAMS)
+
+
+def test_detection_invalidated_by_image_or_detector_params():
+    det = pr.stage_key("detect", PARAMS, "sha")
+    assert pr.stage_key("detect", PARAMS, "other") != det
+    assert pr.stage_key("detect", dict(PARAMS, det_imgsz=960), "sha") != det
+
+
+def test_record_roundtrip_and_reuse():
+    rec = pr.coerce_record(None, "sha")
+    f_key = pr.stage_key("formulas", PARAMS)
+    pr.put_stage(rec, "formulas", f_key, PARAMS, outputs={pr.bbox_key((1, 2, 3, 4)): "x^2"})
+
+    import json
+    loaded = pr.coerce_record(json.loads(pr.dump_record(rec)), "sha")
+    assert pr.reusable_outputs(loaded, "formulas", f_key) == {"1,2,3,4": "x^2"}
+    assert pr.reusable_outputs(loaded, "formulas", pr.stage_key("formulas", dict(PARAMS, beams=1))) == {}
+    assert pr.coerce_record(loaded, "another-image")["stages"] == {}
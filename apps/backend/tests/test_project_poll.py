@@ -0,0 +1,136 @@
+import asyncio
+
+import httpx
+import pytest
+from sqlalchemy import update
+
+from app.config import settings
+from app.main import app
+from app.models import Project, ProjectStatus
+from app.notify import ProjectEvents, project_events, publish
+from app.security import create_access_token
+
+
+@pytest.fixture
+async def client():
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t") as c:
+        yield c
+
+
+async def _setup(make_user, make_project):
+    u = await make_user()
+    p = await make_project(u)
+    return {"Authorization": f"Bearer {create_access_token(u)}"}, p.id
+
+
+async def _finish(Session, pid):
+    async with Session() as s:
+        await s.execute(update(Project).where(Project.id == pid).values(status=ProjectStatus.ready))
+        await publish(s, pid)
+        await s.commit()
+
+
+async def test_events_wake_and_time_out():
+    ev = ProjectEvents()
+    waiter = asyncio.create_task(ev.wait("p1", 5))
+    await asyncio.sleep(0.01)
+    assert ev.notify("p1") == 1
+    assert await waiter is True
+    assert await ev.wait("p1", 0.01) is False
+    assert ev.waiting() == 0
+
+
+async def test_conditional_get_returns_304(Session, client, make_user, make_project):
+    headers, pid = await _setup(make_user, make_project)
+    r = await client.get(f"/projects/{pid}", headers=headers)
+    assert r.status_code == 200 and r.json()["status"] == "processing"
+    tag = r.headers["etag"]
+
+    r = await client.get(f"/projects/{pid}", headers={**headers, "If-None-Match": tag})
+    assert r.status_code == 304 and r.headers["etag"] == tag
+
+    await _finish(Session, pid)
+    r = await client.get(f"/projects/{pid}", headers={**headers, "If-None-Match": tag})
+    assert r.status_code == 200 and r.json()["status"] == "ready"
+    assert r.headers["etag"] != tag
+
+
+async def test_long_poll_wakes_on_update(Session, client, make_user, make_project):
+    headers, pid = await _setup(make_user, make_project)
+    tag = (await client.get(f"/projects/{pid}", headers=headers)).headers["etag"]
+
+    loop = asyncio.get_running_loop()
+    t0 = loop.time()
+    poll = asyncio.create_task(
+        client.get(f"/projects/{pid}", params={"wait": 10}, headers={**headers, "If-None-Match": tag})
+    )
+    for _ in range(100):
+        if project_events.waiting():
+            break
+        await asyncio.sleep(0.01)
+    assert project_events.waiting() == 1
+    await _finish(Session, pid)
+    r = await poll
+    assert r.status_code == 200 and r.json()["status"] == "ready"
+    assert loop.time() - t0 < 2
+
+
+async def test_long_poll_times_out_with_304(client, monkeypatch, make_user, make_project):
+    monkeypatch.setattr(settings, "PROJECT_WAIT_MAX_SEC", 0.2)
+    headers, pid = await _setup(make_user, make_project)
+    tag = (await client.get(f"/projects/{pid}", headers=headers)).headers["etag"]
+    r = await client.get(f"/projects/{pid}", params={"wait": 10}, headers={**headers, "If-None-Match": tag})
+    assert r.status_code == 304
+
+
+async def test_get_counts_queue_once(client, monkeypatch, make_user, make_project):
+    import sys
+
+    projects = sys.modules["app.routers.projects"]
+    headers, pid = await _setup(make_user, make_project)
+    calls = []
+    real = projects.queue_info
+
+    async def counting(session, ids):
+        calls.append(list(ids))
+        return await real(session, ids)
+
+    monkeypatch.setattr(projects, "queue_info", counting)
+    r = await client.get(f"/projects/{pid}", headers=headers)
+    assert r.status_code == 200 and calls == [[pid]]
+
+
+async def test_not_modified_skips_queue_positions(Session, client, monkeypatch, make_user, make_project):
+    import sys
+
+    from app import admission, jobqueue
+
+    projects = sys.modules["app.routers.projects"]
+    monkeypatch.setattr(admission, "_order_cache", {})
+    monkeypatch.setattr(settings, "ADMISSION_QUEUE_TTL_SEC", 0)
+    headers, pid = await _setup(make_user, make_project)
+    ahead = await make_project()
+    async with Session() as s:
+        await jobqueue.enqueue(s, "infer", ahead.id)
+        await jobqueue.enqueue(s, "infer", pid)
+        await s.commit()
+    r = await client.get(f"/projects/{pid}", headers=headers)
+    assert r.json()["queuePosition"] == 2
+    tag = r.headers["etag"]
+
+    calls = []
+    real = projects.queue_info
+
+    async def counting(session, ids):
+        calls.append(list(ids))
+        return await real(session, ids)
+
+    monkeypatch.setattr(projects, "queue_info", counting)
+    r = await client.get(f"/projects/{pid}", headers={**headers, "If-None-Match": tag})
+    assert r.status_code == 304 and calls == []
+
+    # задачу впереди взяли — очередь сдвинулась, тег другой
+    async with Session() as s:
+        await jobqueue.lease(s, "w1")
+    r = await client.get(f"/projects/{pid}", headers={**headers, "If-None-Match": tag})
+    assert r.status_code == 200 and r.json()["queuePosition"] == 1 and calls == [[pid]]
@@ -0,0 +1,43 @@
+import pytest
+from pydantic import ValidationError
+
+from app import qos
+from app.config import Settings, settings
+
+
+@pytest.fixture(autouse=True)
+def thresholds(monkeypatch):
+    monkeypatch.setattr(settings, "QOS_BALANCED_DEPTH", 20)
+    monkeypatch.setattr(settings, "QOS_FAST_DEPTH", 60)
+    monkeypatch.setattr(settings, "QOS_FORCE_TIER", "")
+
+
+def test_tier_follows_queue_depth_and_premium_is_one_step_up():
+    assert [qos.pick(d) for d in (0, 19, 20, 59, 60, 500)] == ["full", "full", "balanced", "balanced", "fast", "fast"]
+    assert [qos.pick(d, premium=True) for d in (0, 20, 60)] == ["full", "full", "balanced"]
+
+
+def test_disabled_threshold_and_forced_tier(monkeypatch):
+    monkeypatch.setattr(settings, "QOS_FAST_DEPTH", 0)
+    assert qos.pick(10_000) == "balanced"
+    monkeypatch.setattr(settings, "QOS_FORCE_TIER", "fast")
+    assert qos.pick(0, premium=True) == "fast"
+
+
+def test_cheaper_tiers_never_cost_more_than_full(monkeypatch):
+    full = qos.params_for("full")
+    assert full["beams"] == settings.BEAMS and full["det_imgsz"] == settings.DET_IMGSZ
+    for tier in ("balanced", "fast"):
+        p = qos.params_for(tier)
+        assert p["beams"] <= full["beams"] and p["det_imgsz"] <= full["det_imgsz"]
+        assert p["max_new_tokens"] <= full["max_new_tokens"]
+    monkeypatch.setattr(settings, "BEAMS", 1)
+    assert qos.params_for("balanced")["beams"] == 1
+    with pytest.raises(ValueError):
+        qos.params_for("ultra")
+
+
+def test_unknown_forced_tier_fails_at_startup():
+    with pytest.raises(ValidationError):
+        Settings(QOS_FORCE_TIER="Fast")
+    assert Settings(QOS_FORCE_TIER="fast").QOS_FORCE_TIER == "fast"
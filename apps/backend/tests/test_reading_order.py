@@ -0,0 +1,128 @@
+import random
+
+import numpy as np
+import pytest
+
+from app.utils.assemble_latex import (
+    _cluster_into_lines, _reading_lines, build_mixed_document, formulas_from_tex, reading_order,
+)
+from app.utils.docx_writer import paragraphs_from_blocks
+from app.utils.reading_order import column_gutters, reading_groups
+
+
+def _two_columns(rows=6, title=True, footer=True):
+    # (x1, y1, x2, y2, label): заголовок на всю ширину, две колонки, подпись
+    out = [(0, 0, 1000, 40, "title")] if title else []
+    for r in range(rows):
+        y = 80 + r * 30
+        out.append((0, y, 470, y + 20, f"L{r}"))
+        out.append((530, y + 2, 1000, y + 22, f"R{r}"))
+    if footer:
+        out.append((0, 300, 1000, 320, "footer"))
+    return out
+
+
+def _labels(boxes):
+    return [boxes[i][4] for i in reading_order([b[:4] for b in boxes])]
+
+
+def test_two_columns_read_column_by_column():
+    boxes = _two_columns()
+    assert column_gutters([b[:4] for b in boxes]).shape == (1, 2)
+    assert _labels(boxes) == ["title"] + [f"L{r}" for r in range(6)] + [f"R{r}" for r in range(6)] + ["footer"]
+    # вход в любом порядке — тот же результат
+    shuffled = boxes[:]
+    random.Random(0).shuffle(shuffled)
+    assert _labels(shuffled) == _labels(boxes)
+
+
+def test_margin_notes_after_main_text():
+    boxes = [(0, y, 700, y + 20, f"m{i}") for i, y in enumerate(range(0, 300, 30))]
+    boxes += [(780, 15, 900, 35, "n0"), (780, 200, 900, 220, "n1")]
+    assert _labels(boxes) == [f"m{i}" for i in range(10)] + ["n0", "n1"]
+
+
+def test_single_column_is_rows():
+    # строка текста + формула рядом — не колонки; вместо y // 50 — настоящие строки
+    boxes = [(0, 45, 300, 65, "a"), (320, 52, 500, 70, "b"), (0, 90, 500, 110, "c"), (10, 130, 60, 150, "d"),
+             (80, 128, 200, 152, "e")]
+    assert not len(column_gutters([b[:4] for b in boxes]))
+    assert _labels(boxes) == ["a", "b", "c", "d", "e"]
+
+
+def _numbered(rows=5, label=(0, 30), formula=(60, 400), intro=True):
+    # нумерованный список: "N)" и формула в одной строке, сверху — текст
+    out = [(0, 0, formula[1], 20, "intro")] if intro else []
+    for r in range(rows):
+        y = 40 + r * 40
+        out.append((label[0], y, label[1], y + 20, f"{r + 1})"))
+        out.append((formula[0], y - 3, formula[1], y + 25, f"f{r + 1}"))
+    return out
+
+
+@pytest.mark.parametrize("label, formula, intro", [
+    ((0, 30), (60, 400), False), ((0, 30), (60, 400), True), ((0, 120), (160, 600), False),
+    ((0, 150), (200, 600), False), ((20, 50), (90, 700), True),
+])
+def test_numbered_formulas_are_one_column(label, formula, intro):
+    boxes = _numbered(label=label, formula=formula, intro=intro)
+    assert not len(column_gutters([b[:4] for b in boxes]))
+    assert _labels(boxes) == ["intro"] * intro + [x for r in range(5) for x in (f"{r + 1})", f"f{r + 1}")]
+    # строки те же, что у _cluster_into_lines без колонок
+    blocks = [{"idx": i, "kind": "text", "content": b[4], "bbox": list(b[:4])} for i, b in enumerate(boxes)]
+    assert _reading_lines(blocks) == _cluster_into_lines(blocks)
+
+
+def test_numbered_formulas_inside_two_columns():
+    left = _numbered(label=(0, 30), formula=(60, 470))
+    right = [(x1 + 530, y1, x2 + 530, y2, "R" + t) for x1, y1, x2, y2, t in left]
+    boxes = left + right
+    gutters = column_gutters([b[:4] for b in boxes])
+    assert gutters.shape == (1, 2) and 470 <= gutters[0, 0] and gutters[0, 1] <= 530
+    labels = _labels(boxes)
+    assert labels == [b[4] for b in left] + [b[4] for b in right]
+
+
+def test_ragged_single_column_has_no_gutter():
+    rng = random.Random(3)
+    boxes = []
+    for r in range(40):
+        x = 0.0
+        while x < 900:
+            w = rng.uniform(60, 400)
+            boxes.append((x, r * 30, x + w, r * 30 + 20))
+            x += w + rng.uniform(5, 15)
+    assert (reading_groups(boxes) == 0).all()
+
+
+def test_degenerate_input():
+    assert reading_order([]) == [] and reading_groups(np.empty((0, 4))).tolist() == []
+    assert reading_order([(0, 0, 10, 10)]) == [0]
+
+
+def test_document_and_docx_follow_columns():
+    boxes = _two_columns(rows=3, footer=False)
+    blocks = [(i, "formula" if b[4] == "title" else "text", b[4], *b[:4]) for i, b in enumerate(boxes)]
+    tex = build_mixed_document(blocks, title="t")
+    pos = [tex.index(label) for label in ("L0", "L1", "L2", "R0", "R1", "R2")]
+    assert pos == sorted(pos)
+    assert formulas_from_tex(tex) == {0: "title"}
+
+    paras = paragraphs_from_blocks([{"idx": i, "kind": k, "content": c, "bbox": bb}
+                                    for i, k, c, *bb in blocks])
+    assert [p[0][1] for p in paras] == ["title", "L0", "L1", "L2", "R0", "R1", "R2"]
+
+
+def test_block_order_matches_document_lines(monkeypatch):
+    # нумерация блоков (detect_blocks) и вывод документа — одни группы и строки
+    from app.utils import reading_order as ro
+    boxes = _two_columns(rows=4) + _numbered(rows=2, intro=False)
+    boxes = [(x1, y1 + 400, x2, y2 + 400, t) for x1, y1, x2, y2, t in boxes[-4:]] + boxes[:-4]
+    xyxy = [b[:4] for b in boxes]
+    gutters = column_gutters(xyxy)
+    calls = []
+    monkeypatch.setattr(ro, "column_gutters", lambda *a: calls.append(a) or gutters)
+    order = reading_order(xyxy, gutters)
+    assert not calls  # гаттеры уже посчитаны
+    blocks = [{"idx": i, "kind": "text", "content": b[4], "bbox": list(b[:4])} for i, b in enumerate(boxes)]
+    assert order == [b["idx"] for line in _reading_lines(blocks) for b in line]
@@ -0,0 +1,85 @@
+import os
+import time
+
+from app import metrics, result_cache
+from app.config import settings
+from app.disk_cache import DiskLRU
+
+
+def _write(path, data: bytes):
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_put_get_roundtrip_and_metrics(tmp_path):
+    metrics.reset()
+    cache = DiskLRU(tmp_path / "c", max_bytes=1 << 20, name="t")
+    src = _write(tmp_path / "a.tex", b"\\documentclass{article}")
+
+    assert cache.get("ab" * 32) is None
+    cache.put("ab" * 32, {"formulas.tex": src}, {"blocks": [{"idx": 1}]})
+    hit = cache.get("ab" * 32)
+
+    assert hit["meta"] == {"blocks": [{"idx": 1}]}
+    assert open(hit["files"]["formulas.tex"], "rb").read() == b"\\documentclass{article}"
+    snap = metrics.snapshot()["counters"]
+    assert snap["t.hit"] == 1 and snap["t.miss"] == 1 and snap["t.store"] == 1
+
+
+def test_lru_evicts_least_recently_used(tmp_path):
+    cache = DiskLRU(tmp_path / "c", max_bytes=2500, name="t")
+    blob = _write(tmp_path / "blob", b"x" * 1000)
+
+    cache.put("aa" * 32, {"f": blob})
+    cache.put("bb" * 32, {"f": blob})
+    # «aa» свежее «bb» после обращения
+    old = time.time() - 100
+    os.utime(tmp_path / "c" / "bb" / ("bb" * 32) / "meta.json", (old, old))
+    assert cache.get("aa" * 32)
+
+    cache.put("cc" * 32, {"f": blob})
+    assert cache.get("bb" * 32) is None
+    assert cache.get("aa" * 32) and cache.get("cc" * 32)
+
+
+def test_result_key_depends_on_image_params_and_weights(tmp_path):
+    img = _write(tmp_path / "page.png", b"png-bytes")
+    weights = tmp_path / "best.pt"
+    weights.write_bytes(b"w1")
+    params = {"image_path": img, "temp_dir": "/tmp/x", "beams": 4, "detector_weights": str(weights)}
+
+    k1 = result_cache.result_key(img, params)
+    assert k1 == result_cache.result_key(img, dict(params, temp_dir="/tmp/other"))
+    assert k1 != result_cache.result_key(img, dict(params, beams=2))
+
+    weights.write_bytes(b"w2-changed")
+    assert k1 != result_cache.result_key(img, params)
+
+    img2 = _write(tmp_path / "page2.png", b"other-bytes")
+    assert k1 != result_cache.result_key(img2, params)
+
+
+def test_pinned_entry_survives_eviction_and_sizes_are_tracked_without_rescans(tmp_path, monkeypatch):
+    cache = DiskLRU(tmp_path / "c", max_bytes=2500, name="t")
+    blob = _write(tmp_path / "blob", b"x" * 1000)
+    cache.put("aa" * 32, {"f": blob})
+    scans = []
+    real_scan = cache._scan
+    monkeypatch.setattr(cache, "_scan", lambda: (scans.append(1), real_scan()))
+
+    with cache.pinned("aa" * 32) as hit:
+        cache.put("bb" * 32, {"f": blob})
+        cache._index["aa" * 32][0] = 0.0  # самая старая, но её сейчас читают
+        cache.put("cc" * 32, {"f": blob})
+        assert open(hit["files"]["f"], "rb").read() == b"x" * 1000
+    assert cache.get("bb" * 32) is None and cache.get("aa" * 32)
+    assert scans == []
+
+
+def test_result_key_depends_on_output_settings(tmp_path, monkeypatch):
+    img = _write(tmp_path / "page.png", b"png-bytes")
+    k1 = result_cache.result_key(img, {"beams": 4})
+    monkeypatch.setattr(settings, "LATEX_VALIDATE", not settings.LATEX_VALIDATE)
+    k2 = result_cache.result_key(img, {"beams": 4})
+    monkeypatch.setattr(result_cache, "PIPELINE_VERSION", result_cache.PIPELINE_VERSION + 1)
+    assert len({k1, k2, result_cache.result_key(img, {"beams": 4})}) == 3
@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from app import jobqueue, metrics, scheduler
+from app.config import settings
+from app.models import Plan
+
+NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def _job(kind="infer", user="u", priority=0, age=0.0):
+    return SimpleNamespace(kind=kind, user_id=user, priority=priority, created_at=NOW - timedelta(seconds=age))
+
+
+def test_order_prefers_tex_then_premium():
+    infer, premium, tex = _job(age=5), _job(user="p", priority=1, age=1), _job("tex", user="t")
+    assert scheduler.order([infer, premium, tex], NOW, {}) == [tex, premium, infer]
+
+
+def test_order_round_robins_users_within_level():
+    a, b = _job(user="a", age=10), _job(user="b", age=1)
+    served = {"a": NOW - timedelta(seconds=1), "b": NOW - timedelta(seconds=30)}
+    assert scheduler.order([a, b], NOW, served) == [b, a]
+    # никого не обслуживали — старшая задача первой
+    assert scheduler.order([b, a], NOW, {}) == [a, b]
+
+
+def test_aging_lifts_starving_job(monkeypatch):
+    monkeypatch.setattr(settings, "SCHED_AGING_SEC", 60.0)
+    old_infer, fresh_tex = _job(age=3 * 60), _job("tex")
+    assert scheduler.order([fresh_tex, old_infer], NOW, {}) == [old_infer, fresh_tex]
+
+
+async def _user_project(make_user, make_project, premium=False):
+    kw = dict(plan=Plan.premium, plan_expires_at=datetime.now(timezone.utc) + timedelta(days=30)) if premium else {}
+    u = await make_user(**kw)
+    return u, (await make_project(u)).id
+
+
+async def test_heavy_user_does_not_block_others(Session, make_user, make_project):
+    heavy, heavy_pid = await _user_project(make_user, make_project)
+    light, light_pid = await _user_project(make_user, make_project)
+    async with Session() as s:
+        for _ in range(5):
+            await jobqueue.enqueue(s, "infer", heavy_pid, user=heavy)
+        await jobqueue.enqueue(s, "infer", light_pid, user=light)
+        await s.commit()
+
+    owners = []
+    for i in range(3):
+        async with Session() as s:
+            owners.append((await jobqueue.lease(s, f"w{i}")).user_id)
+    assert owners[:2] == [heavy.id, light.id]
+    assert owners[2] == heavy.id
+
+
+async def test_premium_and_depth_gauges(Session, make_user, make_project):
+    free, free_pid = await _user_project(make_user, make_project)
+    prem, prem_pid = await _user_project(make_user, make_project, premium=True)
+    async with Session() as s:
+        await jobqueue.enqueue(s, "infer", free_pid, user=free)
+        job = await jobqueue.enqueue(s, "infer", prem_pid, user=prem)
+        await s.commit()
+    assert job.priority == 1
+
+    async with Session() as s:
+        assert await jobqueue.publish_depths(s) == {"tex": 0, "infer": 2}
+    assert metrics.snapshot()["gauges"]["queue.depth.infer"] == 2
+    async with Session() as s:
+        assert (await jobqueue.lease(s, "w1")).user_id == prem.id
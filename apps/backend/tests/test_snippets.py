@@ -0,0 +1,176 @@
+import os
+
+import httpx
+import pytest
+
+from app.config import settings
+from app.main import app
+from app.models import Project, ProjectStatus
+from app.security import create_access_token
+from app.utils import compile_pool, snippets
+from app.utils.assemble_latex import build_mixed_document, formulas_from_tex
+
+# pdflatex: "pdf" — копия исходника; pdftocairo: картинка — копия "pdf"
+FAKE_PDFLATEX = """#!/bin/sh
+if [ "$1" = "--version" ]; then echo "pdfTeX fake"; exit 0; fi
+echo pdflatex >> "{log}"
+cp snippet.tex snippet.pdf
+"""
+
+FAKE_PDFTOCAIRO = """#!/bin/sh
+echo pdftocairo >> "{log}"
+for a in "$@"; do last="$a"; done
+case "$1" in -svg) cp snippet.pdf "$last";; *) cp snippet.pdf "$last.png";; esac
+"""
+
+
+@pytest.fixture
+def tools(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    log = tmp_path / "calls.log"
+    for name, body in (("pdflatex", FAKE_PDFLATEX), ("pdftocairo", FAKE_PDFTOCAIRO)):
+        exe = bindir / name
+        exe.write_text(body.format(log=log))
+        exe.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(settings, "SNIPPET_CACHE_DIR", str(tmp_path / "snippets"))
+    monkeypatch.setattr(settings, "SNIPPET_CACHE_MAX_MB", 16)
+    monkeypatch.setattr(settings, "SNIPPET_PREWARM", False)
+    monkeypatch.setattr(settings, "LATEX_SCRATCH_DIR", str(tmp_path / "scratch"))
+    monkeypatch.setattr(snippets, "_cache", None)
+    monkeypatch.setattr(compile_pool, "_pool", None)
+
+    def calls():
+        return log.read_text().split() if log.exists() else []
+    return calls
+
+
+def test_formulas_from_tex_roundtrip():
+    tex = build_mixed_document([
+        (0, "formula", r"\int_0^1 f(x)\,dx", 0, 0, 200, 30),
+        (1, "text", "где", 0, 100, 40, 120),
+        (2, "formula", r"f(x)=x^2", 50, 100, 120, 120),
+        (3, "formula", r"\frac{a}{b", 0, 200, 100, 220),
+        (4, "formula", "", 0, 300, 100, 320),
+    ], title="t")
+    assert formulas_from_tex(tex) == {0: r"\int_0^1 f(x)\,dx", 2: "f(x)=x^2", 3: r"\frac{a}{b"}
+
+
+def test_formulas_from_edited_tex():
+    # после PATCH display-формулы схлопываются в одну строку (worker._wrap_tex_if_needed)
+    tex = build_mixed_document([(0, "formula", "a+b", 0, 0, 100, 20), (1, "formula", "c", 0, 100, 100, 120)], title="t")
+    tex = tex.replace("\\[\na+b\n\\]", "\\[a+b+c\\]")
+    assert formulas_from_tex(tex) == {0: "a+b+c", 1: "c"}
+
+
+def test_render_is_cached_by_formula(tools):
+    png = snippets.render("x^2")
+    assert b"$\\displaystyle x^2$" in png
+    assert tools() == ["pdflatex", "pdftocairo"]
+
+    assert snippets.render("  x^2\n") == png  # пробелы по краям ключ не меняют
+    assert tools() == ["pdflatex", "pdftocairo"]
+
+    assert b"y^2" in snippets.render("y^2")
+    svg = snippets.render("x^2", fmt="svg")
+    assert b"x^2" in svg
+    assert tools().count("pdflatex") == 3
+
+
+def test_invalid_formula_rendered_as_text(tools):
+    out = snippets.render(r"\frac{a}{b")
+    assert b"\\texttt{" in out and b"displaystyle" not in out
+
+
+async def test_render_many_in_parallel(tools, monkeypatch):
+    monkeypatch.setattr(settings, "LATEX_MAX_CONCURRENCY", 2)
+    res = await snippets.render_many_async(["a", "b", "c", "a"])
+    assert [b"$\\displaystyle " + s + b"$" in r for s, r in zip([b"a", b"b", b"c", b"a"], res)] == [True] * 4
+    assert tools().count("pdflatex") <= 4
+
+
+async def test_preview_endpoint(tools, tmp_path, monkeypatch, make_user, make_project):
+    monkeypatch.setattr(settings, "STORAGE_BACKEND", "local")
+    monkeypatch.setattr(settings, "FILES_DIR", str(tmp_path / "files"))
+    u = await make_user()
+    p = await make_project(u, status=ProjectStatus.ready, tex_key=f"users/{u.id}/projects/x/formulas.tex")
+    headers = {"Authorization": f"Bearer {create_access_token(u)}"}
+    tex_file = tmp_path / "files" / p.tex_key
+    tex_file.parent.mkdir(parents=True)
+    tex_file.write_text(build_mixed_document([(7, "formula", "e^{i\\pi}", 0, 0, 100, 20)], title="t"))
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t") as c:
+        r = await c.get(f"/projects/{p.id}/blocks/7/preview", headers=headers)
+        assert r.status_code == 200 and r.headers["content-type"] == "image/png"
+        assert b"e^{i\\pi}" in r.content
+        tag = r.headers["etag"]
+
+        r = await c.get(f"/projects/{p.id}/blocks/7/preview", headers={**headers, "If-None-Match": tag})
+        assert r.status_code == 304
+
+        r = await c.get(f"/projects/{p.id}/blocks/7/preview?format=svg", headers=headers)
+        assert r.status_code == 200 and r.headers["content-type"].startswith("image/svg+xml")
+
+        assert (await c.get(f"/projects/{p.id}/blocks/8/preview", headers=headers)).status_code == 404
+    assert tools().count("pdflatex") == 2
+
+
+async def test_preview_from_stored_blocks_without_tex(tools, make_user, make_project):
+    # блоки сохранены, tex ещё не собран (или недоступен) — превью всё равно есть
+    u = await make_user()
+    p = await make_project(u, blocks=[{"idx": 3, "kind": "formula", "bbox": [0, 0, 10, 10], "content": "y_1"},
+                                      {"idx": 4, "kind": "text", "bbox": [0, 20, 10, 30], "content": "и"}])
+    headers = {"Authorization": f"Bearer {create_access_token(u)}"}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t") as c:
+        r = await c.get(f"/projects/{p.id}/blocks/3/preview", headers=headers)
+        assert r.status_code == 200 and b"y_1" in r.content
+        assert (await c.get(f"/projects/{p.id}/blocks/4/preview", headers=headers)).status_code == 404
+
+
+def test_prewarm_needs_a_cache_shared_with_the_api(tools, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "SNIPPET_PREWARM", True)
+    monkeypatch.setattr(settings, "SNIPPET_CACHE_DIR", "")
+    monkeypatch.setattr(settings, "TEMP_DIR", str(tmp_path / "tmp"))
+    monkeypatch.setattr(settings, "INPROCESS_WORKERS", 0)
+    assert snippets.prewarm(["z^2"]) == []
+    monkeypatch.setattr(settings, "INPROCESS_WORKERS", 1)
+    assert all(f.result(5) for f in snippets.prewarm(["z^2"]))
+
+
+async def test_concurrent_renders_share_one_compile(tools):
+    res = await snippets.render_many_async(["q^2", "q^2", " q^2 ", "q^2"])
+    assert len(set(res)) == 1 and b"q^2" in res[0]
+    assert tools().count("pdflatex") == 1
+    assert snippets._inflight == {}
+
+
+async def test_worker_prewarms_after_infer(Session, tmp_path, monkeypatch, make_project):
+    import sys, types
+    from app import worker
+    from app.utils.assemble_latex import write_mixed_latex_file
+
+    async def _no_docx(tex_path, token, blocks=None):
+        return None
+
+    def run_full_pipeline(cancel=None, **params):
+        blocks = [{"idx": 1, "kind": "formula", "content": "x^2", "bbox": (0, 0, 100, 20)},
+                  {"idx": 2, "kind": "text", "content": "где", "bbox": (0, 40, 40, 60)}]
+        tex = write_mixed_latex_file([(1, "formula", "x^2", 0, 0, 100, 20)], f"{params['temp_dir']}/page.tex")
+        return {"tex_path": tex, "pdf_path": None, "blocks": blocks, "record": None}
+
+    prewarmed = []
+    monkeypatch.setitem(sys.modules, "app.pipeline", types.SimpleNamespace(run_full_pipeline=run_full_pipeline))
+    monkeypatch.setattr(worker.settings, "INFER_POOL_SIZE", 0)
+    monkeypatch.setattr(worker.settings, "RESULT_CACHE_DIR", str(tmp_path / "results"))
+    monkeypatch.setattr(worker.result_cache, "_cache", None)
+    monkeypatch.setattr(worker, "fetch_to_path", lambda key, dest: open(dest, "wb").write(b"png") and dest)
+    monkeypatch.setattr(worker, "_load_record", lambda key, workdir: None)
+    monkeypatch.setattr(worker, "_maybe_make_docx_async", _no_docx)
+    monkeypatch.setattr(worker, "upload_file", lambda src, key, content_type=None: key)
+    monkeypatch.setattr(worker.snippets, "prewarm", lambda formulas: prewarmed.append(list(formulas)))
+    p = await make_project(image_key="in.png")
+    await worker._run_infer(p.id, str(tmp_path))
+    assert prewarmed == [["x^2"]]
+    async with Session() as s:
+        assert (await s.get(Project, p.id)).status == ProjectStatus.ready
@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+from app import tex_cache, worker
+from app.config import settings
+from app.utils import latex_format
+from app.utils.latex_to_pdf import compile_tex_file_to_pdf, compile_tex_file_to_pdf_async
+
+# заглушки считают запуски: попадание в кэш не должно запускать ничего
+FAKE_LATEXMK = """#!/bin/sh
+if [ "$1" = "--version" ]; then echo "Latexmk fake"; exit 0; fi
+echo latexmk >> "{log}"
+for a in "$@"; do case "$a" in -jobname=*) job="${{a#-jobname=}}";; esac; done
+printf '%%PDF-1.4 fake' > "$job.pdf"
+"""
+
+FAKE_PDFLATEX = """#!/bin/sh
+if [ "$1" = "--version" ]; then echo "pdfTeX fake"; exit 0; fi
+echo pdflatex >> "{log}"
+for a in "$@"; do case "$a" in *.tex) job="${{a%.tex}}";; esac; done
+printf '%%PDF-1.4 fake' > "$job.pdf"
+"""
+
+FAKE_PANDOC = """#!/bin/sh
+if [ "$1" = "--version" ]; then echo "pandoc 3.1 fake"; exit 0; fi
+echo pandoc >> "{log}"
+while [ $# -gt 0 ]; do [ "$1" = "-o" ] && out="$2"; shift; done
+printf 'docx' > "$out"
+"""
+
+DOC = "\\documentclass{article}\n\\begin{document}\n\\[x^2\\]\n\\end{document}\n"
+
+
+@pytest.fixture
+def tools(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    log = tmp_path / "calls.log"
+    log.write_text("")
+    for name, body in (("latexmk", FAKE_LATEXMK), ("pdflatex", FAKE_PDFLATEX), ("pandoc", FAKE_PANDOC)):
+        exe = bindir / name
+        exe.write_text(body.format(log=log))
+        exe.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(settings, "TEX_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(settings, "TEX_CACHE_MAX_MB", 16)
+    monkeypatch.setattr(settings, "LATEX_PRECOMPILED_FORMAT", False)
+    monkeypatch.setattr(tex_cache, "_cache", None)
+    latex_format.tool_version.cache_clear()
+    return lambda: log.read_text().split()
+
+
+def _tex(tmp_path, name, text):
+    d = tmp_path / name
+    d.mkdir()
+    p = d / "formulas.tex"
+    p.write_bytes(text.encode("utf-8"))
+    return p
+
+
+def test_normalize_ignores_line_endings_and_trailing_space():
+    assert tex_cache.normalize("\ufeffa  \r\nb\r\n\r\n") == tex_cache.normalize("a\nb") == "a\nb\n"
+    assert tex_cache.normalize("a b") != tex_cache.normalize("ab")
+
+
+@pytest.mark.skipif(os.name != "posix", reason="shell stand-ins")
+def test_same_source_skips_compile(tmp_path, tools):
+    first = compile_tex_file_to_pdf(_tex(tmp_path, "a", DOC))
+    again = compile_tex_file_to_pdf(_tex(tmp_path, "b", DOC.replace("\n", "  \r\n")))
+    assert again.read_bytes() == first.read_bytes() and again.parent.name == "b"
+    assert tools() == ["pdflatex"]
+    compile_tex_file_to_pdf(_tex(tmp_path, "c", DOC.replace("x^2", "x^3")))
+    assert tools() == ["pdflatex", "pdflatex"]
+
+
+@pytest.mark.skipif(os.name != "posix", reason="shell stand-ins")
+async def test_async_pdf_and_docx_hits_skip_subprocesses(tmp_path, tools):
+    for name in ("a", "b"):
+        tex = _tex(tmp_path, name, DOC)
+        pdf = await compile_tex_file_to_pdf_async(tex)
+        docx = await worker._maybe_make_docx_async(str(tex))
+        assert pdf.exists() and open(docx).read() == "docx"
+    assert tools() == ["pdflatex", "pandoc"]
+
+
+@pytest.mark.skipif(os.name != "posix", reason="shell stand-ins")
+def test_tool_version_is_part_of_the_key(tmp_path, tools, monkeypatch):
+    tex = _tex(tmp_path, "a", DOC)
+    k1 = tex_cache.key(tex, "pdf:pdflatex:pdfTeX 3.14")
+    assert k1 != tex_cache.key(tex, "pdf:pdflatex:pdfTeX 3.15")
+    monkeypatch.setattr(settings, "TEX_CACHE_MAX_MB", 0)
+    assert tex_cache.key(tex, "pdf") is None
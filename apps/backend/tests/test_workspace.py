@@ -0,0 +1,68 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from app import workspace as ws
+from app.workspace import WorkspaceManager, MB
+
+
+@pytest.mark.asyncio
+async def test_job_dir_removed_on_exit_even_on_error(tmp_path):
+    mgr = WorkspaceManager(tmp_path / "work")
+    with pytest.raises(RuntimeError):
+        async with mgr.job("infer") as wd:
+            (open(os.path.join(wd, "page.tex"), "w")).write("x")
+            saved = wd
+            raise RuntimeError("boom")
+    assert not os.path.exists(saved)
+    assert mgr.bytes_in_use() == 0
+
+
+@pytest.mark.asyncio
+async def test_quota_applies_back_pressure(tmp_path, monkeypatch):
+    monkeypatch.setattr(ws.settings, "WORKSPACE_MIN_RESERVE_MB", 1, raising=False)
+    mgr = WorkspaceManager(tmp_path / "work", quota_bytes=3 * MB)
+    order = []
+
+    async def job(name, hold):
+        async with mgr.job("infer", size_hint=2 * MB):
+            order.append(f"start-{name}")
+            await asyncio.sleep(hold)
+            order.append(f"end-{name}")
+
+    await asyncio.gather(job("a", 0.05), job("b", 0))
+    assert order == ["start-a", "end-a", "start-b", "end-b"]
+
+
+@pytest.mark.asyncio
+async def test_small_jobs_go_to_tmpfs(tmp_path):
+    mgr = WorkspaceManager(tmp_path / "work", tmpfs_root=tmp_path / "shm", tmpfs_max_bytes=MB)
+    async with mgr.job("tex", size_hint=1000) as small:
+        assert small.startswith(str(tmp_path / "shm"))
+    async with mgr.job("infer", size_hint=10 * MB) as big:
+        assert big.startswith(str(tmp_path / "work"))
+
+
+def test_gc_removes_orphans_only(tmp_path):
+    root = tmp_path / "work"
+    root.mkdir()
+    dead = root / f"infer-{ws.NODE}-999999999-aaaa"
+    alive = root / f"infer-{ws.NODE}-{os.getpid()}-bbbb"
+    legacy_old = root / "0123456789abcdef"
+    for d in (dead, alive, legacy_old):
+        d.mkdir()
+        (d / "f").write_bytes(b"x" * 10)
+    old = time.time() - 10_000
+    os.utime(legacy_old, (old, old))
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    (inbox / "stale.png").write_bytes(b"x")
+    os.utime(inbox / "stale.png", (old, old))
+
+    mgr = WorkspaceManager(root, orphan_ttl_sec=3600, gc_only_roots=(inbox,))
+    assert mgr.collect() == 3
+    assert alive.exists() and not dead.exists() and not legacy_old.exists()
+    assert not (inbox / "stale.png").exists()
+    assert mgr.bytes_in_use() == 10